@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+'''
+    Microbenchmark of the Cisco exporter's row to metric path, rows/sec
+
+    "before" is the per-value path the exporter used prior to lib/mapping:
+    a dict lookup, .labels(), a formatter call, getattr() of the setter and an
+    f-string metric name for every value, wrapped in try/except.
+    "after" is SwitchParser extracting rows through compiled plans and the
+    exporter merging the batch into bound plans, one value row per label set.
+
+    usage: python3 benchmarks/cisco_mapping.py [--rows N] [--repeat N]
+'''
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ['PROMETHEUS_DISABLE_CREATED_SERIES'] = 'True'
+
+import prometheus_client # noqa
+from lib import util # noqa
+from exporters.cisco import cisco # noqa
+
+def interface_rows(count):
+    rows = []
+
+    for i in range(count):
+        rows.append({
+            'interface': f"Ethernet{i // 48 + 1}/{i % 48 + 1}",
+            'state': 'up', 'admin_state': 'up',
+            'eth_hw_addr': f"aabb.ccdd.{i:04x}", 'desc': f"server-{i}",
+            'eth_txload': '1', 'eth_rxload': '2', 'eth_bw': '10000000', 'eth_mode': 'trunk'
+        })
+
+    return {'TABLE_interface': {'ROW_interface': rows}}
+
+def counter_rows(count):
+    rows = []
+
+    for i in range(count):
+        row = {'interface': f"Ethernet{i // 48 + 1}/{i % 48 + 1}"}
+        for source in cisco.cisco_metrics_wanted['interface_counters_eth'].keys():
+            row[source] = str(i * 1000)
+
+        rows.append(row)
+
+    return {'TABLE_interface': {'ROW_interface': rows}}
+
+'''
+    The per-value path as it was, kept here only for comparison
+'''
+class LegacyWalker():
+    def __init__(self, client):
+        parser = cisco.SwitchParser()
+        self.metric_refs = {}
+
+        for category, metrics in cisco.cisco_metrics_wanted.items():
+            config = cisco.cisco_metric_config[category]
+
+            for metric_source, definition in metrics.items():
+                metric_name = f"cisco_{metric_source}"
+                if config['prefix_with_category_name']:
+                    metric_name = f"cisco_{category}_{metric_source}"
+
+                self.metric_refs[metric_name] = {
+                    'metric': getattr(client, definition[0])(metric_name, config['helptext'], config['labels']),
+                    'formatter': parser.converters[definition[1]],
+                    'setter': 'inc' if definition[0] == 'Counter' else 'set'
+                }
+
+    def add_metric_value(self, metric_name, labels, value):
+        ref = self.metric_refs[metric_name]['metric'].labels(*labels)
+        formatter = self.metric_refs[metric_name]['formatter']
+
+        new_value = formatter(value)
+
+        getattr(ref, self.metric_refs[metric_name]['setter'])(new_value)
+
+        return new_value
+
+    def add_eth_metrics(self, switch_hostname, interface_data):
+        interface = interface_data['interface']
+        labels = [switch_hostname, interface, interface_data['eth_hw_addr'], interface_data.get('desc', 'unknown')]
+
+        current_state = self.add_metric_value('cisco_eth_state', labels, interface_data['state'])
+
+        try:
+            self.add_metric_value('cisco_eth_admin_state', labels, interface_data['admin_state'])
+        except:
+            pass
+
+        if current_state < 1:
+            return
+
+        for metric_source in cisco.cisco_metrics_wanted['eth'].keys():
+            try:
+                self.add_metric_value(f"cisco_{metric_source}", labels, interface_data[metric_source])
+            except:
+                pass
+
+    def add_counters(self, switch_hostname, interface_row, description):
+        labels = [switch_hostname, interface_row['interface'], description]
+
+        for metric_source in cisco.cisco_metrics_wanted['interface_counters_eth'].keys():
+            try:
+                self.add_metric_value(f"cisco_{metric_source}", labels, interface_row[metric_source])
+            except:
+                pass
+
+    def run(self, interfaces, counters):
+        for row in interfaces['TABLE_interface']['ROW_interface']:
+            self.add_eth_metrics('sw1', row)
+
+        for row in counters['TABLE_interface']['ROW_interface']:
+            self.add_counters('sw1', row, 'unknown')
+
+def run_legacy(interfaces, counters):
+    client = util.ScopedClient()
+    LegacyWalker(client).run(interfaces, counters)
+
+def run_plans(interfaces, counters):
+    client = util.ScopedClient()
+    plans = cisco.SwitchParser().plans
+    bound_plans = {category: plan.bind(client) for category, plan in plans.items()}
+
+    parser = cisco.SwitchParser()
+    parser.collect_switch_interfaces('sw1', interfaces)
+    parser.collect_switch_interface_counters('sw1', counters)
+
+    for category, labels, values in parser.batch:
+        bound_plans[category].apply(labels, values)
+
+def run_extract(interfaces, counters):
+    parser = cisco.SwitchParser()
+    parser.collect_switch_interfaces('sw1', interfaces)
+    parser.collect_switch_interface_counters('sw1', counters)
+
+def measure(function, rows, repeat, *args):
+    best = None
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        taken = time.perf_counter() - start
+
+        best = taken if best is None else min(best, taken)
+
+    return rows / best
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cisco exporter row mapping microbenchmark')
+    parser.add_argument('--rows', type=int, default=5000, help='interface rows per table')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per case, best is reported')
+    args = parser.parse_args()
+
+    interfaces = interface_rows(args.rows)
+    counters = counter_rows(args.rows)
+    rows = args.rows * 2
+
+    # timing decorators record into a throwaway registry
+    util.current_registry.set(prometheus_client.CollectorRegistry())
+
+    before = measure(run_legacy, rows, args.repeat, interfaces, counters)
+    after = measure(run_plans, rows, args.repeat, interfaces, counters)
+    extract = measure(run_extract, rows, args.repeat, interfaces, counters)
+
+    print(f"rows per run:               {rows}")
+    print(f"before (per-value setters): {before:12.0f} rows/sec")
+    print(f"after (compiled plans):     {after:12.0f} rows/sec  ({after / before:.2f}x)")
+    print(f"after, extract only:        {extract:12.0f} rows/sec")
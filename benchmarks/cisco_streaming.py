@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+'''
+    Peak memory and time of parsing a large `show interface counters
+    detailed | json` output, buffered and streamed
+
+    "buffered" is the output held whole, decoded and json.loads()ed before
+    its rows are collected, as the Cisco exporter does with --buffered-parse.
+    "streamed" feeds the output in pipe sized chunks to lib/tablerows and
+    collects every row as it completes. Peak memory is measured with
+    tracemalloc, from the first chunk received to the batch being ready, and
+    does not count the generated output itself.
+
+    usage: python3 benchmarks/cisco_streaming.py [--rows N] [--chunk-size BYTES] [--repeat N]
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ['TIMING'] = '0'
+
+from lib import tablerows # noqa
+from exporters.cisco import cisco # noqa
+
+def counters_output(count):
+    rows = []
+
+    for i in range(count):
+        row = {'interface': f"Ethernet{i // 48 + 1}/{i % 48 + 1}"}
+        for source in cisco.cisco_metrics_wanted['interface_counters_eth'].keys():
+            row[source] = str(i * 1000)
+
+        # detailed counters carry many more fields than are collected
+        for extra in range(40):
+            row[f"eth_extra_counter_{extra}"] = str(i * extra)
+
+        rows.append(row)
+
+    return json.dumps({'TABLE_interface': {'ROW_interface': rows}}, indent=2).encode('utf-8')
+
+def chunks(output, chunk_size):
+    for start in range(0, len(output), chunk_size):
+        yield output[start:start + chunk_size]
+
+def buffered(output, chunk_size):
+    parser = cisco.SwitchParser()
+
+    # as communicate() joins what it read
+    received = b''.join(chunks(output, chunk_size))
+    parser.collect_switch_interface_counters('sw', json.loads(received.decode()))
+
+    return parser.batch
+
+def streamed(output, chunk_size):
+    parser = cisco.SwitchParser()
+    rows = tablerows.TableRows('interface')
+    batch = []
+
+    for chunk in chunks(output, chunk_size):
+        for row in rows.feed(chunk):
+            parser.collect_interface_counters_row('sw', row, batch)
+
+    rows.close()
+
+    return batch
+
+def measure(function, output, chunk_size, repeat):
+    best = None
+
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        batch = function(output, chunk_size)
+        elapsed = time.perf_counter() - started_at
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    batch = function(output, chunk_size)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return best, peak, len(batch)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--chunk-size', type=int, default=65536)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    output = counters_output(args.rows)
+    print(f"output: {args.rows} rows, {len(output) / 2**20:.1f} MiB")
+
+    for name, function in (('buffered', buffered), ('streamed', streamed)):
+        seconds, peak, rows = measure(function, output, args.chunk_size, args.repeat)
+        print(f"{name + ':':<10} {seconds * 1000:8.1f} ms, peak {peak / 2**20:7.1f} MiB, {rows} rows")
+
+if __name__ == '__main__':
+    main()
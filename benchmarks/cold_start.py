@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+'''
+    Cold start of ./metrics and of server workers, in milliseconds
+
+    Every command is run --repeat times as a fresh interpreter and timed from
+    spawn to exit, then once more under python -X importtime to list the
+    imports that take the longest (cumulative, children included).
+
+        ./metrics --exporter NAME ...    for every --exporter, the dummy
+                                         exporter is run with --sleep-scale 0
+        ./metrics --exporter unknown     rejected before prometheus_client
+                                         and the exporter are imported
+        import server                    what every server worker pays
+
+    ./metrics is run with the exporter index in the environment, as the web
+    server runs it, unless --no-index is given.
+
+    usage: python3 benchmarks/cold_start.py [--exporter dummy --exporter cisco ...]
+           [--repeat 10] [--top 10] [--no-index] [--output results.json]
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+root_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, root_directory)
+
+from lib import exporterindex # noqa
+
+def exporter_command(name):
+    command = [sys.executable, os.path.join(root_directory, 'metrics'), '--exporter', name, '--no-print']
+
+    if name == 'dummy':
+        command += ['--sleep-scale', '0']
+
+    return command
+
+def percentile(values, share):
+    values = sorted(values)
+
+    return values[min(len(values) - 1, int(round(share * (len(values) - 1))))]
+
+def wall_times(command, environment, repeat):
+    times = []
+
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        subprocess.run(command, cwd=root_directory, env=environment, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append((time.perf_counter() - started_at) * 1000)
+
+    return times
+
+'''
+    Slowest imports as [(module, cumulative ms)], from -X importtime
+'''
+def slowest_imports(command, environment, top):
+    output = subprocess.run(
+        [command[0], '-X', 'importtime'] + command[1:],
+        cwd=root_directory, env=environment, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True
+    ).stderr
+
+    imports = []
+
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+
+        _, cumulative, module = line.split('|')
+        imports.append((module.strip(), int(cumulative) / 1000))
+
+    imports.sort(key=lambda item: item[1], reverse=True)
+
+    return imports[:top]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--exporter', action='append', help='exporter to start, repeatable (default: dummy)')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--top', type=int, default=10, help='slowest imports listed per command')
+    parser.add_argument('--no-index', action='store_true', help='run ./metrics without the exporter index')
+    parser.add_argument('--output', help='also write the results to this file as JSON')
+    args = parser.parse_args()
+
+    environment = dict(os.environ)
+    index_path = None
+
+    if not args.no_index:
+        fd, index_path = tempfile.mkstemp(suffix='.exporters')
+        os.close(fd)
+
+        exporterindex.write_index(index_path, exporterindex.discover()[0])
+        environment['EXPORTER_INDEX'] = index_path
+
+    commands = {f"./metrics --exporter {name}": exporter_command(name) for name in args.exporter or ['dummy']}
+    commands['./metrics --exporter unknown'] = exporter_command('unknown')
+    commands['import server'] = [sys.executable, '-c', 'import server']
+
+    results = {}
+
+    try:
+        for label, command in commands.items():
+            times = wall_times(command, environment, args.repeat)
+
+            results[label] = {
+                'p50_ms': percentile(times, 0.5),
+                'p90_ms': percentile(times, 0.9),
+                'min_ms': min(times),
+                'slowest_imports_ms': slowest_imports(command, environment, args.top)
+            }
+    finally:
+        if index_path is not None:
+            os.remove(index_path)
+
+    for label, result in results.items():
+        print(f"{label}: p50 {result['p50_ms']:.1f} ms, p90 {result['p90_ms']:.1f} ms, min {result['min_ms']:.1f} ms")
+
+        for module, milliseconds in result['slowest_imports_ms']:
+            print(f"    {milliseconds:8.1f} ms  {module}")
+
+    if args.output:
+        with open(args.output, 'w') as handle:
+            json.dump(results, handle, indent=2)
+
+if __name__ == '__main__':
+    main()
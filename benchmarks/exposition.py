@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+'''
+    Exposition encoder against prometheus_client.generate_latest(), series/sec
+
+    A registry with gauges, counters, a histogram, a summary, an info and an
+    enum metric is rendered by both, from families collected up front so only
+    the encoding is timed (collecting is prometheus_client's either way).
+
+        one-shot     Encoder(cache_series=False), as ./metrics renders
+        warm         a reused encoder, as pool workers render, every value
+                     changed since the previous render
+        unchanged    a reused encoder, no value changed
+
+    Output is checked to be byte-identical before timing.
+
+    usage: python3 benchmarks/exposition.py [--series N] [--repeat N]
+'''
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ['PROMETHEUS_DISABLE_CREATED_SERIES'] = 'True'
+
+import prometheus_client # noqa
+from lib import exposition # noqa
+
+def build_registry(series):
+    registry = prometheus_client.CollectorRegistry()
+
+    gauge = prometheus_client.Gauge(
+        'bench_interface_bytes', 'Bytes per "interface"\nand a second line \\ with a backslash',
+        ['instance', 'interface', 'description'], registry=registry
+    )
+    counter = prometheus_client.Counter(
+        'bench_interface_packets', 'Packets per interface', ['instance', 'interface'], registry=registry
+    )
+
+    for i in range(series // 2):
+        interface = f"Ethernet{i // 48 + 1}/{i % 48 + 1}"
+        gauge.labels('rack-sw01', interface, f'uplink "{i}"\n\\').set(i * 1234567.891)
+        counter.labels('rack-sw01', interface).inc(i * 1000)
+
+    histogram = prometheus_client.Histogram('bench_latency_seconds', 'Latency', ['path'], registry=registry)
+    summary = prometheus_client.Summary('bench_runtime_seconds', 'Runtime', ['function'], registry=registry)
+
+    for i in range(100):
+        histogram.labels(f"/path/{i % 10}").observe(i / 100)
+        summary.labels(f"function_{i % 10}").observe(i / 7)
+
+    prometheus_client.Info('bench_build', 'Build information', registry=registry).info({'version': '1.0', 'commit': 'abc'})
+    prometheus_client.Enum('bench_state', 'State', states=['up', 'down'], registry=registry).state('down')
+
+    special = prometheus_client.Gauge('bench_special', 'Special values', ['value'], registry=registry)
+    for value in (float('inf'), float('-inf'), float('nan'), 0, -1.5, 1e-9, 123456789.0, 1234567.0, 2 ** 70):
+        special.labels(str(value)).set(value)
+
+    return registry
+
+class Collected:
+    def __init__(self, families):
+        self.families = families
+
+    def collect(self):
+        return self.families
+
+'''
+    Same families with every value bumped, as the next scrape would see them
+'''
+def changed(families):
+    bumped = []
+
+    for family in families:
+        copy = prometheus_client.Metric(family.name, family.documentation, family.type)
+        copy.samples = [sample._replace(value=sample.value + 1) for sample in family.samples]
+        bumped.append(copy)
+
+    return bumped
+
+def measure(render, repeat):
+    best = None
+
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        render()
+        elapsed = time.perf_counter() - started_at
+
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--series', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    current = Collected(list(build_registry(args.series).collect()))
+    following = Collected(changed(current.families))
+
+    one_shot = exposition.Encoder(cache_series=False)
+    warm = exposition.Encoder()
+
+    for registry in (current, following, current):
+        expected = prometheus_client.generate_latest(registry)
+
+        if one_shot.generate_latest(registry) != expected or warm.generate_latest(registry) != expected \
+                or b''.join(warm.generate_families(registry)) != expected:
+            raise SystemExit("output differs from generate_latest()")
+
+    series = sum(len(family.samples) for family in current.families)
+
+    def alternate():
+        warm.generate_latest(current)
+        warm.generate_latest(following)
+
+    before = measure(lambda: prometheus_client.generate_latest(current), args.repeat)
+    cold = measure(lambda: one_shot.generate_latest(current), args.repeat)
+    after = measure(alternate, args.repeat) / 2
+    unchanged = measure(lambda: warm.generate_latest(current), args.repeat)
+
+    print(f"series:                 {series:12d}")
+    print(f"generate_latest():      {series / before:12.0f} series/sec")
+    print(f"encoder, one-shot:      {series / cold:12.0f} series/sec  ({before / cold:.2f}x)")
+    print(f"encoder, warm:          {series / after:12.0f} series/sec  ({before / after:.2f}x)")
+    print(f"encoder, unchanged:     {series / unchanged:12.0f} series/sec  ({before / unchanged:.2f}x)")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+'''
+    Load test of server.py, JSON results on stdout
+
+    For every worker count, server.py is started on its own and each path is
+    driven at each concurrency level by a closed loop of keep-alive HTTP/1.1
+    clients (every client sends its next request as soon as the previous one
+    is answered) for a fixed duration. Reported per run:
+
+        throughput_rps       answered requests per second, errors included
+        latency_ms           p50, p95, p99, mean and max
+        cpu_ms_per_request   CPU time of the server process tree (workers and
+                             the exporter processes they reaped) per request
+        peak_rss_mb          peak summed RSS of the server process tree
+
+    Client processes are separate from the measured tree, use more of them
+    (--client-processes) if a single one saturates before the server does.
+
+    usage: python3 benchmarks/server_load.py [--workers 1,2,4] [--concurrency 1,8,32]
+           [--path /metrics --path /metrics/dummy?--sleep-scale=0 ...]
+           [--duration 5] [--env POOL_SIZE=2 ...] [--output results.json]
+
+    Linux only, CPU and memory are read from /proc.
+'''
+import os
+import sys
+import json
+import time
+import socket
+import signal
+import asyncio
+import argparse
+import platform
+import subprocess
+import multiprocessing
+
+root_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+default_paths = ['/metrics', '/metrics/dummy?--sleep-scale=0', '/metrics/dummy']
+
+clock_ticks = os.sysconf('SC_CLK_TCK')
+page_size = os.sysconf('SC_PAGE_SIZE')
+
+'''
+    Server process tree, from /proc
+'''
+def children_of():
+    children = {}
+
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+
+        try:
+            with open(f"/proc/{name}/stat", 'r') as handle:
+                fields = handle.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+
+        children.setdefault(int(fields[1]), []).append(int(name))
+
+    return children
+
+def process_tree(pid):
+    children = children_of()
+    tree = [pid]
+
+    for parent in tree:
+        tree.extend(children.get(parent, []))
+
+    return tree
+
+'''
+    CPU seconds of a process, including children it has waited for
+'''
+def cpu_seconds(pid):
+    try:
+        with open(f"/proc/{pid}/stat", 'r') as handle:
+            fields = handle.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return 0.0
+
+    # utime, stime, cutime, cstime
+    return sum(int(field) for field in fields[11:15]) / clock_ticks
+
+def rss_mb(pid):
+    try:
+        with open(f"/proc/{pid}/statm", 'r') as handle:
+            return int(handle.read().split()[1]) * page_size / 1048576
+    except OSError:
+        return 0.0
+
+def tree_cpu_seconds(pid):
+    return sum(cpu_seconds(member) for member in process_tree(pid))
+
+def tree_rss_mb(pid):
+    return sum(rss_mb(member) for member in process_tree(pid))
+
+'''
+    Minimal keep-alive HTTP/1.1 client, understands Content-Length and
+    chunked responses, which is all Sanic sends
+'''
+async def read_response(reader):
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("connection closed")
+
+    status = int(status_line.split()[1])
+    length = None
+    chunked = False
+
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+
+        name, _, value = line.decode('latin-1').partition(':')
+        name = name.strip().lower()
+
+        if name == 'content-length':
+            length = int(value)
+        elif name == 'transfer-encoding' and 'chunked' in value.lower():
+            chunked = True
+
+    if chunked:
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            await reader.readexactly(size + 2)
+
+            if size == 0:
+                break
+    elif length:
+        await reader.readexactly(length)
+
+    return status
+
+async def client_loop(port, path, deadline, latencies, errors):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    request = f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode()
+
+    try:
+        while time.monotonic() < deadline:
+            started_at = time.perf_counter()
+
+            writer.write(request)
+            status = await read_response(reader)
+
+            latencies.append(time.perf_counter() - started_at)
+
+            if status != 200:
+                errors.append(status)
+    finally:
+        writer.close()
+
+async def drive(port, path, concurrency, duration):
+    latencies = []
+    errors = []
+    deadline = time.monotonic() + duration
+
+    await asyncio.gather(*[client_loop(port, path, deadline, latencies, errors) for _ in range(concurrency)])
+
+    return latencies, len(errors)
+
+def client_process(arguments):
+    return asyncio.run(drive(*arguments))
+
+'''
+    Nearest rank percentile of sorted values
+'''
+def percentile(values, fraction):
+    if not values:
+        return None
+
+    return values[min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))]
+
+def split_concurrency(concurrency, processes):
+    shares = [concurrency // processes] * processes
+
+    for i in range(concurrency % processes):
+        shares[i] += 1
+
+    return [share for share in shares if share > 0]
+
+def run_load(server_pid, port, path, concurrency, duration, client_processes, sample_interval=0.1):
+    shares = split_concurrency(concurrency, client_processes)
+
+    with multiprocessing.Pool(len(shares)) as pool:
+        cpu_before = tree_cpu_seconds(server_pid)
+        started_at = time.perf_counter()
+
+        pending = pool.map_async(client_process, [(port, path, share, duration) for share in shares])
+
+        peak_rss = 0.0
+        while not pending.ready():
+            peak_rss = max(peak_rss, tree_rss_mb(server_pid))
+            pending.wait(sample_interval)
+
+        elapsed = time.perf_counter() - started_at
+        cpu_after = tree_cpu_seconds(server_pid)
+
+        latencies = []
+        errors = 0
+        for client_latencies, client_errors in pending.get():
+            latencies.extend(client_latencies)
+            errors += client_errors
+
+    latencies.sort()
+    requests = len(latencies)
+
+    def milliseconds(value):
+        return None if value is None else round(value * 1000, 3)
+
+    return {
+        'path': path,
+        'concurrency': concurrency,
+        'duration': round(elapsed, 3),
+        'requests': requests,
+        'errors': errors,
+        'throughput_rps': round(requests / elapsed, 2),
+        'latency_ms': {
+            'p50': milliseconds(percentile(latencies, 0.50)),
+            'p95': milliseconds(percentile(latencies, 0.95)),
+            'p99': milliseconds(percentile(latencies, 0.99)),
+            'mean': milliseconds(sum(latencies) / requests if requests else None),
+            'max': milliseconds(latencies[-1] if latencies else None)
+        },
+        'cpu_ms_per_request': round((cpu_after - cpu_before) * 1000 / requests, 3) if requests else None,
+        'peak_rss_mb': round(peak_rss, 1)
+    }
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+
+        return probe.getsockname()[1]
+
+def wait_for_server(port, timeout=30):
+    deadline = time.monotonic() + timeout
+
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1) as connection:
+                connection.sendall(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n")
+
+                if connection.recv(12).startswith(b'HTTP/1.1 200'):
+                    return
+        except OSError:
+            pass
+
+        time.sleep(0.2)
+
+    raise Exception(f"server did not come up on port {port}")
+
+def start_server(workers, port, environment, log):
+    env = dict(os.environ)
+    env.update(environment)
+    env['WORKERS'] = str(workers)
+    env['PORT'] = str(port)
+
+    return subprocess.Popen(
+        [sys.executable, 'server.py'],
+        cwd=root_directory,
+        env=env,
+        stdout=log,
+        stderr=log,
+        start_new_session=True
+    )
+
+def stop_server(server):
+    server.send_signal(signal.SIGINT)
+
+    try:
+        server.wait(15)
+    except subprocess.TimeoutExpired:
+        os.killpg(server.pid, signal.SIGKILL)
+        server.wait()
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=root_directory, capture_output=True, text=True
+        ).stdout.strip() or None
+    except OSError:
+        return None
+
+def integer_list(value):
+    return [int(item) for item in value.split(',') if item.strip()]
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test server.py")
+    parser.add_argument('--workers', type=integer_list, default=[1, 2, 4], help="comma separated worker counts")
+    parser.add_argument('--concurrency', type=integer_list, default=[1, 8, 32], help="comma separated concurrency levels")
+    parser.add_argument('--path', action='append', default=None, help="path to request, repeatable")
+    parser.add_argument('--duration', type=float, default=5, help="seconds per run")
+    parser.add_argument('--warmup', type=float, default=1, help="seconds of unmeasured load before each path")
+    parser.add_argument('--client-processes', type=int, default=1, help="processes generating load")
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE', help="server environment, repeatable")
+    parser.add_argument('--server-log', default=os.devnull, help="file for server output")
+    parser.add_argument('--output', default=None, help="write results here instead of stdout")
+    args = parser.parse_args()
+
+    paths = args.path or default_paths
+    environment = dict(item.split('=', 1) for item in args.env)
+
+    report = {
+        'started_at': time.time(),
+        'host': {
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'cpus': os.cpu_count()
+        },
+        'revision': git_revision(),
+        'settings': {
+            'duration': args.duration,
+            'warmup': args.warmup,
+            'client_processes': args.client_processes,
+            'environment': environment
+        },
+        'results': []
+    }
+
+    with open(args.server_log, 'ab') as log:
+        for workers in args.workers:
+            port = free_port()
+            server = start_server(workers, port, environment, log)
+
+            try:
+                wait_for_server(port)
+
+                for path in paths:
+                    if args.warmup > 0:
+                        run_load(server.pid, port, path, max(args.concurrency), args.warmup, args.client_processes)
+
+                    for concurrency in args.concurrency:
+                        result = run_load(server.pid, port, path, concurrency, args.duration, args.client_processes)
+                        result['workers'] = workers
+
+                        report['results'].append(result)
+                        print(
+                            f"workers={workers} concurrency={concurrency} {path}: "
+                            f"{result['throughput_rps']} req/s, p99 {result['latency_ms']['p99']} ms",
+                            file=sys.stderr
+                        )
+            finally:
+                stop_server(server)
+
+    output = json.dumps(report, indent=2)
+
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, 'w') as handle:
+            handle.write(output + "\n")
+
+if __name__ == '__main__':
+    main()
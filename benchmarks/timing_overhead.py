@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+'''
+    Per call overhead of lib/timing, in nanoseconds
+
+    A method that does nothing is called --calls times, undecorated and with
+    each way of timing it, the undecorated time is taken off the others.
+
+        previous       timing.observed as it was, a Summary labelled on
+                       every call
+        summary        timing.observed, cached series
+        sampled 0.1    every tenth call timed on average
+        histogram      histogram buckets instead of a summary
+        disabled       configure(enable=False) after decoration
+        Observe        timing.Observe around the call, previous and current
+
+    usage: python3 benchmarks/timing_overhead.py [--calls N] [--repeat N]
+'''
+import os
+import sys
+import time
+import argparse
+import functools
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ['PROMETHEUS_DISABLE_CREATED_SERIES'] = 'True'
+
+import prometheus_client # noqa
+from lib import util # noqa
+from lib import timing # noqa
+
+'''
+    timing.observed and timing.Observe as they were, a prometheus_client
+    Summary looked up and labelled on every call
+'''
+def previous_metric():
+    metric = util.get_metric("previous_execution_seconds")
+    if metric is None:
+        metric = prometheus_client.Summary("previous_execution_seconds", "Summary of time spent executing something", ['function'], registry=util.current_registry.get())
+
+    return metric
+
+def previous_observed(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        start = time.perf_counter()
+        result = method(self, *args, **kwargs)
+        summary = previous_metric()
+        summary.labels(f"{self.__class__.__name__}.{method.__name__}").observe(round(time.perf_counter() - start, 3))
+
+        return result
+    return wrapper
+
+class PreviousObserve():
+    def __init__(self, class_ref, name):
+        self.name = f"{class_ref.__class__.__name__}.{name}"
+        self.summary = previous_metric()
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *args):
+        self.summary.labels(self.name).observe(round(time.perf_counter() - self.start, 3))
+
+class Subject:
+    def plain(self):
+        pass
+
+    @previous_observed
+    def previous(self):
+        pass
+
+    @timing.observed
+    def current(self):
+        pass
+
+    def previous_context(self):
+        with PreviousObserve(self, 'context'):
+            pass
+
+    def current_context(self):
+        with timing.Observe(self, 'context'):
+            pass
+
+'''
+    Best time of calling function calls times, in nanoseconds per call
+'''
+def measure(function, calls, repeat):
+    best = None
+
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+
+        for _ in range(calls):
+            function()
+
+        elapsed = time.perf_counter() - started_at
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best / calls * 1e9
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calls', type=int, default=200000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    # a registry per run, as the worker pool has
+    client = util.ScopedClient()
+    client.activate()
+
+    subject = Subject()
+    baseline = measure(subject.plain, args.calls, args.repeat)
+
+    def overhead(function):
+        return measure(function, args.calls, args.repeat) - baseline
+
+    results = [('previous', overhead(subject.previous))]
+
+    timing.configure(enable=True, rate=1.0, histogram_buckets=())
+    results.append(('summary', overhead(subject.current)))
+
+    timing.configure(rate=0.1)
+    results.append(('sampled 0.1', overhead(subject.current)))
+
+    # a registry without execution_seconds, so the histogram gets created
+    util.current_registry.set(prometheus_client.CollectorRegistry())
+    timing.configure(rate=1.0, histogram_buckets=(0.0001, 0.001, 0.01, 0.1, 1))
+    results.append(('histogram', overhead(subject.current)))
+
+    timing.configure(enable=False)
+    results.append(('disabled', overhead(subject.current)))
+
+    util.current_registry.set(prometheus_client.CollectorRegistry())
+    timing.configure(enable=True, rate=1.0, histogram_buckets=())
+    results.append(('Observe, previous', overhead(subject.previous_context)))
+    results.append(('Observe', overhead(subject.current_context)))
+
+    print(f"undecorated call:       {baseline:8.0f} ns")
+
+    for name, nanoseconds in results:
+        print(f"{name + ':':<24}{nanoseconds:8.0f} ns/call overhead")
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,23 @@
 from exporters import exporter
 from lib import timing
 from lib import util
+from lib import mapping
+from lib import tablerows
+from lib import sharding
+from lib.namefilter import NameFilter
+from lib.datasource import datasource
 from datetime import datetime, timedelta
 from collections import defaultdict
+import os
+import re
+import time
 import sys
 import json
 import argparse
+import tempfile
 import subprocess
 import multiprocessing
+import concurrent.futures
 import asyncio
 
 class InterfaceState():
@@ -30,232 +40,423 @@ class BGPNeighborState():
     Run command on switch and return result, this intentionally
     has no exception handling, because I'd like the program to fail
     when there is a switch communication problem, because it is a big deal
+
+    A single try, retries are up to SwitchCommands
 '''
-async def asyncio_switch_command(switch_hostname, command, retries=2):
-    for x in range(1, retries+1):
-        try:
-            handle = await asyncio.create_subprocess_shell(
-                f"ssh -o BatchMode=yes -o StrictHostKeyChecking=no -n admin@{switch_hostname} '{command}'",
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-
-            stdout, stderr = await asyncio.wait_for(handle.communicate(), timeout=15)
-
-            if handle.returncode > 0:
-                raise Exception(f"Status code >0. Stderr: {stderr.decode()}")
-            else:
-                break    
-        except:
-            if x == retries:
-                print(f"Command failed after {retries} tries.")
-                raise
+async def asyncio_switch_command(switch_hostname, command, ssh_options=()):
+    handle = await asyncio.create_subprocess_exec(
+        'ssh', '-o', 'BatchMode=yes', '-o', 'StrictHostKeyChecking=no', *ssh_options,
+        '-n', f"admin@{switch_hostname}", command,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+
+    stdout, stderr = await asyncio.wait_for(handle.communicate(), timeout=15)
+
+    if handle.returncode > 0:
+        raise Exception(f"Status code >0. Stderr: {stderr.decode()}")
 
     return stdout.decode()
 
 '''
-    This runs on coroutines to speed things up
+    Feeds the rows of TABLE_table in stream to on_row as they arrive
+'''
+async def read_table_rows(stream, table, on_row):
+    rows = tablerows.TableRows(table)
+
+    while True:
+        chunk = await stream.read(65536)
+
+        if not chunk:
+            break
+
+        for row in rows.feed(chunk):
+            on_row(row)
+
+    rows.close()
+
+'''
+    Run command on switch like asyncio_switch_command, but instead of
+    returning the output, the rows of its TABLE_table are handed to
+    collect(row, batch) as they come off the pipe, and the batch is returned.
+    Every try starts with an empty batch, rows of a failed try are dropped.
+'''
+async def asyncio_switch_table(switch_hostname, command, table, collect, ssh_options=()):
+    batch = []
+
+    handle = await asyncio.create_subprocess_exec(
+        'ssh', '-o', 'BatchMode=yes', '-o', 'StrictHostKeyChecking=no', *ssh_options,
+        '-n', f"admin@{switch_hostname}", command,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+
+    try:
+        # stdout is read to the end even when it does not parse, so ssh can exit
+        parsed, stderr = await asyncio.wait_for(asyncio.gather(
+            read_table_rows(handle.stdout, table, lambda row: collect(row, batch)),
+            handle.stderr.read(),
+            return_exceptions=True
+        ), timeout=15)
+
+        await handle.wait()
+    except BaseException:
+        if handle.returncode is None:
+            handle.kill()
+        raise
+
+    if handle.returncode > 0:
+        raise Exception(f"Status code >0. Stderr: {stderr.decode()}")
+    elif isinstance(parsed, BaseException):
+        raise parsed
+
+    return batch
+
+'''
+    SSH connection to a single switch
+
+    With multiplexing on, the first command sets up a persistent master
+    connection (ControlMaster) that outlives the scrape by control_persist
+    seconds, every other command, in this scrape or the following ones, opens
+    a channel on it instead of doing a full handshake and authentication.
+    At most max_channels commands are in flight on a switch at once.
+'''
+class SwitchConnection():
+    def __init__(self, switch_hostname, max_channels=4, control_directory='/tmp', control_persist=600, multiplexing=True):
+        self.switch_hostname = switch_hostname
+        self.channels = asyncio.Semaphore(max_channels)
+        self.master_ready = asyncio.Lock()
+        self.multiplexing = multiplexing
+        self.control_path = os.path.join(control_directory, f"cisco-ssh-admin@{switch_hostname}")
+        self.control_persist = control_persist
+
+    def ssh_options(self):
+        if not self.multiplexing:
+            return ()
+
+        return (
+            '-o', 'ControlMaster=auto',
+            '-o', f"ControlPath={self.control_path}",
+            '-o', f"ControlPersist={self.control_persist}"
+        )
+
+    async def command(self, command):
+        return await self.run(asyncio_switch_command, command)
+
+    async def table(self, command, table, collect):
+        return await self.run(asyncio_switch_table, command, table, collect)
+
+    async def run(self, function, *args):
+        # without a master yet, let the first command set it up before the rest pile on
+        if self.multiplexing and not os.path.exists(self.control_path):
+            async with self.master_ready:
+                if not os.path.exists(self.control_path):
+                    async with self.channels:
+                        return await function(self.switch_hostname, *args, ssh_options=self.ssh_options())
+
+        async with self.channels:
+            return await function(self.switch_hostname, *args, ssh_options=self.ssh_options())
+
+'''
+    Commands run on every switch: the command, the SwitchParser method
+    collecting a row of its interface table when it is streamed, and the
+    metric categories it is the output of. {range} is where an interface
+    range goes, see selected_commands.
+'''
+switch_commands = {
+    'system_resources': ('show system resources | json', None, ('system_resources',)),
+    'interfaces': ('show interface{range} | json', 'collect_interface_row', ('eth', 'svi')),
+    'interface_counters': ('show interface{range} counters detailed | json', 'collect_interface_counters_row', ('interface_counters_eth', 'interface_counters_svi')),
+    'bgp_summary': ('show bgp all summary | json', None, ('bgp_saf', 'bgp_saf_neighbor'))
+}
+
+'''
+    Commands a scrape runs, as (command, collector) by name: narrowed to
+    interface_range (ie. ethernet1/1-48,vlan10) if given, without those
+    none of the selected metrics come from
+'''
+def selected_commands(selection, interface_range=None):
+    plans = SwitchParser(selection=selection).plans
+    commands = {}
+
+    for name, (command, collector, categories) in switch_commands.items():
+        wanted = any(plans[category].fields for category in categories)
+
+        # ethernet counters take their description from show interface
+        if name == 'interfaces' and plans['interface_counters_eth'].fields:
+            wanted = True
+
+        if wanted:
+            commands[name] = (command.format(range=f" {interface_range}" if interface_range else ''), collector)
+
+    return commands
+
+'''
+    Commands on switches as a data source (see lib/datasource), keyed by
+    (switch, command name in switch_commands), which takes care of retries,
+    caching and metrics of the fetches
+
+    Output is kept as returned by the switch, except for the interface tables
+    when streaming: they are parsed row by row while they are received and
+    their value is the batch of their rows. Connections belong to the event
+    loop of a scrape, connect() sets them up for every scrape.
+
+    refresh_intervals maps command names to how long their output is reused,
+    cache_ttl applies to the others. commands are those of selected_commands,
+    all of them unless given, selection is the one streamed rows are
+    collected with.
+'''
+class SwitchCommands(datasource.DataSource):
+    def __init__(self, streaming=True, debug=False, refresh_intervals=None, commands=None, selection=None, **options):
+        super().__init__('cisco_ssh', **options)
+        self.streaming = streaming
+        self.selection = selection or Selection()
+        self.parser = SwitchParser(debug, self.selection)
+        self.commands = commands or selected_commands(self.selection)
+        self.refresh_intervals = refresh_intervals or {}
+        self.connections = {}
+
+        # output depends on the commands and the selection, runs with other ones must not share it
+        self.variant = repr((sorted(self.commands.items()), self.selection))
+
+    def connect(self, connections):
+        self.connections = connections
+
+    def ttl(self, key):
+        return self.refresh_intervals.get(key[1], self.cache_ttl)
+
+    def path(self, key):
+        return super().path(key + (self.variant,))
+
+    # labels come back from the cache directory as lists
+    def decode(self, value):
+        if 'batch' in value:
+            value['batch'] = [(category, tuple(labels), values) for category, labels, values in value['batch']]
+
+        return value
+
+    async def load(self, key):
+        switch, name = key
+        command, collector = self.commands[name]
+        connection = self.connections[switch]
+
+        if collector is None or not self.streaming:
+            return {'output': await connection.command(command)}
+
+        collect = getattr(self.parser, collector)
+
+        return {'batch': await connection.table(command, 'interface', lambda row, batch: collect(switch, row, batch))}
+
+'''
+    This runs on coroutines to speed things up, commands on a switch
+    run concurrently over its connection
+
+    Parsing happens later, possibly in another process, see SwitchCommands
 '''
-async def asyncio_get_metrics_from_switch(switch_hostname):
+async def asyncio_get_metrics_from_switch(commands, switch):
     data = {
-        'switch': switch_hostname,
+        'switch': switch,
         'commands': {}
     }
 
-    commands = {
-        'system_resources': 'show system resources | json',
-        'interfaces': 'show interface | json',
-        'interface_counters': 'show interface counters detailed | json',
-        'bgp_summary': 'show bgp all summary | json'
-    }
-
-    for key, command in commands.items():
+    async def run_command(key):
         with timing.Timer() as timer:
-            output = json.loads(await asyncio_switch_command(switch_hostname, command))
-        
-        data['commands'][key] = {
-            'output': output,
-            'time': timer.value
-        }
+            result = await commands.fetch((switch, key))
 
-    return data
+        stored_at = commands.stored_at((switch, key))
 
-class CiscoExporter(exporter.Exporter):
-    job_name = 'CiscoExporter'
-    
-    default_switches = [
-        'core-sw01', 'core-sw02', 
-        'rack-sw01', 'rack-sw02', 'rack-sw03', 'rack-sw04', 'rack-sw05', 'rack-sw06'
-    ]
+        # cached values are shared, the time is this scrape's
+        data['commands'][key] = dict(
+            result,
+            time=timer.value,
+            age=0 if stored_at is None else max(0, time.time() - stored_at)
+        )
 
-    '''
-        Get value from enum or -1
-    '''
-    def from_enum(self, enum, value):
-        mapped = getattr(enum, value.upper(), -1)
+    # every command is waited for before a failure is raised, commands left
+    # running would be cancelled when the loop closes, and a subprocess that
+    # is cancelled while it is being spawned can keep the loop from closing
+    results = await asyncio.gather(*[run_command(key) for key in commands.commands], return_exceptions=True)
 
-        if mapped == -1:
-            if self.debug:
-                print (f"cannot map value {value} to enum {enum}")
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
 
-        return mapped
-    
-    '''
-        Takes configuration values from commandline arguments
-    '''
-    def parse_args(self, *args):
-        parser = argparse.ArgumentParser(
-            prog=self.__class__.__name__,
-            description="Collects metrics from Cisco switches",
-            epilog="",
-            # add_help=False
-        )
-        exporter_arguments = parser.add_argument_group('possible exporter arguments')
+    return data
 
-        exporter_arguments.add_argument(
-            '--target', metavar="TARGET", help="specify target, otherwise all", default=None
-        )
+'''
+    Metrics wanted per category: metric source mapped to metric type, the
+    converter for its value (see SwitchParser) and the key in the switch
+    output when it differs from the source, see lib/mapping
+'''
+cisco_metrics_wanted = {
+    'eth': {
+        'eth_txload':       ('Gauge', 'float'),
+        'eth_rxload':       ('Gauge', 'float'),
+        'eth_bw':           ('Gauge', 'float'),
+        'eth_mode':         ('Gauge', 'interface_port_mode'),
+        'eth_state':        ('Gauge', 'interface_state', 'state'),
+        'eth_admin_state':  ('Gauge', 'interface_state', 'admin_state')
+    },
+    'svi': {
+        'svi_bw':               ('Gauge', 'float'),
+        'svi_rx_load':          ('Gauge', 'float'),
+        'svi_tx_load':          ('Gauge', 'float'),
+        'svi_admin_state':      ('Gauge', 'interface_state'),
+        'svi_state':            ('Gauge', 'interface_state', 'svi_line_proto')
+    },
+    'bgp_saf': {
+        'configuredpeers':      ('Gauge', 'float'),
+        'capablepeers':         ('Gauge', 'float'),
+        'totalnetworks':        ('Gauge', 'float'),
+        'totalpaths':           ('Gauge', 'float'),
+        'memoryused':           ('Gauge', 'float'),
+        'numberattrs':          ('Gauge', 'float'),
+        'bytesattrs':           ('Gauge', 'float'),
+        'numberpaths':          ('Gauge', 'float'),
+        'bytespaths':           ('Gauge', 'float'),
+        'numbercommunities':    ('Gauge', 'float'),
+        'bytescommunities':     ('Gauge', 'float'),
+        'numberclusterlist':    ('Gauge', 'float'),
+        'bytesclusterlist':     ('Gauge', 'float')
+    },
+    'bgp_saf_neighbor': {
+        'state':                 ('Gauge', 'bgp_neighbor_state'),
+        'neighbortableversion':  ('Gauge', 'float'),
+        'prefixreceived':        ('Gauge', 'float'),
+        'msgrecvd':              ('Counter', 'float'),
+        'msgsent':               ('Counter', 'float'),
+        'inq':                   ('Counter', 'float'),
+        'outq':                  ('Counter', 'float')
+    },
+    'interface_counters_eth': {
+        'eth_inbytes':      ('Counter', 'float'),
+        'eth_indiscard':    ('Counter', 'float'),
+        'eth_inerr':        ('Counter', 'float'),
+        'eth_inpkts':       ('Counter', 'float'),
+        'eth_ingiants':     ('Counter', 'float'),
+        'eth_outbytes':     ('Counter', 'float'),
+        'eth_outdiscard':   ('Counter', 'float'),
+        'eth_outerr':       ('Counter', 'float'),
+        'eth_outpkts':      ('Counter', 'float'),
+        'eth_outgiants':    ('Counter', 'float')
+    },
+    'interface_counters_svi': {
+        'svi_total_pkts_out':  ('Counter', 'float'),
+        'svi_total_bytes_out': ('Counter', 'float'),
+        'svi_total_pkts_in':   ('Counter', 'float'),
+        'svi_total_bytes_in':  ('Counter', 'float'),
+        'svi_ucast_bytes_out': ('Counter', 'float'),
+        'svi_ucast_pkts_out':  ('Counter', 'float'),
+        'svi_ucast_bytes_in':  ('Counter', 'float'),
+        'svi_ucast_pkts_in':   ('Counter', 'float')
+    },
+    'system_resources': {
+        'memory_usage_total': ('Gauge', 'float'),
+        'memory_usage_used':  ('Gauge', 'float'),
+        'memory_usage_free':  ('Gauge', 'float'),
+        'processes_total':    ('Gauge', 'float'),
+        'processes_running':  ('Gauge', 'float'),
+        'cpu_state_user':     ('Gauge', 'float'),
+        'cpu_state_kernel':   ('Gauge', 'float'),
+        'cpu_state_idle':     ('Gauge', 'float')
+    }
+}
+
+cisco_metric_config = {
+    'eth': {
+        'labels': ['instance', 'interface', 'hwaddr', 'description'],
+        'helptext': 'From show interfaces',
+        'prefix_with_category_name': False,
+        # everything but the state is only of interest when the interface is up
+        'gate': ('eth_state', ['eth_state', 'eth_admin_state'])
+    },
+    'svi': {
+        'labels': ['instance', 'interface', 'hwaddr'],
+        'helptext': 'From show interfaces',
+        'prefix_with_category_name': False,
+        'gate': ('svi_state', ['svi_state', 'svi_admin_state'])
+    },
+    'bgp_saf': {
+        'labels': ['instance', 'af_id', 'router_id', 'local_as'],
+        'helptext': 'From show bgp summary all',
+        'prefix_with_category_name': True
+    },
+    'bgp_saf_neighbor': {
+        'labels': ['instance', 'af_id', 'neighborid', 'router_id', 'local_as', 'neighboras'],
+        'helptext': 'From show bgp summary all',
+        'prefix_with_category_name': True
+    },
+    'interface_counters_eth': {
+        'labels': ['instance', 'interface', 'description'],
+        'helptext': 'From show interface counters detailed',
+        'prefix_with_category_name': False
+    },
+    'interface_counters_svi': {
+        'labels': ['instance', 'interface'],
+        'helptext': 'From show interface counters detailed',
+        'prefix_with_category_name': False
+    },
+    'system_resources': {
+        'labels': ['instance'],
+        'helptext': 'From show system resources',
+        'prefix_with_category_name': False
+    }
+}
 
-        parsed_args = parser.parse_args(args)
+'''
+    What a scrape collects: interfaces by name, ethernet interfaces by
+    description and metrics by name, see lib/namefilter
+'''
+class Selection():
+    def __init__(self, interfaces=None, descriptions=None, metrics=None):
+        self.interfaces = interfaces or NameFilter()
+        self.descriptions = descriptions or NameFilter()
+        self.metrics = metrics or NameFilter()
 
-        return parsed_args
+    def __repr__(self):
+        return f"Selection({self.interfaces!r}, {self.descriptions!r}, {self.metrics!r})"
 
-    # preps metrics references
-    @timing.observed
-    def create_metrics(self):
-        self.cisco_metrics_wanted = {
-            'eth': {
-                'eth_txload':       (self.metrics.Gauge, float),
-                'eth_rxload':       (self.metrics.Gauge, float),
-                'eth_bw':           (self.metrics.Gauge, float),
-                'eth_mode':         (self.metrics.Gauge, self.interface_port_mode_to_value),
-                'eth_state':        (self.metrics.Gauge, self.interface_state_to_value),
-                'eth_admin_state':  (self.metrics.Gauge, self.interface_state_to_value)
-            },
-            'svi': {
-                'svi_bw':               (self.metrics.Gauge, float),
-                'svi_rx_load':          (self.metrics.Gauge, float),
-                'svi_tx_load':          (self.metrics.Gauge, float),
-                'svi_admin_state':      (self.metrics.Gauge, self.interface_state_to_value),
-                'svi_state':            (self.metrics.Gauge, self.interface_state_to_value)
-            },
-            'bgp_saf': {
-                'configuredpeers':      (self.metrics.Gauge, float),
-                'capablepeers':         (self.metrics.Gauge, float),
-                'totalnetworks':        (self.metrics.Gauge, float),
-                'totalpaths':           (self.metrics.Gauge, float),
-                'memoryused':           (self.metrics.Gauge, float),
-                'numberattrs':          (self.metrics.Gauge, float),
-                'bytesattrs':           (self.metrics.Gauge, float),
-                'numberpaths':          (self.metrics.Gauge, float),
-                'bytespaths':           (self.metrics.Gauge, float),
-                'numbercommunities':    (self.metrics.Gauge, float),
-                'bytescommunities':     (self.metrics.Gauge, float),
-                'numberclusterlist':    (self.metrics.Gauge, float),
-                'bytesclusterlist':     (self.metrics.Gauge, float)
-            },
-            'bgp_saf_neighbor': {
-                'state':                 (self.metrics.Gauge, self.bgp_neighbor_state_to_value),
-                'neighbortableversion':  (self.metrics.Gauge, float),
-                'prefixreceived':        (self.metrics.Gauge, float),
-                'msgrecvd':              (self.metrics.Counter, float),
-                'msgsent':               (self.metrics.Counter, float),
-                'inq':                   (self.metrics.Counter, float),
-                'outq':                  (self.metrics.Counter, float)
-            },
-            'interface_counters_eth': {
-                'eth_inbytes':      (self.metrics.Counter, float),
-                'eth_indiscard':    (self.metrics.Counter, float),
-                'eth_inerr':        (self.metrics.Counter, float),
-                'eth_inpkts':       (self.metrics.Counter, float),
-                'eth_ingiants':     (self.metrics.Counter, float),
-                'eth_outbytes':     (self.metrics.Counter, float),
-                'eth_outdiscard':   (self.metrics.Counter, float),
-                'eth_outerr':       (self.metrics.Counter, float),
-                'eth_outpkts':      (self.metrics.Counter, float),
-                'eth_outgiants':    (self.metrics.Counter, float)
-            },
-            'interface_counters_svi': {
-                'svi_total_pkts_out':  (self.metrics.Counter, float),
-                'svi_total_bytes_out': (self.metrics.Counter, float),
-                'svi_total_pkts_in':   (self.metrics.Counter, float),
-                'svi_total_bytes_in':  (self.metrics.Counter, float),
-                'svi_ucast_bytes_out': (self.metrics.Counter, float),
-                'svi_ucast_pkts_out':  (self.metrics.Counter, float),
-                'svi_ucast_bytes_in':  (self.metrics.Counter, float),
-                'svi_ucast_pkts_in':   (self.metrics.Counter, float)
-            },
-            'system_resources': {
-                'memory_usage_total': (self.metrics.Gauge, float),
-                'memory_usage_used':  (self.metrics.Gauge, float),
-                'memory_usage_free':  (self.metrics.Gauge, float),
-                'processes_total':    (self.metrics.Gauge, float),
-                'processes_running':  (self.metrics.Gauge, float),
-                'cpu_state_user':     (self.metrics.Gauge, float),
-                'cpu_state_kernel':   (self.metrics.Gauge, float),
-                'cpu_state_idle':     (self.metrics.Gauge, float)
-            }
-        }
+'''
+    Turns the raw command output of a switch into a flat batch of
+    (category, labels, [(field index, value)]) rows, without touching any
+    metric objects.
+
+    This is the expensive part of a scrape (json parsing and walking every
+    row) and has no state shared with the exporter, so it can run in a child
+    process; the batch is then merged into the registry in the main thread.
+    Timings of a parser in a child process stay in that process. They keep
+    the CiscoExporter.* labels these methods had before they moved here.
+
+    Interfaces and metrics left out by the selection are dropped as their
+    rows are collected, before any values are extracted.
+'''
+class SwitchParser():
+    def __init__(self, debug=False, selection=None):
+        self.debug = debug
+        self.selection = selection or Selection()
+        self.batch = []
+        self.interface_descriptions = {}
 
-        cisco_metric_config = {
-            'eth': {
-                'labels': ['instance', 'interface', 'hwaddr', 'description'],
-                'helptext': 'From show interfaces',
-                'prefix_with_category_name': False
-            },
-            'svi': {
-                'labels': ['instance', 'interface', 'hwaddr'],
-                'helptext': 'From show interfaces',
-                'prefix_with_category_name': False
-            },
-            'bgp_saf': {
-                'labels': ['instance', 'af_id', 'router_id', 'local_as'],
-                'helptext': 'From show bgp summary all',
-                'prefix_with_category_name': True
-            },
-            'bgp_saf_neighbor': {
-                'labels': ['instance', 'af_id', 'neighborid', 'router_id', 'local_as', 'neighboras'],
-                'helptext': 'From show bgp summary all',
-                'prefix_with_category_name': True
-            },
-            'interface_counters_eth': {
-                'labels': ['instance', 'interface', 'description'],
-                'helptext': 'From show interface counters detailed',
-                'prefix_with_category_name': False
-            },
-            'interface_counters_svi': {
-                'labels': ['instance', 'interface'],
-                'helptext': 'From show interface counters detailed',
-                'prefix_with_category_name': False
-            },
-            'system_resources': {
-                'labels': ['instance'],
-                'helptext': 'From show system resources',
-                'prefix_with_category_name': False
-            }
+        self.converters = {
+            'float': float,
+            'interface_state': self.interface_state_to_value,
+            'interface_port_mode': self.interface_port_mode_to_value,
+            'bgp_neighbor_state': self.bgp_neighbor_state_to_value
         }
 
-        self.metric_refs = {}
-
-        for category, metrics in self.cisco_metrics_wanted.items():
-            for metric_source, data in metrics.items():
-                handler, formatter = data
+        self.plans = mapping.compile_plans(cisco_metrics_wanted, cisco_metric_config, self.converters, 'cisco', self.selection.metrics.allows)
 
-                prefix = f"cisco"
-                if cisco_metric_config[category]['prefix_with_category_name']:
-                    prefix = f"{prefix}_{category}"
+    '''
+        Get value from enum or -1
+    '''
+    def from_enum(self, enum, value):
+        mapped = getattr(enum, value.upper(), -1)
 
-                metric_name = f"{prefix}_{metric_source}"
-                
-                self.metric_refs[metric_name] = {
-                    'metric': handler(metric_name, cisco_metric_config[category]['helptext'], cisco_metric_config[category]['labels']),
-                    'formatter': formatter
-                }
+        if mapped == -1:
+            if self.debug:
+                print (f"cannot map value {value} to enum {enum}")
 
-                if handler == self.metrics.Counter:
-                    self.metric_refs[metric_name]['setter'] = 'inc'
-                else:
-                    self.metric_refs[metric_name]['setter'] = 'set'
+        return mapped
 
     def bgp_neighbor_state_to_value(self, state):
         return self.from_enum(BGPNeighborState, state)
@@ -264,7 +465,7 @@ class CiscoExporter(exporter.Exporter):
         return self.from_enum(InterfaceState, state)
 
     def interface_port_mode_to_value(self, mode):
-        return self.from_enum(InterfacePortMode, state)
+        return self.from_enum(InterfacePortMode, mode)
 
     def is_interface_svi(self, blob):
         if blob['interface'].startswith('Vlan'):
@@ -276,191 +477,401 @@ class CiscoExporter(exporter.Exporter):
         
         return False
 
-    # set value using metric formatter and setter
-    # return the set value
-    def add_metric_value(self, metric_name, labels, value):
-        ref = self.metric_refs[metric_name]['metric'].labels(*labels)
-        formatter = self.metric_refs[metric_name]['formatter']
-        
-        new_value = formatter(value)
-
-        getattr(ref, self.metric_refs[metric_name]['setter'])(new_value)
+    # extract the values of a row into the batch, self.batch unless given
+    def add_row(self, category, labels, row, batch=None):
+        values = self.plans[category].extract(row)
 
-        return new_value
+        if values:
+            (self.batch if batch is None else batch).append((category, labels, values))
 
     # svi interface
-    @timing.observed
-    def add_svi_metrics(self, switch_hostname, interface_data):
+    @timing.observed(class_name='CiscoExporter')
+    def add_svi_metrics(self, switch_hostname, interface_data, batch=None):
+        self.add_row('svi', (switch_hostname, interface_data['interface'], interface_data['svi_mac']), interface_data, batch)
+
+    # eth interface, kept without values too: counters of the interface
+    # take its description from it, see describe_interface_counters
+    @timing.observed(class_name='CiscoExporter')
+    def add_eth_metrics(self, switch_hostname, interface_data, batch=None):
         interface = interface_data['interface']
-        hwaddr = interface_data['svi_mac']
-
-        current_state = self.add_metric_value('cisco_svi_state', [switch_hostname, interface, hwaddr], interface_data['svi_line_proto'])
-
-        try:
-            self.add_metric_value('cisco_svi_admin_state', [switch_hostname, interface, hwaddr], interface_data['svi_admin_state'])
-        except:
-            pass
-
-        if current_state < 1:
-            return
-
-        for metric_source, metric_type in self.cisco_metrics_wanted['svi'].items():
-            metric_name = f"cisco_{metric_source}"
-
-            try:
-                self.add_metric_value(metric_name, [switch_hostname, interface, hwaddr], interface_data[metric_source])
-            except:
-                pass
-
-    # eth interface
-    @timing.observed
-    def add_eth_metrics(self, switch_hostname, interface_data):
-        interface = interface_data['interface']
-        hwaddr = interface_data['eth_hw_addr']
         description = self.interface_descriptions[switch_hostname][interface]
 
-        current_state = self.add_metric_value('cisco_eth_state', [switch_hostname, interface, hwaddr, description], interface_data['state'])
-
-        try:
-            self.add_metric_value('cisco_eth_admin_state', [switch_hostname, interface, hwaddr, description], interface_data['admin_state'])
-        except:
-            pass
-
-        if current_state < 1:
-            return
-
-        for metric_source, metric_type in self.cisco_metrics_wanted['eth'].items():
-            metric_name = f"cisco_{metric_source}"
+        values = []
+        if self.selection.descriptions.allows(description):
+            values = self.plans['eth'].extract(interface_data)
 
-            try:
-                self.add_metric_value(metric_name, [switch_hostname, interface, hwaddr, description], interface_data[metric_source])
-            except:
-                pass
+        labels = (switch_hostname, interface, interface_data['eth_hw_addr'], description)
+        (self.batch if batch is None else batch).append(('eth', labels, values))
 
     # fill out interface description
     def add_eth_description(self, switch_hostname, data):
         if switch_hostname not in self.interface_descriptions.keys():
             self.interface_descriptions[switch_hostname] = {}
 
-        interface_name = data['interface']
-
-        interface_description = 'unknown'
-        if 'desc' in data.keys():
-            interface_description = data['desc']
-
-        self.interface_descriptions[switch_hostname][interface_name] = interface_description
+        self.interface_descriptions[switch_hostname][data['interface']] = data.get('desc', 'unknown')
 
     # collect data from interfaces
     # also fill out descriptions of interfaces
     # to be used later
-    @timing.observed
+    @timing.observed(class_name='CiscoExporter')
     def collect_switch_interfaces(self, switch_hostname, data):
-        for row in data['TABLE_interface']['ROW_interface']:
-            if self.is_interface_svi(row):
-                self.add_svi_metrics(switch_hostname, row)
-                continue
+        for row in mapping.table_rows(data, 'interface'):
+            self.collect_interface_row(switch_hostname, row)
+
+    def collect_interface_row(self, switch_hostname, row, batch=None):
+        if not self.selection.interfaces.allows(row['interface']):
+            return
+
+        if self.is_interface_svi(row):
+            self.add_svi_metrics(switch_hostname, row, batch)
+            return
 
-            self.add_eth_description(switch_hostname, row)
-            self.add_eth_metrics(switch_hostname, row)
+        self.add_eth_description(switch_hostname, row)
+        self.add_eth_metrics(switch_hostname, row, batch)
 
     # collect data from interface counters
-    @timing.observed
+    @timing.observed(class_name='CiscoExporter')
     def collect_switch_interface_counters(self, switch_hostname, data):
-        for interface_row in data['TABLE_interface']['ROW_interface']:
-            interface = interface_row['interface']
+        for interface_row in mapping.table_rows(data, 'interface'):
+            self.collect_interface_counters_row(switch_hostname, interface_row)
 
-            if self.is_interface_svi(interface_row):
-                category = 'interface_counters_svi'
-                labels = [switch_hostname, interface]
-            else:
-                category = 'interface_counters_eth'
-                description = self.interface_descriptions[switch_hostname][interface]
-                labels = [switch_hostname, interface, description]
+    # the description is added by describe_interface_counters, interface
+    # rows may not all be in yet when counters are streamed
+    def collect_interface_counters_row(self, switch_hostname, row, batch=None):
+        interface = row['interface']
 
-            for metric_source, metric_type in self.cisco_metrics_wanted[category].items():
-                metric_name = f"cisco_{metric_source}"
+        if not self.selection.interfaces.allows(interface):
+            return
 
-                try:
-                    self.add_metric_value(metric_name, labels, interface_row[metric_source])
-                except:
-                    pass
+        if self.is_interface_svi(row):
+            self.add_row('interface_counters_svi', (switch_hostname, interface), row, batch)
+        else:
+            self.add_row('interface_counters_eth', (switch_hostname, interface), row, batch)
 
-    # bgp data - neightbors states
-    @timing.observed
-    def collect_switch_bgp_summary(self, switch_hostname, data):
-        data = data['TABLE_vrf']['ROW_vrf']
+    # add descriptions to the labels of ethernet counters, taken from the
+    # ethernet interfaces in the batch when their rows were streamed, and
+    # leave out counters of interfaces with descriptions not selected
+    def describe_interface_counters(self, switch_hostname):
+        descriptions = {labels[1]: labels[3] for category, labels, _ in self.batch if category == 'eth'}
+        descriptions.update(self.interface_descriptions.get(switch_hostname, {}))
+
+        allows = self.selection.descriptions.allows
+        described = []
+
+        for category, labels, values in self.batch:
+            if category == 'interface_counters_eth':
+                description = descriptions.get(labels[1], 'unknown')
+
+                if not allows(description):
+                    continue
+
+                labels = labels + (description,)
 
-        if type(data) is not list:
-            data = [data]
+            described.append((category, labels, values))
 
-        for row_vrf in data:
+        self.batch = described
+
+    # bgp data - neightbors states
+    @timing.observed(class_name='CiscoExporter')
+    def collect_switch_bgp_summary(self, switch_hostname, data):
+        for row_vrf in mapping.table_rows(data, 'vrf'):
             router_id = row_vrf['vrf-router-id']
             local_as = row_vrf['vrf-local-as']
 
-            if type(row_vrf['TABLE_af']['ROW_af']) is not list:
-                row_vrf['TABLE_af']['ROW_af'] = [row_vrf['TABLE_af']['ROW_af']]
-
-            for row_af in row_vrf['TABLE_af']['ROW_af']:
+            for row_af in mapping.table_rows(row_vrf, 'af'):
                 af_id = row_af['af-id']
 
-                for metric_source in self.cisco_metrics_wanted['bgp_saf'].keys():
-                    metric_name = f"cisco_bgp_saf_{metric_source}"
+                for row_saf in mapping.table_rows(row_af, 'saf'):
+                    self.add_row('bgp_saf', (switch_hostname, af_id, router_id, local_as), row_saf)
 
                     try:
-                        self.add_metric_value(metric_name, [switch_hostname, af_id, router_id, local_as], row_af['TABLE_saf']['ROW_saf'][metric_source])
-                    except:
-                        pass
+                        neighbors = mapping.table_rows(row_saf, 'neighbor')
+                    except KeyError:
+                        continue
 
-                try:
-                    for neighbor in row_af['TABLE_saf']['ROW_saf']['TABLE_neighbor']['ROW_neighbor']:
-                        neighborid = neighbor['neighborid']
-                        neighboras = neighbor['neighboras']
+                    for neighbor in neighbors:
+                        labels = (switch_hostname, af_id, neighbor['neighborid'], router_id, local_as, neighbor['neighboras'])
+                        self.add_row('bgp_saf_neighbor', labels, neighbor)
 
-                        for metric_source in self.cisco_metrics_wanted['bgp_saf_neighbor'].keys():
-                            metric_name = f"cisco_bgp_saf_neighbor_{metric_source}"
+    # system resources
+    @timing.observed(class_name='CiscoExporter')
+    def collect_switch_system_resources(self, switch_hostname, data):
+        self.add_row('system_resources', (switch_hostname,), data)
 
-                            self.add_metric_value(metric_name, [switch_hostname, af_id, neighborid, router_id, local_as, neighboras], neighbor[metric_source])
-                except:
-                    pass
+    # output of a command, or the batch it was streamed into
+    def collect_command(self, collect, switch_hostname, command):
+        if 'batch' in command:
+            self.batch.extend(command['batch'])
+        else:
+            collect(switch_hostname, json.loads(command['output']))
 
-    # system resources
+    def parse(self, item):
+        switch = item['switch']
+        commands = item['commands']
+
+        collectors = (
+            ('system_resources', self.collect_switch_system_resources),
+            ('bgp_summary', self.collect_switch_bgp_summary),
+            ('interfaces', self.collect_switch_interfaces),
+            ('interface_counters', self.collect_switch_interface_counters)
+        )
+
+        # commands not selected were not run
+        for name, collect in collectors:
+            if name in commands:
+                self.collect_command(collect, switch, commands[name])
+
+        self.describe_interface_counters(switch)
+
+        return {
+            'switch': switch,
+            'times': {command: command_data['time'] for command, command_data in commands.items()},
+            'ages': {command: command_data['age'] for command, command_data in commands.items()},
+            'batch': self.batch
+        }
+
+'''
+    Commands --refresh-intervals applies to. Not interfaces: state and load
+    come from show interface along with the descriptions, and no cheaper
+    command has them, reusing its output would make them stale.
+'''
+refreshable_commands = [name for name in switch_commands if name != 'interfaces']
+
+'''
+    Value of --refresh-intervals, COMMAND:SECONDS,...
+'''
+def refresh_intervals(value):
+    intervals = {}
+
+    for pair in value.split(','):
+        if not pair.strip():
+            continue
+
+        try:
+            command, seconds = pair.split(':', 1)
+            intervals[command.strip()] = float(seconds)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"not COMMAND:SECONDS: {pair}")
+
+        if command.strip() not in refreshable_commands:
+            raise argparse.ArgumentTypeError(f"not a command with a refresh interval: {command.strip()}, one of {', '.join(refreshable_commands)}")
+
+    return intervals
+
+'''
+    Value of --interface-range, goes into show commands as it is, so only
+    what interface ranges are made of is taken
+'''
+def interface_range(value):
+    if re.fullmatch(r'[A-Za-z0-9/.,-]+', value) is None:
+        raise argparse.ArgumentTypeError(f"not an interface range: {value}")
+
+    return value
+
+def default_cache_directory():
+    return os.path.join(tempfile.gettempdir(), 'cisco-exporter-cache')
+
+'''
+    Entry point for parsing in a child process
+'''
+def parse_switch(item, debug, selection=None):
+    return SwitchParser(debug, selection).parse(item)
+
+class CiscoExporter(exporter.Exporter):
+    job_name = 'CiscoExporter'
+    target_argument = '--target'
+    
+    default_switches = [
+        'core-sw01', 'core-sw02', 
+        'rack-sw01', 'rack-sw02', 'rack-sw03', 'rack-sw04', 'rack-sw05', 'rack-sw06'
+    ]
+
+    def __init__(self, *args):
+        super().__init__(*args)
+
+        self.selection = Selection(
+            NameFilter(self.args.include_interfaces, self.args.exclude_interfaces),
+            NameFilter(self.args.include_descriptions, self.args.exclude_descriptions),
+            NameFilter(self.args.include_metrics, self.args.exclude_metrics)
+        )
+
+        # kept with the instance, its cache carries over to the next push of the push daemon
+        self.commands = SwitchCommands(
+            streaming=self.args.parse_workers < 1 and not self.args.buffered_parse,
+            debug=self.debug,
+            concurrency=self.args.fetch_concurrency,
+            retries=self.args.fetch_retries,
+            cache_ttl=self.args.fetch_cache_ttl,
+            cache_size=self.args.fetch_cache_size,
+            cache_dir=self.args.cache_dir,
+            refresh_intervals=self.args.refresh_intervals,
+            commands=selected_commands(self.selection, self.args.interface_range),
+            selection=self.selection
+        )
+
+    '''
+        Takes configuration values from commandline arguments
+    '''
+    def parse_args(self, *args):
+        parser = argparse.ArgumentParser(
+            prog=self.__class__.__name__,
+            description="Collects metrics from Cisco switches",
+            epilog="",
+            # add_help=False
+        )
+        exporter_arguments = parser.add_argument_group('possible exporter arguments')
+
+        exporter_arguments.add_argument(
+            '--target', metavar="TARGET", help="specify target, otherwise all", default=None
+        )
+        exporter_arguments.add_argument(
+            '--ssh-max-channels', metavar="N", type=int, help="max commands in flight per switch", default=4
+        )
+        exporter_arguments.add_argument(
+            '--ssh-control-persist', metavar="SECONDS", type=int, help="keep SSH master connections open for this long after a scrape", default=600
+        )
+        exporter_arguments.add_argument(
+            '--ssh-control-directory', metavar="DIR", help="directory for SSH master connection sockets", default='/tmp'
+        )
+        exporter_arguments.add_argument(
+            '--no-ssh-multiplexing', action='store_true', help="open a new SSH connection per command", default=False
+        )
+        exporter_arguments.add_argument(
+            '--parse-workers', metavar="N", type=int, help="parse switch output in N child processes, 0 parses in process", default=0
+        )
+        exporter_arguments.add_argument(
+            '--buffered-parse', action='store_true', help="parse interface tables once received instead of row by row while receiving", default=False
+        )
+        exporter_arguments.add_argument(
+            '--fetch-concurrency', metavar="N", type=int, help="max commands in flight over all switches", default=32
+        )
+        exporter_arguments.add_argument(
+            '--fetch-retries', metavar="N", type=int, help="times a failed command is tried again", default=1
+        )
+        exporter_arguments.add_argument(
+            '--fetch-cache-ttl', metavar="SECONDS", type=float, help="reuse output of every command for this long", default=0
+        )
+        exporter_arguments.add_argument(
+            '--fetch-cache-size', metavar="N", type=int, help="max command outputs cached in memory", default=256
+        )
+        exporter_arguments.add_argument(
+            '--refresh-intervals', metavar="COMMAND:SECONDS,...", type=refresh_intervals, default={},
+            help=f"reuse output of these commands for this long, ie. bgp_summary:300, commands: {','.join(refreshable_commands)}"
+        )
+        exporter_arguments.add_argument(
+            '--cache-dir', metavar="DIR", help="directory keeping cached command output between runs", default=default_cache_directory()
+        )
+        exporter_arguments.add_argument(
+            '--include-interfaces', metavar="REGEX", action='append', help="only collect interfaces with names matching REGEX, can be repeated", default=None
+        )
+        exporter_arguments.add_argument(
+            '--exclude-interfaces', metavar="REGEX", action='append', help="leave out interfaces with names matching REGEX, can be repeated", default=None
+        )
+        exporter_arguments.add_argument(
+            '--include-descriptions', metavar="REGEX", action='append', help="only collect ethernet interfaces with descriptions matching REGEX", default=None
+        )
+        exporter_arguments.add_argument(
+            '--exclude-descriptions', metavar="REGEX", action='append', help="leave out ethernet interfaces with descriptions matching REGEX", default=None
+        )
+        exporter_arguments.add_argument(
+            '--include-metrics', metavar="REGEX", action='append', help="only collect metrics with names matching REGEX, ie. cisco_eth_.*", default=None
+        )
+        exporter_arguments.add_argument(
+            '--exclude-metrics', metavar="REGEX", action='append', help="leave out metrics with names matching REGEX", default=None
+        )
+        exporter_arguments.add_argument(
+            '--interface-range', metavar="RANGE", type=interface_range, help="only ask switches for these interfaces, ie. ethernet1/1-48,vlan10", default=None
+        )
+        exporter_arguments.add_argument(
+            '--max-series', metavar="N", type=int, help="most series per metric family, 0 for no limit", default=0
+        )
+
+        parsed_args = parser.parse_args(args)
+
+        return parsed_args
+
+    # preps metrics references, the families of every category plan
     @timing.observed
-    def collect_switch_system_resources(self, switch_hostname, data):
-        labels = [switch_hostname]
+    def create_metrics(self):
+        plans = SwitchParser(self.debug, self.selection).plans
 
-        for metric_source, metric_type in self.cisco_metrics_wanted['system_resources'].items():
-            metric_name = f"cisco_{metric_source}"
+        self.bound_plans = {category: plan.bind(self.metrics, self.args.max_series) for category, plan in plans.items()}
 
-            try:
-                self.add_metric_value(metric_name, labels, data[metric_source])
-            except:
-                pass
+    # set values of a parsed switch batch
+    @timing.observed
+    def merge_switch_batch(self, batch):
+        bound_plans = self.bound_plans
+
+        for category, labels, values in batch:
+            # rows without values only carry labels, see SwitchParser.add_eth_metrics
+            if values:
+                bound_plans[category].apply(labels, values)
+
+    # parse in this process or fan out to child processes,
+    # either way batches are merged here, in the main thread
+    def parse_switches(self, raw_data):
+        if self.args.parse_workers < 1:
+            for item in raw_data:
+                yield parse_switch(item, self.debug, self.selection)
+            return
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.args.parse_workers) as executor:
+            futures = [executor.submit(parse_switch, item, self.debug, self.selection) for item in raw_data]
+
+            for future in concurrent.futures.as_completed(futures):
+                yield future.result()
+
+    def switch_connection(self, switch):
+        return SwitchConnection(
+            switch,
+            max_channels=self.args.ssh_max_channels,
+            control_directory=self.args.ssh_control_directory,
+            control_persist=self.args.ssh_control_persist,
+            multiplexing=not self.args.no_ssh_multiplexing
+        )
 
     async def gather_async(self, switches):
-        tasks = [asyncio_get_metrics_from_switch(switch) for switch in switches]
+        self.commands.connect({switch: self.switch_connection(switch) for switch in switches})
+
+        tasks = [asyncio_get_metrics_from_switch(self.commands, switch) for switch in switches]
         raw_data = await asyncio.gather(*tasks, return_exceptions=True)
 
         return raw_data
 
     def gather_metrics(self):
         if self.args.target is None:
-            switches = self.default_switches
+            # all switches of this instance, when several share them
+            switches = sharding.own_targets(self.default_switches)
         else:
             switches = [ self.args.target ]
 
         self.create_metrics()
-        self.interface_descriptions = {}
+        self.commands.register(self.metrics)
 
         # with timing.Observe(self, 'get_metrics_from_switch'):
         raw_data = asyncio.run(self.gather_async(switches))
 
-        timer_metric = self.metrics.Gauge("cisco_command_runtime", "Time taken to obtain data from switch", ['instance', 'command'])
-        
+        # a switch that could not be reached fails the scrape
         for item in raw_data:
-            for command, command_data in item['commands'].items():
-                timer_metric.labels(item['switch'], command).set(command_data['time'])
+            if isinstance(item, BaseException):
+                raise item
+
+        timer_metric = self.metrics.Gauge("cisco_command_runtime", "Time taken to obtain data from switch", ['instance', 'command'])
+        age_metric = self.metrics.Gauge("cisco_command_age_seconds", "Age of the command output used, 0 when fetched in this scrape", ['instance', 'command'])
+
+        with timing.Observe(self, 'parse_switches'):
+            for batch in self.parse_switches(raw_data):
+                for command, time_taken in batch['times'].items():
+                    timer_metric.labels(batch['switch'], command).set(time_taken)
+
+                for command, age in batch['ages'].items():
+                    age_metric.labels(batch['switch'], command).set(age)
+
+                self.merge_switch_batch(batch['batch'])
+
+        if self.args.max_series > 0:
+            dropped_metric = self.metrics.Gauge("cisco_dropped_series", "Label sets left out because the families of their category reached --max-series", ['category'])
 
-            self.collect_switch_system_resources(item['switch'], item['commands']['system_resources']['output'])
-            self.collect_switch_bgp_summary(item['switch'], item['commands']['bgp_summary']['output'])
-            self.collect_switch_interfaces(item['switch'], item['commands']['interfaces']['output'])
-            self.collect_switch_interface_counters(item['switch'], item['commands']['interface_counters']['output'])
+            for category, bound_plan in self.bound_plans.items():
+                if bound_plan.plan.fields:
+                    dropped_metric.labels(category).set(bound_plan.dropped)
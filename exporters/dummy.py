@@ -1,10 +1,21 @@
 from exporters import exporter
 from lib import timing
+import argparse
 import time
 
 class DummyExporter(exporter.Exporter):
     job_name = 'DummyExporter'
-    
+
+    '''
+        --sleep-scale scales all simulated work, 0 makes the exporter return
+        right away (ie. to benchmark the server rather than the exporter)
+    '''
+    def parse_args(self, *args):
+        parser = argparse.ArgumentParser(prog=self.__class__.__name__)
+        parser.add_argument('--sleep-scale', metavar="FACTOR", type=float, help="scale simulated work by FACTOR", default=1.0)
+
+        return parser.parse_args(args)
+
     '''
         Dummy metric as an example
     '''
@@ -13,7 +24,7 @@ class DummyExporter(exporter.Exporter):
         dummy_counter = self.metrics.Counter('dummy_counter', 'A dummy metric, means nothing.', ['dummy_label'])
 
         # let's sleep a bit to simulate some work
-        time.sleep(1)
+        time.sleep(1 * self.args.sleep_scale)
 
         dummy_counter.labels('dummy_label_value').inc(1)
 
@@ -26,14 +37,14 @@ class DummyExporter(exporter.Exporter):
     '''
     @timing.observed
     def observed_function(self):
-        time.sleep(0.3)
+        time.sleep(0.3 * self.args.sleep_scale)
 
         '''
             ...alternatively, anything can be manually timed with the timing.Observe
             context manager
         '''
         with timing.Observe(self, 'my_custom_task'):
-            time.sleep(0.55)
+            time.sleep(0.55 * self.args.sleep_scale)
         '''
             This automatically creates metrics similar to these:
 
@@ -50,7 +61,7 @@ class DummyExporter(exporter.Exporter):
             a generic timer context manager
         '''
         with timing.Timer() as timer:
-            time.sleep(0.25)
+            time.sleep(0.25 * self.args.sleep_scale)
 
         dummy_counter = self.metrics.Counter('generic_timer_seconds', 'Value of generic timer')
         dummy_counter.inc(timer.value)
@@ -11,12 +11,20 @@ import sys
         job_name - used to group metrics under a specific job label
                    when pushing to Pushgateway
            debug - commandline --debug flag
+ target_argument - exporter argument selecting a single target (ie. --target),
+                   exporters that have one can be run for many targets at once
+                   with --targets
+        deadline - event loop time by which an async exporter run inside of
+                   the web server (INPROCESS_EXPORTERS) is cancelled, None
+                   otherwise
 
     See dummy.py
 '''
 class Exporter:
     job_name = 'exporter'
     debug = False
+    target_argument = None
+    deadline = None
 
     def __init__(self, prometheus_client, debug, *args):
         self.metrics = prometheus_client
@@ -34,6 +42,10 @@ class Exporter:
 
         prometheus_client module is available via self.metrics
         all unknown arguments passed to metrics are available via self.args
+
+        When pushing on an interval (./metrics --interval) the same instance
+        is called once per push, with self.metrics set to a fresh registry
+        every time, metrics should be created here rather than in __init__
     '''
     def gather_metrics(self):
         pass
@@ -41,4 +53,8 @@ class Exporter:
     '''
         If you want to use asyncio, defining gather_metrics as a coroutine
         is supported, ie. async def gather_metrics(self)...
+
+        Such exporters can be run in the web server's own event loop, see
+        INPROCESS_EXPORTERS, where they must not block: no blocking I/O,
+        time.sleep() or asyncio.run()
     '''
\ No newline at end of file
@@ -0,0 +1,100 @@
+import time
+import asyncio
+
+'''
+    Admission control for exporter runs
+
+    Every exporter gets a gate allowing a number of runs at once, further runs
+    wait in a queue of limited depth. Runs arriving at a full queue, or that
+    wait in it past their deadline, are rejected right away instead of piling
+    up sub processes.
+
+    Gates are per server worker, like the worker pool.
+'''
+class Rejected(Exception):
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+'''
+    on_change is called with the gate whenever in_flight or queued change
+'''
+class Gate:
+    def __init__(self, limit, queue_depth, on_change=None):
+        self.limit = limit
+        self.queue_depth = queue_depth
+        self.slots = asyncio.Semaphore(limit) if limit > 0 else None
+        self.on_change = on_change
+
+        self.in_flight = 0
+        self.queued = 0
+
+    def changed(self):
+        if self.on_change is not None:
+            self.on_change(self)
+
+    '''
+        Waits for a free slot for up to timeout seconds, returns the time
+        waited. Raises Rejected when the queue is full or the wait timed out.
+    '''
+    async def acquire(self, timeout=None):
+        if self.slots is None:
+            self.in_flight += 1
+            self.changed()
+            return 0.0
+
+        if self.slots.locked() and self.queued >= self.queue_depth:
+            raise Rejected('queue_full')
+
+        started_at = time.perf_counter()
+        self.queued += 1
+        self.changed()
+
+        try:
+            await asyncio.wait_for(self.slots.acquire(), timeout=timeout)
+        except asyncio.TimeoutError:
+            raise Rejected('queue_timeout')
+        finally:
+            self.queued -= 1
+            self.changed()
+
+        self.in_flight += 1
+        self.changed()
+
+        return time.perf_counter() - started_at
+
+    def release(self):
+        self.in_flight -= 1
+
+        if self.slots is not None:
+            self.slots.release()
+
+        self.changed()
+
+'''
+    Gates of all exporters, created lazily on first use. A limit of 0 means
+    no limit. on_change is called with the exporter name and the gate.
+'''
+class Admission:
+    def __init__(self, default_limit, limits, default_queue_depth, queue_depths, on_change=None):
+        self.default_limit = default_limit
+        self.limits = limits
+        self.default_queue_depth = default_queue_depth
+        self.queue_depths = queue_depths
+        self.on_change = on_change
+
+        self.gates = {}
+
+    def gate(self, exporter_name):
+        if exporter_name not in self.gates:
+            on_change = None
+            if self.on_change is not None:
+                on_change = lambda gate: self.on_change(exporter_name, gate) # noqa
+
+            self.gates[exporter_name] = Gate(
+                self.limits.get(exporter_name, self.default_limit),
+                self.queue_depths.get(exporter_name, self.default_queue_depth),
+                on_change
+            )
+
+        return self.gates[exporter_name]
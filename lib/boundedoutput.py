@@ -0,0 +1,64 @@
+import io
+
+'''
+    Bounded copies of exporter output
+
+    The web server keeps only the start of an exporter's stdout (where
+    ./metrics tells an exporter was not found) and the end of its stderr
+    (where tracebacks end), with a marker in place of the bytes dropped, so
+    an exporter printing without end cannot grow a server worker's memory.
+    Everything is counted, kept or not.
+'''
+class BoundedOutput:
+    def __init__(self, limit, tail=False):
+        self.limit = limit
+        self.tail = tail
+        self.kept = bytearray()
+        self.total = 0
+
+    def add(self, chunk):
+        self.total += len(chunk)
+
+        if self.tail:
+            self.kept += chunk
+
+            if len(self.kept) > self.limit:
+                del self.kept[:len(self.kept) - self.limit]
+        elif len(self.kept) < self.limit:
+            self.kept += chunk[:self.limit - len(self.kept)]
+
+    @property
+    def truncated(self):
+        return self.total > len(self.kept)
+
+    '''
+        Kept bytes as text, with a marker where bytes were dropped, a cut
+        through a character is replaced
+    '''
+    def text(self):
+        text = self.kept.decode('utf-8', 'replace')
+        dropped = self.total - len(self.kept)
+
+        if not dropped:
+            return text
+
+        if self.tail:
+            return f"[truncated, first {dropped} bytes dropped]\n{text}"
+
+        return f"{text}\n[truncated, last {dropped} bytes dropped]\n"
+
+'''
+    Text stream writing into a BoundedOutput, for sys.stdout and sys.stderr
+    of jobs run in a pool worker
+'''
+class BoundedWriter(io.TextIOBase):
+    def __init__(self, output):
+        self.output = output
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        self.output.add(text.encode('utf-8', 'replace'))
+
+        return len(text)
@@ -0,0 +1,188 @@
+import zlib
+import asyncio
+from collections import OrderedDict
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+'''
+    Response compression
+
+    The encoding is negotiated from the client's Accept-Encoding header, zstd
+    is offered only when the zstandard package is installed. Bodies past
+    offload_size are compressed in a thread, off the event loop (zlib and
+    zstd release the GIL while they work).
+
+    Bodies that are the same for many scrapes (cached results, snapshots) are
+    compressed once per version and kept in a LRU bounded by cache_bytes, so
+    repeat scrapes are served the same compressed bytes. A part that changes
+    with every response (ie. a snapshot's age) is not cached: for gzip the
+    deflate state after the body is kept along and a copy of it finishes the
+    stream with the suffix, for zstd the suffix is appended as its own frame.
+'''
+
+# rough size of a deflate state kept along with a cached body
+GZIP_STATE_BYTES = 256 * 1024
+
+
+'''
+    Accept-Encoding as {coding: q}
+'''
+def accepted_encodings(header):
+    accepted = {}
+
+    for part in header.split(','):
+        coding, _, parameters = part.partition(';')
+        coding = coding.strip().lower()
+
+        if not coding:
+            continue
+
+        quality = 1.0
+
+        for parameter in parameters.split(';'):
+            name, _, value = parameter.partition('=')
+
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+
+        accepted[coding] = quality
+
+    return accepted
+
+def as_bytes(body):
+    if isinstance(body, str):
+        return body.encode('utf-8')
+
+    return body
+
+class Compressor:
+    def __init__(self, gzip_level=6, zstd_level=3, min_size=1024, offload_size=65536, cache_bytes=64 * 1048576):
+        self.gzip_level = gzip_level
+        self.zstd_level = zstd_level
+        self.min_size = min_size
+        self.offload_size = offload_size
+        self.cache_bytes = cache_bytes
+
+        # in order of preference
+        self.encodings = ['gzip']
+        if zstandard is not None:
+            self.encodings.insert(0, 'zstd')
+
+        self.cache = OrderedDict()
+        self.cached_bytes = 0
+
+    '''
+        Best encoding the client accepts, None for identity
+    '''
+    def negotiate(self, accept_encoding):
+        if not accept_encoding:
+            return None
+
+        accepted = accepted_encodings(accept_encoding)
+        wildcard = accepted.get('*', 0.0)
+
+        best = None
+        best_quality = 0.0
+
+        for encoding in self.encodings:
+            quality = accepted.get(encoding, wildcard)
+
+            if quality > best_quality:
+                best = encoding
+                best_quality = quality
+
+        return best
+
+    def zstd_compress(self, body):
+        return zstandard.ZstdCompressor(level=self.zstd_level).compress(body)
+
+    '''
+        Compressed body as (bytes, state), where state is what is needed to
+        finish the stream with more data: a deflate stream that was only
+        flushed for gzip, None for zstd, whose frames are complete
+    '''
+    def start(self, body, encoding):
+        if encoding == 'zstd':
+            return self.zstd_compress(body), None
+
+        # wbits 31 writes a gzip header and trailer
+        deflate = zlib.compressobj(self.gzip_level, zlib.DEFLATED, 31)
+
+        return deflate.compress(body) + deflate.flush(zlib.Z_SYNC_FLUSH), deflate
+
+    def finish(self, started, suffix):
+        compressed, deflate = started
+
+        if deflate is None:
+            return compressed + self.zstd_compress(suffix) if suffix else compressed
+
+        # the cached state stays untouched for the next response
+        deflate = deflate.copy()
+
+        return compressed + deflate.compress(suffix) + deflate.flush()
+
+    '''
+        Returns (body, encoding) as bytes, encoding is None if body was left
+        as is. body and suffix are str or bytes, suffix is appended to body.
+
+        version identifies body (ie. a cache key and when it was stored),
+        bodies with a version are compressed once and then served from memory.
+    '''
+    async def compress(self, body, encoding, version=None, suffix=''):
+        if encoding is None or len(body) + len(suffix) < self.min_size:
+            return as_bytes(body) + as_bytes(suffix), None
+
+        if version is None:
+            body = as_bytes(body) + as_bytes(suffix)
+            suffix = ''
+
+        started = await self.start_body(body, encoding, version)
+
+        return self.finish(started, as_bytes(suffix)), encoding
+
+    async def start_body(self, body, encoding, version):
+        cache_key = None
+        if version is not None:
+            cache_key = (version, encoding)
+            started = self.cache.get(cache_key)
+
+            if started is not None:
+                self.cache.move_to_end(cache_key)
+                return started
+
+        body = as_bytes(body)
+
+        if len(body) >= self.offload_size:
+            started = await asyncio.get_running_loop().run_in_executor(None, self.start, body, encoding)
+        else:
+            started = self.start(body, encoding)
+
+        if cache_key is not None:
+            self.remember(cache_key, started)
+
+        return started
+
+    def cost(self, started):
+        compressed, deflate = started
+
+        return len(compressed) + (GZIP_STATE_BYTES if deflate is not None else 0)
+
+    def remember(self, cache_key, started):
+        if self.cost(started) > self.cache_bytes:
+            return
+
+        if cache_key in self.cache:
+            self.cached_bytes -= self.cost(self.cache.pop(cache_key))
+
+        self.cache[cache_key] = started
+        self.cached_bytes += self.cost(started)
+
+        while self.cached_bytes > self.cache_bytes:
+            _, evicted = self.cache.popitem(last=False)
+            self.cached_bytes -= self.cost(evicted)
@@ -0,0 +1,32 @@
+import os
+
+'''
+    Helpers for reading server configuration from the environment
+'''
+def env_int(name, default):
+    return int(os.getenv(name, default))
+
+def env_float(name, default):
+    return float(os.getenv(name, default))
+
+'''
+    Per exporter values, in the form of NAME:VALUE,NAME:VALUE
+    ie. POOL_SIZES=cisco:1,dummy:4
+'''
+def env_per_exporter(name, cast=int):
+    values = {}
+
+    for pair in os.getenv(name, '').split(','):
+        if ':' not in pair:
+            continue
+
+        exporter, value = pair.split(':', 1)
+        values[exporter.strip()] = cast(value.strip())
+
+    return values
+
+'''
+    Comma separated values, ie. TIMING_BUCKETS=0.01,0.1,1
+'''
+def env_list(name):
+    return [value.strip() for value in os.getenv(name, '').split(',') if value.strip()]
@@ -1,11 +1,291 @@
-import prometheus_client as metrics
-from lib import timing
+import os
 import time
+import json
+import asyncio
+import hashlib
+import tempfile
+from collections import OrderedDict
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, SummaryMetricFamily
 
 '''
     Generic DataSource class that handles generating metrics for its own status
     and timing its own functions
+
+    A data source fetches values by key from somewhere slow (a device over
+    SSH, an API), subclasses implement load(key) and exporters await
+    fetch(key). On top of load() a data source gives:
+
+        caching      values are kept for cache_ttl seconds (or ttl(key),
+                     per key), at most cache_size of them, least recently
+                     used go first
+        persistence  with a cache_dir, cached values are also kept as files
+                     there, so runs of ./metrics, each a new process, reuse
+                     what an earlier run fetched
+        coalescing   concurrent fetches of a key share one load
+        concurrency  at most concurrency loads in flight at once
+        retries      a failed load is tried again up to retries times,
+                     backoff seconds later, doubling every time
+        metrics      register(self.metrics) adds latency, error, retry and
+                     cache metrics of every source to the exporter's registry,
+                     labelled by the source's name
+
+    A data source can outlive a scrape (ie. on an exporter instance reused by
+    the push daemon) and so be used by several event loops one after another,
+    its cache carries over, register it with the registry of every scrape.
+
+    Files in cache_dir are JSON, values have to survive a round trip through
+    json or be brought back by decode(). Processes sharing a cache_dir do not
+    coalesce their loads, the last one to store wins.
 '''
 class DataSource:
+    def __init__(self, name, concurrency=8, retries=2, backoff=0.5, timeout=None, cache_ttl=0, cache_size=256, cache_dir=None):
+        self.name = name
+        self.concurrency = max(1, concurrency)
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.cache_dir = cache_dir
+
+        if cache_dir is not None:
+            os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+
+        # key -> (stored at, value), least recently used first
+        self.cache = OrderedDict()
+
+        # key -> future of the load in flight
+        self.pending = {}
+
+        self.semaphore = None
+        self.semaphore_loop = None
+
+        self.tries = 0
+        self.seconds = 0.0
+        self.errors = 0
+        self.retried = 0
+        self.lookups = {'hit': 0, 'disk_hit': 0, 'miss': 0, 'coalesced': 0}
+
+    '''
+        Value of key, to be implemented by subclasses
+    '''
+    async def load(self, key):
+        raise NotImplementedError
+
+    '''
+        Seconds a value of key stays fresh, subclasses can have a ttl per key
+    '''
+    def ttl(self, key):
+        return self.cache_ttl
+
+    '''
+        Value as stored in and read back from cache_dir
+    '''
+    def encode(self, value):
+        return value
+
+    def decode(self, value):
+        return value
+
+    '''
+        Value of key, from the cache when there is a fresh one, ttl overrides
+        ttl(key) for this fetch
+    '''
+    async def fetch(self, key, ttl=None):
+        ttl = self.ttl(key) if ttl is None else ttl
+
+        if ttl > 0:
+            entry = self.cache.get(key)
+
+            if entry is not None and time.time() - entry[0] < ttl:
+                self.cache.move_to_end(key)
+                self.lookups['hit'] += 1
+
+                return entry[1]
+
+            # another process may have stored a fresher one
+            entry = self.read(key) if self.cache_dir is not None else None
+
+            if entry is not None and time.time() - entry[0] < ttl:
+                self.remember(key, entry)
+                self.lookups['disk_hit'] += 1
+
+                return entry[1]
+
+        pending = self.pending.get(key)
+
+        # a load left behind by the loop of an earlier scrape never finishes
+        if pending is not None and pending.get_loop() is asyncio.get_running_loop():
+            self.lookups['coalesced'] += 1
+
+            # one fetch giving up must not cancel the load for the others
+            return await asyncio.shield(pending)
+
+        self.lookups['miss'] += 1
+
+        future = self.pending[key] = asyncio.ensure_future(self.load_with_retries(key))
+
+        try:
+            value = await asyncio.shield(future)
+        finally:
+            if future.done():
+                self.forget(key, future)
+            else:
+                # the fetch was cancelled, the load goes on for whoever shares it
+                future.add_done_callback(lambda done: self.forget(key, done))
+
+        if ttl > 0:
+            self.store(key, value)
+
+        return value
+
+    def forget(self, key, future):
+        if self.pending.get(key) is future:
+            del self.pending[key]
+
+        # nobody may be waiting for it anymore
+        if not future.cancelled():
+            future.exception()
+
+    def store(self, key, value):
+        entry = (time.time(), value)
+
+        self.remember(key, entry)
+
+        if self.cache_dir is not None:
+            self.write(key, entry)
+
+    def remember(self, key, entry):
+        self.cache[key] = entry
+        self.cache.move_to_end(key)
+
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    '''
+        Wall clock time the cached value of key was stored, None if there is none
+    '''
+    def stored_at(self, key):
+        entry = self.cache.get(key)
+
+        return entry[0] if entry is not None else None
+
+    def invalidate(self, key=None):
+        if key is None:
+            self.cache.clear()
+        else:
+            self.cache.pop(key, None)
+
+    def path(self, key):
+        digest = hashlib.sha1(repr((self.name, key)).encode()).hexdigest()
+
+        return os.path.join(self.cache_dir, f"{digest}.entry")
+
+    def read(self, key):
+        try:
+            with open(self.path(key), 'r') as handle:
+                entry = json.load(handle)
+        except (OSError, ValueError):
+            return None
+
+        return (entry['stored_at'], self.decode(entry['value']))
+
+    def write(self, key, entry):
+        fd, temporary = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+
+        try:
+            with os.fdopen(fd, 'w') as handle:
+                json.dump({'stored_at': entry[0], 'value': self.encode(entry[1])}, handle)
+
+            os.replace(temporary, self.path(key))
+        except (OSError, TypeError, ValueError):
+            # a value that cannot be kept is only cached in memory
+            try:
+                os.remove(temporary)
+            except OSError:
+                pass
+
+    '''
+        Semaphore of the running loop, a semaphore cannot be shared by loops
+    '''
+    def slots(self):
+        loop = asyncio.get_running_loop()
+
+        if self.semaphore_loop is not loop:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+            self.semaphore_loop = loop
+
+        return self.semaphore
+
+    async def load_with_retries(self, key):
+        delay = self.backoff
+
+        for attempt in range(self.retries + 1):
+            started_at = time.perf_counter()
+
+            try:
+                async with self.slots():
+                    if self.timeout is None:
+                        return await self.load(key)
+
+                    return await asyncio.wait_for(self.load(key), timeout=self.timeout)
+            except Exception:
+                self.errors += 1
+
+                if attempt == self.retries:
+                    raise
+            finally:
+                self.tries += 1
+                self.seconds += time.perf_counter() - started_at
+
+            self.retried += 1
+
+            await asyncio.sleep(delay)
+            delay *= 2
+
+    def register(self, client):
+        registry = client.REGISTRY
+        collector = registry._names_to_collectors.get('datasource_fetch_seconds')
+
+        if collector is None:
+            collector = DataSourceMetrics()
+            registry.register(collector)
+
+        collector.add(self)
+
+'''
+    Metrics of the data sources registered with a registry
+'''
+class DataSourceMetrics:
     def __init__(self):
-        pass
\ No newline at end of file
+        self.sources = []
+
+    def add(self, source):
+        if source not in self.sources:
+            self.sources.append(source)
+
+    def families(self):
+        return (
+            SummaryMetricFamily('datasource_fetch_seconds', "Time spent loading from data sources, every try", labels=['source']),
+            CounterMetricFamily('datasource_fetch_errors', "Failed tries of loads from data sources", labels=['source']),
+            CounterMetricFamily('datasource_fetch_retries', "Loads from data sources tried again", labels=['source']),
+            CounterMetricFamily('datasource_cache', "Data source fetches, by result: hit, disk_hit, miss, coalesced", labels=['source', 'result']),
+            GaugeMetricFamily('datasource_cache_entries', "Values held in data source caches", labels=['source'])
+        )
+
+    def describe(self):
+        return self.families()
+
+    def collect(self):
+        seconds, errors, retries, lookups, entries = self.families()
+
+        for source in self.sources:
+            seconds.add_metric([source.name], source.tries, source.seconds)
+            errors.add_metric([source.name], source.errors)
+            retries.add_metric([source.name], source.retried)
+            entries.add_metric([source.name], len(source.cache))
+
+            for result, count in source.lookups.items():
+                lookups.add_metric([source.name, result], count)
+
+        return (seconds, errors, retries, lookups, entries)
@@ -0,0 +1,163 @@
+import os
+import ast
+import json
+import importlib
+
+'''
+    Exporter index
+
+    Exporters under exporters/ are found and checked once, without importing
+    them: every candidate module is parsed and its classes inheriting Exporter
+    are looked up in the syntax tree. The result is a JSON index of exporter
+    name to module and class that the web server writes at start up and hands
+    down through the environment, so server workers answer unknown exporter
+    names without spawning anything and ./metrics imports the right module
+    and class directly.
+'''
+exporters_directory = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'exporters')
+
+def default_path():
+    import tempfile
+
+    base = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+    return os.path.join(base, f"metrics-server-{os.getpid()}.exporters")
+
+'''
+    Exporters live either in exporters/NAME/NAME.py or exporters/NAME.py,
+    the former wins, same as when importing them. Yields (name, module, path)
+'''
+def candidates(directory=exporters_directory):
+    for entry in sorted(os.listdir(directory)):
+        if entry.startswith(('_', '.')):
+            continue
+
+        path = os.path.join(directory, entry, f"{entry}.py")
+        if os.path.isfile(path):
+            yield entry, f"exporters.{entry}.{entry}", path
+            continue
+
+        name, extension = os.path.splitext(entry)
+        if extension == '.py' and name != 'exporter' and not os.path.isdir(os.path.join(directory, name)):
+            yield name, f"exporters.{name}", os.path.join(directory, entry)
+
+def base_name(node):
+    if isinstance(node, ast.Name):
+        return node.id
+    elif isinstance(node, ast.Attribute):
+        return node.attr
+
+    return None
+
+'''
+    Classes of a module inheriting Exporter, directly or through another
+    class of the same module, in the order they are defined
+'''
+def exporter_classes(tree):
+    classes = [node for node in tree.body if isinstance(node, ast.ClassDef)]
+    found = {'Exporter'}
+
+    # a class may come before the class it inherits
+    changed = True
+    while changed:
+        changed = False
+
+        for node in classes:
+            if node.name not in found and any(base_name(base) in found for base in node.bases):
+                found.add(node.name)
+                changed = True
+
+    return [node for node in classes if node.name in found and node.name != 'Exporter']
+
+'''
+    target_argument of a class, as set in its body or that of a class of the
+    same module it inherits, None if neither sets it to a string
+'''
+def target_argument(node, classes):
+    by_name = {candidate.name: candidate for candidate in classes}
+    pending = [node]
+    seen = set()
+
+    while pending:
+        current = pending.pop(0)
+
+        if current.name in seen:
+            continue
+        seen.add(current.name)
+
+        for statement in current.body:
+            if isinstance(statement, ast.Assign) and any(isinstance(target, ast.Name) and target.id == 'target_argument' for target in statement.targets):
+                value = statement.value
+                return value.value if isinstance(value, ast.Constant) and isinstance(value.value, str) else None
+
+        pending.extend(by_name[base_name(base)] for base in current.bases if base_name(base) in by_name)
+
+    return None
+
+'''
+    Returns (index, problems): index is {name: {'module', 'class', 'path',
+    'target_argument'}},
+    problems is {name: reason} of candidates that are not usable exporters
+'''
+def discover(directory=exporters_directory):
+    index = {}
+    problems = {}
+
+    for name, module, path in candidates(directory):
+        try:
+            with open(path, 'rb') as handle:
+                tree = ast.parse(handle.read(), path)
+        except (OSError, SyntaxError, ValueError) as e:
+            problems[name] = f"{type(e).__name__}: {e}"
+            continue
+
+        classes = exporter_classes(tree)
+
+        if not classes:
+            problems[name] = "No class inheriting Exporter found in module."
+            continue
+
+        # same pick as find_exporter_class(), which goes by dir() order
+        chosen = min(classes, key=lambda node: node.name)
+
+        index[name] = {
+            'module': module,
+            'class': chosen.name,
+            'path': path,
+            'target_argument': target_argument(chosen, classes)
+        }
+
+    return index, problems
+
+def write_index(path, index):
+    import tempfile
+
+    directory = os.path.dirname(path) or '.'
+    fd, temporary = tempfile.mkstemp(dir=directory, suffix='.tmp')
+
+    with os.fdopen(fd, 'w') as handle:
+        json.dump(index, handle)
+
+    os.replace(temporary, path)
+
+def read_index(path):
+    with open(path, 'r') as handle:
+        return json.load(handle)
+
+'''
+    Index handed down by the web server, None when there is none (ie. when
+    ./metrics is run by hand) or it cannot be read
+'''
+def inherited_index():
+    path = os.getenv('EXPORTER_INDEX')
+
+    if not path:
+        return None
+
+    try:
+        return read_index(path)
+    except (OSError, ValueError):
+        return None
+
+def load_class(entry):
+    return getattr(importlib.import_module(entry['module']), entry['class'])
@@ -0,0 +1,301 @@
+'''
+    Text exposition
+
+    Produces the same bytes as prometheus_client.generate_latest(), with the
+    parts that do not change between collections cached by an Encoder:
+
+        - HELP/TYPE headers of every family
+        - the name and rendered (escaped, sorted) label set of every sample
+
+    as well as the last rendered line of every series. A sample that was seen
+    before costs a dict lookup and a float format, or only the lookup if its
+    value did not change.
+    Long-lived processes (pool workers, server workers) keep one encoder
+    around, ./metrics pays for the first render only.
+
+    Families can also be rendered one at a time, so the exposition can be
+    written out while the rest is still being encoded and never has to sit
+    in memory at once.
+'''
+INF = float('inf')
+MINUS_INF = float('-inf')
+
+# OpenMetrics only samples, rendered as separate gauges after their family
+OPENMETRICS_SUFFIXES = ('_created', '_gsum', '_gcount')
+
+'''
+    prometheus_client is only imported once something is rendered, the web
+    server uses the helpers below without ever collecting a registry
+'''
+def default_registry(registry):
+    if registry is None:
+        import prometheus_client
+        return prometheus_client.REGISTRY
+
+    return registry
+
+'''
+    Same as prometheus_client's floatToGoString
+'''
+def format_float(value):
+    value = float(value)
+
+    if value == INF:
+        return '+Inf'
+    elif value == MINUS_INF:
+        return '-Inf'
+    elif value != value:
+        return 'NaN'
+
+    text = repr(value)
+
+    # Go switches to exponents sooner than Python, only positive values matter for le/quantile
+    if value > 0:
+        dot = text.find('.')
+
+        if dot > 6:
+            mantissa = f'{text[0]}.{text[1:dot]}{text[dot + 1:]}'.rstrip('0.')
+            return f'{mantissa}e+0{dot - 1}'
+
+    return text
+
+def escape_help(text):
+    return text.replace('\\', r'\\').replace('\n', r'\n')
+
+def escape_label_value(text):
+    return text.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+def render_header(name, documentation, metric_type):
+    return f'# HELP {name} {escape_help(documentation)}\n# TYPE {name} {metric_type}\n'
+
+'''
+    cache_series=False only caches headers, for one-shot renders where
+    keeping every series around is pure overhead
+'''
+class Encoder:
+    def __init__(self, max_cached=200000, cache_series=True):
+        self.max_cached = max_cached
+        self.cache_series = cache_series
+
+        # (name, type, documentation) -> (header, {openmetrics sample name: suffix})
+        self.headers = {}
+
+        # (sample name, label items) -> ['name{labels} ', last value, last line]
+        self.series = {}
+
+    def family_header(self, metric):
+        key = (metric.name, metric.type, metric.documentation)
+        header = self.headers.get(key)
+
+        if header is not None:
+            return header
+
+        name = metric.name
+        metric_type = metric.type
+
+        # munging from OpenMetrics into Prometheus format
+        if metric_type == 'counter':
+            name = name + '_total'
+        elif metric_type == 'info':
+            name = name + '_info'
+            metric_type = 'gauge'
+        elif metric_type == 'stateset':
+            metric_type = 'gauge'
+        elif metric_type == 'gaugehistogram':
+            metric_type = 'histogram'
+        elif metric_type == 'unknown':
+            metric_type = 'untyped'
+
+        suffixes = {metric.name + suffix: suffix for suffix in OPENMETRICS_SUFFIXES}
+
+        if len(self.headers) >= self.max_cached:
+            self.headers.clear()
+
+        header = self.headers[key] = (render_header(name, metric.documentation, metric_type), suffixes)
+
+        return header
+
+    def add_series(self, name, labels, key):
+        if labels:
+            rendered = ','.join(f'{label}="{escape_label_value(value)}"' for label, value in sorted(labels.items()))
+            prefix = f'{name}{{{rendered}}} '
+        else:
+            prefix = f'{name} '
+
+        if not self.cache_series:
+            return [prefix, None, None]
+
+        if len(self.series) >= self.max_cached:
+            self.series.clear()
+
+        series = self.series[key] = [prefix, None, None]
+
+        return series
+
+    '''
+        Appends the exposition of a single metric family to output, a list of str
+    '''
+    def encode_family(self, metric, output):
+        if not self.cache_series:
+            return self.encode_family_once(metric, output)
+
+        cached_series = self.series
+        append = output.append
+
+        try:
+            header, suffixes = self.family_header(metric)
+            append(header)
+
+            openmetrics_samples = None
+
+            for sample in metric.samples:
+                name = sample.name
+                labels = sample.labels
+                value = sample.value
+                timestamp = sample.timestamp
+
+                # label names are part of the key, a={"x"} and b={"x"} are different series
+                key = (name, tuple(labels.items()))
+                series = cached_series.get(key)
+                if series is None:
+                    series = self.add_series(name, labels, key)
+
+                # unchanged since the last render, zero is left out as 0.0 == -0.0
+                if timestamp is None and value == series[1] and value:
+                    line = series[2]
+                else:
+                    # plain repr() is right unless the value is special or may need an exponent
+                    text = repr(float(value))
+                    if text[-1] in 'fn' or text.find('.') > 6:
+                        text = format_float(value)
+
+                    if timestamp is None:
+                        line = f'{series[0]}{text}\n'
+                        series[1] = value
+                        series[2] = line
+                    else:
+                        # in milliseconds
+                        line = f'{series[0]}{text} {int(float(timestamp) * 1000):d}\n'
+
+                if name in suffixes:
+                    if openmetrics_samples is None:
+                        openmetrics_samples = {}
+
+                    openmetrics_samples.setdefault(suffixes[name], []).append(line)
+                    continue
+
+                append(line)
+        except Exception as exception:
+            exception.args = (exception.args or ('',)) + (metric,)
+            raise
+
+        if openmetrics_samples is None:
+            return
+
+        for suffix, lines in sorted(openmetrics_samples.items()):
+            output.append(render_header(metric.name + suffix, metric.documentation, 'gauge'))
+            output.extend(lines)
+
+    '''
+        encode_family() without keeping series, every line is rendered
+        straight away and nothing is looked up per sample
+    '''
+    def encode_family_once(self, metric, output):
+        append = output.append
+
+        try:
+            header, suffixes = self.family_header(metric)
+            append(header)
+
+            openmetrics_samples = None
+
+            for name, labels, value, timestamp, _ in metric.samples:
+                if labels:
+                    rendered = ','.join([
+                        f'{label}="{escape_label_value(text)}"' if '\\' in text or '\n' in text or '"' in text
+                        else f'{label}="{text}"'
+                        for label, text in sorted(labels.items())
+                    ])
+                    prefix = f'{name}{{{rendered}}} '
+                else:
+                    prefix = f'{name} '
+
+                # format_float() inlined, most values go through here
+                text = repr(float(value))
+                if text[-1] in 'fn':
+                    text = format_float(value)
+                else:
+                    dot = text.find('.')
+                    if dot > 6 and text[0] != '-':
+                        text = f'{text[0]}.{text[1:dot]}{text[dot + 1:]}'.rstrip('0.') + f'e+0{dot - 1}'
+
+                if timestamp is None:
+                    line = f'{prefix}{text}\n'
+                else:
+                    line = f'{prefix}{text} {int(float(timestamp) * 1000):d}\n'
+
+                if name in suffixes:
+                    if openmetrics_samples is None:
+                        openmetrics_samples = {}
+
+                    openmetrics_samples.setdefault(suffixes[name], []).append(line)
+                    continue
+
+                append(line)
+        except Exception as exception:
+            exception.args = (exception.args or ('',)) + (metric,)
+            raise
+
+        if openmetrics_samples is None:
+            return
+
+        for suffix, lines in sorted(openmetrics_samples.items()):
+            output.append(render_header(metric.name + suffix, metric.documentation, 'gauge'))
+            output.extend(lines)
+
+    '''
+        Drop-in for prometheus_client.generate_latest()
+    '''
+    def generate_latest(self, registry=None):
+        registry = default_registry(registry)
+        output = []
+
+        for metric in registry.collect():
+            self.encode_family(metric, output)
+
+        return ''.join(output).encode('utf-8')
+
+    def generate_families(self, registry=None):
+        registry = default_registry(registry)
+        output = []
+
+        for metric in registry.collect():
+            self.encode_family(metric, output)
+
+            yield ''.join(output).encode('utf-8')
+            output.clear()
+
+    '''
+        Writes the exposition of registry to a binary file object
+        family by family, returns the number of bytes written
+    '''
+    def write_families(self, handle, registry=None):
+        written = 0
+
+        for chunk in self.generate_families(registry):
+            handle.write(chunk)
+            written += len(chunk)
+
+        return written
+
+# shared by everything in the process
+default_encoder = Encoder()
+
+def generate_latest(registry=None):
+    return default_encoder.generate_latest(registry)
+
+def generate_families(registry=None):
+    return default_encoder.generate_families(registry)
+
+def write_families(handle, registry=None):
+    return default_encoder.write_families(handle, registry)
@@ -0,0 +1,210 @@
+'''
+    Declarative table-to-metric mapping
+
+    Exporters that read tabular device output (NX-OS style TABLE_x/ROW_x
+    structures and the like) describe the metrics they want per category:
+
+        metrics_wanted = {
+            'category': {
+                'source': ('Gauge', 'converter'),                 # value from row['source']
+                'other':  ('Counter', 'converter', 'row_key'),    # value from row['row_key']
+            }
+        }
+
+        metric_config = {
+            'category': {
+                'labels': ['instance', ...],
+                'helptext': '...',
+                'prefix_with_category_name': False,
+                'gate': ('source', ['source', 'other'])           # optional
+            }
+        }
+
+    compile_plans() turns that into one Plan per category, once. A plan knows
+    the row key, pre-resolved converter and position of every field, so
+    extracting a row is a single tight loop. With a gate, only the listed
+    fields are kept unless the gate field converts to 1 or more (ie. the rest
+    of an interface is only interesting when it is up).
+
+    Metrics not wanted (see compile_plans) are left out of the plans, they
+    are never extracted and have no metric family; a gate still applies when
+    its own field is left out.
+
+    Plans do not touch metric objects, extract() can run anywhere. bind()
+    registers a BoundPlan holding the plan's series in a registry.
+'''
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+'''
+    Rows of TABLE_name/ROW_name, which is a dict instead of a list
+    when there is only one row
+'''
+def table_rows(data, name):
+    rows = data[f"TABLE_{name}"][f"ROW_{name}"]
+
+    if type(rows) is not list:
+        return [rows]
+
+    return rows
+
+class Plan():
+    def __init__(self, category, labels, helptext, fields, gate=None, wanted=None):
+        self.category = category
+        self.labels = labels
+        self.helptext = helptext
+
+        gate_field = None
+        if gate is not None:
+            gate_field = fields[[field[0] for field in fields].index(gate[0])]
+
+        if wanted is not None:
+            fields = [field for field in fields if wanted(field[1])]
+
+        # [(source, metric name, metric type, row key, converter)]
+        self.fields = fields
+        self.extractors = [(index, field[3], field[4]) for index, field in enumerate(fields)]
+
+        self.gate = None
+        if gate is not None:
+            self.gate = (
+                (None, gate_field[3], gate_field[4]),
+                [self.extractors[self.index_of(source)] for source in gate[1] if source in self.sources()]
+            )
+
+    def sources(self):
+        return [field[0] for field in self.fields]
+
+    def index_of(self, source):
+        return self.sources().index(source)
+
+    '''
+        Converted values of a row as [(field index, value)], fields that are
+        missing or do not convert are left out
+    '''
+    def extract(self, row):
+        extractors = self.extractors
+
+        if self.gate is not None:
+            (_, gate_key, gate_converter), always = self.gate
+
+            try:
+                up = gate_converter(row[gate_key]) >= 1
+            except (KeyError, TypeError, ValueError, AttributeError):
+                up = False
+
+            if not up:
+                extractors = always
+
+        values = []
+        append = values.append
+
+        for index, key, converter in extractors:
+            raw = row.get(key)
+            if raw is None:
+                continue
+
+            try:
+                append((index, converter(raw)))
+            except (TypeError, ValueError, AttributeError):
+                pass
+
+        return values
+
+    def bind(self, client, max_series=0):
+        return BoundPlan(self, client, max_series)
+
+'''
+    Series values of a plan, registered as a collector of its metric families
+
+    A label set gets one row of values, indexed like the plan's fields, the
+    first time it is applied. Setting a value is then a list store (or add,
+    for counters) instead of going through a labelled child object per series.
+
+    With max_series, label sets past the first max_series are dropped and
+    counted in dropped, every family of the plan has at most that many series.
+'''
+class BoundPlan():
+    def __init__(self, plan, client, max_series=0):
+        self.plan = plan
+        self.width = len(plan.fields)
+        self.counters = [field[2] == 'Counter' for field in plan.fields]
+        self.max_series = max_series
+        self.dropped = 0
+
+        # labels -> [value or None per field]
+        self.series = {}
+
+        # a plan without fields has no families to collect
+        if plan.fields:
+            client.REGISTRY.register(self)
+
+    def apply(self, labels, values):
+        row = self.series.get(labels)
+
+        if row is None:
+            if self.max_series and len(self.series) >= self.max_series:
+                self.dropped += 1
+                return
+
+            row = self.series[labels] = [None] * self.width
+
+        counters = self.counters
+
+        for index, value in values:
+            if counters[index]:
+                # same rule as Counter.inc()
+                if value < 0:
+                    continue
+
+                if row[index] is not None:
+                    value += row[index]
+
+            row[index] = value
+
+    def describe(self):
+        for _, name, metric_type, _, _ in self.plan.fields:
+            yield self.family(name, metric_type)
+
+    def family(self, name, metric_type):
+        if metric_type == 'Counter':
+            return CounterMetricFamily(name, self.plan.helptext, labels=self.plan.labels)
+
+        return GaugeMetricFamily(name, self.plan.helptext, labels=self.plan.labels)
+
+    def collect(self):
+        for index, (_, name, metric_type, _, _) in enumerate(self.plan.fields):
+            family = self.family(name, metric_type)
+
+            for labels, row in self.series.items():
+                if row[index] is not None:
+                    family.add_metric([str(label) for label in labels], row[index])
+
+            yield family
+
+'''
+    One plan per category, metric names are prefix_source,
+    or prefix_category_source with prefix_with_category_name
+
+    wanted, if given, is called with every metric name and leaves out the
+    metrics it returns False for
+'''
+def compile_plans(metrics_wanted, metric_config, converters, prefix, wanted=None):
+    plans = {}
+
+    for category, metrics in metrics_wanted.items():
+        config = metric_config[category]
+
+        category_prefix = prefix
+        if config.get('prefix_with_category_name', False):
+            category_prefix = f"{prefix}_{category}"
+
+        fields = []
+        for source, definition in metrics.items():
+            metric_type, converter = definition[0], definition[1]
+            row_key = definition[2] if len(definition) > 2 else source
+
+            fields.append((source, f"{category_prefix}_{source}", metric_type, row_key, converters[converter]))
+
+        plans[category] = Plan(category, config['labels'], config['helptext'], fields, config.get('gate'), wanted)
+
+    return plans
@@ -0,0 +1,31 @@
+import re
+
+'''
+    Include/exclude filter on names, ie. of interfaces or metrics
+
+    Patterns are regular expressions matched against the whole name, as in
+    Prometheus relabeling. A name is allowed when it matches one of the
+    include patterns, or there are none, and none of the exclude patterns.
+
+        interfaces = NameFilter(include=['Ethernet1/.*'], exclude=['Ethernet1/4[0-9]'])
+        interfaces.allows('Ethernet1/1')    # True
+'''
+class NameFilter():
+    def __init__(self, include=None, exclude=None):
+        self.include = [re.compile(pattern) for pattern in include or ()]
+        self.exclude = [re.compile(pattern) for pattern in exclude or ()]
+
+    def allows(self, name):
+        if self.include and not any(pattern.fullmatch(name) for pattern in self.include):
+            return False
+
+        return not any(pattern.fullmatch(name) for pattern in self.exclude)
+
+    '''
+        Whether any name can be left out
+    '''
+    def active(self):
+        return bool(self.include or self.exclude)
+
+    def __repr__(self):
+        return f"NameFilter({[pattern.pattern for pattern in self.include]}, {[pattern.pattern for pattern in self.exclude]})"
@@ -0,0 +1,224 @@
+import sys
+import time
+import json
+import base64
+import signal
+import threading
+import traceback
+import http.client
+from urllib.parse import urlparse, quote_plus
+from lib import runner
+from lib import util
+from lib import exporterindex
+from lib import exposition
+
+'''
+    Push daemon
+
+    ./metrics --interval keeps running instead of exiting after one push:
+    every job keeps its exporter instance from one cycle to the next and
+    only gets a fresh registry (self.metrics) per cycle, the exposition is
+    pushed over a keep-alive connection to the Pushgateway that is reopened
+    only when it breaks. Failed pushes are retried with exponential backoff,
+    a failed cycle is logged and the next one runs on schedule.
+
+    Jobs file format (JSON), several jobs are pushed concurrently:
+
+        [
+            {"exporter": "cisco", "arguments": {"--target": "rack-sw01"}, "interval": 60,
+             "grouping": {"instance": "rack-sw01"}},
+            {"exporter": "dummy", "interval": 15}
+        ]
+'''
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+'''
+    Same as prometheus_client's grouping key escaping
+'''
+def escape_grouping_key(name, value):
+    if value == "":
+        return name + "@base64", "="
+    elif '/' in value:
+        return name + "@base64", base64.urlsafe_b64encode(value.encode('utf-8')).decode('utf-8')
+
+    return name, quote_plus(value)
+
+def gateway_path(job, grouping=None):
+    path = '/metrics/{}/{}'.format(*escape_grouping_key('job', job))
+
+    for name, value in sorted((grouping or {}).items()):
+        path += '/{}/{}'.format(*escape_grouping_key(str(name), str(value)))
+
+    return path
+
+'''
+    Pushgateway client holding on to one HTTP/1.1 connection, retries are
+    given up once stopping (a threading.Event) is set
+'''
+class Pushgateway:
+    def __init__(self, address, timeout=10, retries=3, backoff=0.5, stopping=None):
+        url = urlparse(address if '://' in address else f"http://{address}")
+
+        connection_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+
+        self.host = url.netloc
+        self.prefix = url.path.rstrip('/')
+        self.connection_class = connection_class
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.stopping = stopping or threading.Event()
+
+        self.connection = None
+        self.connections_opened = 0
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def request(self, method, path, body):
+        if self.connection is None:
+            self.connection = self.connection_class(self.host, timeout=self.timeout)
+            self.connections_opened += 1
+
+        try:
+            self.connection.request(method, self.prefix + path, body=body, headers={'Content-Type': CONTENT_TYPE})
+            response = self.connection.getresponse()
+            message = response.read()
+        except (OSError, http.client.HTTPException):
+            self.close()
+            raise
+
+        if response.will_close:
+            self.close()
+
+        return response.status, message
+
+    '''
+        PUT replaces every metric of the job and grouping, as push_to_gateway
+        does, POST only the metrics of the same name
+    '''
+    def push(self, job, body, grouping=None, method='PUT'):
+        path = gateway_path(job, grouping)
+        delay = self.backoff
+
+        for attempt in range(self.retries + 1):
+            try:
+                status, message = self.request(method, path, body)
+
+                if status < 300:
+                    return
+
+                error = Exception(f"Pushgateway answered {status}: {message.decode('utf-8', 'replace').strip()}")
+
+                # the body or the path is at fault, sending them again will not help
+                if status < 500:
+                    raise error
+            except (OSError, http.client.HTTPException) as e:
+                error = e
+
+            # no more retries when the daemon is stopping, it would wait for the whole backoff
+            if attempt == self.retries or self.stopping.wait(delay):
+                raise error
+
+            delay *= 2
+
+'''
+    Raises runner.ExporterNotFound right away for an unknown exporter
+'''
+class PushJob:
+    def __init__(self, exporter, arguments, interval, grouping=None):
+        self.exporter = exporter
+        self.arguments = arguments
+        self.interval = interval
+        self.grouping = grouping or {}
+
+        self.exporter_class = runner.load_exporter(exporter, exporterindex.inherited_index())
+        self.instance = None
+
+        # kept across cycles, series that did not change are not rendered again
+        self.encoder = exposition.Encoder()
+
+    '''
+        Runs the exporter into a fresh registry, returns the exposition. The
+        instance is created on the first cycle and reused after that.
+    '''
+    def collect(self, debug):
+        client = util.ScopedClient()
+        token = client.activate()
+
+        try:
+            if self.instance is None:
+                self.instance = runner.run_exporter(self.exporter_class, client, debug, self.arguments)
+            else:
+                self.instance.metrics = client
+                runner.gather(self.instance)
+        finally:
+            client.deactivate(token)
+
+        return self.encoder.generate_latest(client.REGISTRY)
+
+def load_jobs(path, default_interval):
+    with open(path, 'r') as handle:
+        entries = json.load(handle)
+
+    jobs = []
+
+    for entry in entries:
+        pairs = [(str(name), str(value)) for name, value in entry.get('arguments', {}).items()]
+        interval = entry.get('interval', default_interval)
+
+        if interval is None:
+            raise Exception(f"No interval for {entry['exporter']}, set one in the jobs file or with --interval")
+
+        jobs.append(PushJob(
+            entry['exporter'],
+            runner.arguments_from_pairs(pairs),
+            float(interval),
+            entry.get('grouping')
+        ))
+
+    return jobs
+
+'''
+    Collects and pushes every job on its interval, start to start, until
+    SIGTERM or SIGINT. Every job has its own thread and connection, at most
+    concurrency of them collect and push at once.
+'''
+def run_daemon(jobs, address, debug=False, concurrency=4, timeout=10, retries=3):
+    stopping = threading.Event()
+    slots = threading.Semaphore(max(1, concurrency))
+
+    def stop(*_):
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    def job_loop(job):
+        gateway = Pushgateway(address, timeout, retries, stopping=stopping)
+
+        while not stopping.is_set():
+            started_at = time.monotonic()
+
+            with slots:
+                try:
+                    body = job.collect(debug)
+                    gateway.push(job.instance.job_name, body, job.grouping)
+                except (Exception, SystemExit):
+                    print(f"Push of {job.exporter} failed:\n{traceback.format_exc()}", file=sys.stderr)
+
+            stopping.wait(max(0, job.interval - (time.monotonic() - started_at)))
+
+        gateway.close()
+
+    threads = [threading.Thread(target=job_loop, args=(job,), name=f"push-{job.exporter}") for job in jobs]
+
+    for thread in threads:
+        thread.start()
+
+    # the main thread has to stay free to receive the signals
+    while any(thread.is_alive() for thread in threads):
+        for thread in threads:
+            thread.join(timeout=0.5)
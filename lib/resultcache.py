@@ -0,0 +1,224 @@
+import os
+import time
+import json
+import fcntl
+import asyncio
+import hashlib
+import tempfile
+
+'''
+    Scrape result cache shared between all server workers
+
+    Results are kept as files in a directory (tmpfs when available), so every
+    worker process sees the same entries. Concurrent identical scrapes are
+    coalesced: within a worker they wait on the same future, across workers
+    they wait on a per key lock file held by whoever is collecting, and read
+    the result it stored.
+
+    Lock files only exist while someone collects, expired entries are swept
+    once in a while by the workers storing results. Entries are read and
+    written in the default executor, results can be large.
+'''
+def default_directory():
+    base = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+    return os.path.join(base, 'metrics-server-cache')
+
+'''
+    Cache key for an exporter and its query arguments, argument order
+    does not matter
+'''
+def cache_key(exporter, pairs):
+    normalized = '\0'.join(f"{name}={value}" for name, value in sorted(pairs))
+
+    return hashlib.sha1(f"{exporter}\0{normalized}".encode()).hexdigest()
+
+async def in_executor(function, *args):
+    return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+class ResultCache:
+    lock_poll_interval = 0.02
+    lock_poll_interval_max = 0.2
+    sweep_interval = 60
+
+    '''
+        Entries older than max_ttl are swept, it is the longest TTL of any
+        exporter. Without it entries are only removed by clear().
+    '''
+    def __init__(self, directory=None, max_ttl=0):
+        self.directory = directory or default_directory()
+        self.max_ttl = max_ttl
+        self.in_flight = {}
+        self.swept_at = time.monotonic()
+
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, key, suffix):
+        return os.path.join(self.directory, f"{key}.{suffix}")
+
+    '''
+        Drop all entries, done once at server start
+    '''
+    def clear(self):
+        for name in os.listdir(self.directory):
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+    '''
+        Removes entries nobody can use anymore, not only the ones asked for
+        again, every query string has its own
+    '''
+    def sweep(self):
+        expired_before = time.time() - self.max_ttl
+
+        for name in os.listdir(self.directory):
+            if not name.endswith('.entry'):
+                continue
+
+            path = os.path.join(self.directory, name)
+
+            try:
+                if os.stat(path).st_mtime < expired_before:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def get(self, key, ttl):
+        try:
+            with open(self.path(key, 'entry'), 'r') as handle:
+                entry = json.load(handle)
+        except (OSError, ValueError):
+            return None
+
+        if time.time() - entry['stored_at'] > ttl:
+            return None
+
+        return entry['result']
+
+    '''
+        Also records stored_at in result, which together with the key
+        identifies this version of the entry
+    '''
+    def put(self, key, result):
+        result['stored_at'] = time.time()
+
+        fd, temporary = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+
+        with os.fdopen(fd, 'w') as handle:
+            json.dump({'stored_at': result['stored_at'], 'result': result}, handle)
+
+        os.replace(temporary, self.path(key, 'entry'))
+
+    '''
+        Returns (result, status), status is one of hit, miss or coalesced.
+        collect is a coroutine function producing a result, only results
+        with returncode 0 are stored.
+
+        Collection runs as its own task, a cancelled caller only stops
+        waiting for it, the others still get the result.
+    '''
+    async def fetch(self, key, ttl, collect):
+        result = await in_executor(self.get, key, ttl)
+        if result is not None:
+            return result, 'hit'
+
+        # someone in this worker is already collecting
+        if key in self.in_flight:
+            result, _ = await asyncio.shield(self.in_flight[key])
+
+            return result, 'coalesced'
+
+        task = asyncio.ensure_future(self.fetch_locked(key, ttl, collect))
+        task.add_done_callback(lambda _: self.collected(key, task))
+        self.in_flight[key] = task
+
+        return await asyncio.shield(task)
+
+    def collected(self, key, task):
+        del self.in_flight[key]
+
+        if self.max_ttl > 0 and time.monotonic() - self.swept_at >= self.sweep_interval:
+            self.swept_at = time.monotonic()
+            asyncio.get_running_loop().run_in_executor(None, self.sweep)
+
+        # mark as retrieved, there may be nobody waiting on it anymore
+        if not task.cancelled():
+            task.exception()
+
+    async def fetch_locked(self, key, ttl, collect):
+        lock, waited = await self.acquire_lock(key)
+
+        try:
+            # whoever held the lock may have just stored a result
+            if waited:
+                result = await in_executor(self.get, key, ttl)
+                if result is not None:
+                    return result, 'coalesced'
+
+            result = await collect()
+
+            if result['returncode'] == 0:
+                await in_executor(self.put, key, result)
+
+            return result, 'miss'
+        finally:
+            # removed while still held, whoever waits on it notices and opens the next one
+            try:
+                os.remove(self.path(key, 'lock'))
+            except OSError:
+                pass
+
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+
+    '''
+        Returns the open and locked lock file of key, and whether it had to
+        wait for it. A lock file that was removed by its holder while this
+        waited on it is not the lock anymore, the current one is tried next.
+    '''
+    async def acquire_lock(self, key):
+        path = self.path(key, 'lock')
+        waited = False
+
+        while True:
+            lock = open(path, 'w')
+
+            try:
+                waited = await self.flock(lock) or waited
+
+                try:
+                    current = os.stat(path)
+                except FileNotFoundError:
+                    current = None
+
+                opened = os.fstat(lock.fileno())
+
+                if current is not None and (current.st_dev, current.st_ino) == (opened.st_dev, opened.st_ino):
+                    return lock, waited
+            except BaseException:
+                lock.close()
+                raise
+
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+            waited = True
+
+    '''
+        Non-blocking flock with polling, so the event loop is never blocked
+        while another worker is collecting. Returns True if it had to wait.
+    '''
+    async def flock(self, lock):
+        interval = self.lock_poll_interval
+        waited = False
+
+        while True:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return waited
+            except BlockingIOError:
+                waited = True
+
+            await asyncio.sleep(interval)
+            interval = min(interval * 2, self.lock_poll_interval_max)
@@ -0,0 +1,282 @@
+import sys
+import time
+import argparse
+from exporters import exporter
+from lib import exporterindex
+
+'''
+    Shared between ./metrics and the exporter worker pool, everything needed
+    to turn an exporter name and its arguments into collected metrics
+
+    Imported by the web server and by ./metrics before it knows whether the
+    exporter exists, anything heavy (prometheus_client, asyncio) is imported
+    where it is used
+'''
+class ExporterNotFound(Exception):
+    pass
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog='Metrics Exporter Wrapper',
+        description='Wraps exporters, or something',
+        add_help=False,
+        # an abbreviated exporter argument (ie. --target) is not one of ours
+        allow_abbrev=False
+    )
+
+    parser.add_argument('--exporter', metavar='NAME', help='Run metrics by exporter name', default=None)
+    parser.add_argument('--pushgateway-address', metavar='HOST:PORT', help='Pushgateway address in host:port format', default=None)
+    parser.add_argument('--output-filename', metavar='file', help='If provided, will print metrics to this file', default=None)
+    parser.add_argument('--output-fd', metavar='fd', help='If provided, will write metrics to this inherited file descriptor', default=None, type=int)
+    parser.add_argument('--no-print', help='Do not print metrics to stdout', action='store_true', default=False)
+    parser.add_argument('--debug', help='Turn on debug mode, will be passed to exporter as a constructor argument', default=False, action='store_true')
+    parser.add_argument('--targets', metavar='TARGET,...', help='Run the exporter for each of these targets and merge the results', default=None)
+    parser.add_argument('--fan-out', metavar='N', help='Most targets collected at once with --targets', default=8, type=int)
+    parser.add_argument('--interval', metavar='SECONDS', help='Keep running and push to the Pushgateway every SECONDS', default=None, type=float)
+    parser.add_argument('--push-jobs', metavar='FILE', help='Push the exporter runs listed in this JSON file, with --interval', default=None)
+    parser.add_argument('--push-concurrency', metavar='N', help='Most jobs collected and pushed at once with --interval', default=4, type=int)
+    parser.add_argument('--push-timeout', metavar='SECONDS', help='Pushgateway request timeout', default=10, type=float)
+    parser.add_argument('--push-retries', metavar='N', help='Retries of a failed push with --interval, with exponential backoff', default=3, type=int)
+    parser.add_argument('--help', help='Print help', default=False, action='store_true')
+
+    return parser
+
+'''
+    Arguments of build_parser() for whoever starts ./metrics, not for a
+    scrape: where output goes and the push daemon. The web server turns
+    query strings into arguments and refuses these.
+'''
+CLI_ONLY_ARGUMENTS = (
+    '--exporter', '--pushgateway-address', '--output-filename', '--output-fd', '--no-print',
+    '--interval', '--push-jobs', '--push-concurrency', '--push-timeout', '--push-retries'
+)
+
+'''
+    Exporters live either in exporters/NAME/NAME.py or exporters/NAME.py
+'''
+def find_exporter_module(name):
+    try:
+        return __import__(f"exporters.{name}.{name}", fromlist=[None])
+    except ModuleNotFoundError:
+        try:
+            return __import__(f"exporters.{name}", fromlist=[None])
+        except ModuleNotFoundError:
+            raise ExporterNotFound(name)
+
+'''
+    Exporter arguments from (name, value) pairs, ie. query string parameters,
+    a pair with an empty value is a flag
+'''
+def arguments_from_pairs(pairs):
+    arguments = []
+
+    for name, value in pairs:
+        arguments.append(name)
+
+        if value != "":
+            arguments.append(value)
+
+    return arguments
+
+def find_exporter_class(exporter_module):
+    for property_name in dir(exporter_module):
+        ref = getattr(exporter_module, property_name)
+
+        if not isinstance(ref, type):
+            continue
+
+        if issubclass(ref, exporter.Exporter):
+            return ref
+
+    raise Exception("No class inheriting Exporter found in module.")
+
+'''
+    With an index (see lib/exporterindex) the exporter's module and class are
+    known up front and names missing from it are not looked for
+'''
+def load_exporter(name, index=None):
+    if index is None:
+        return find_exporter_class(find_exporter_module(name))
+
+    if name not in index:
+        raise ExporterNotFound(name)
+
+    return exporterindex.load_class(index[name])
+
+'''
+    Instantiate the exporter and run its entry point, returns the instance
+'''
+def run_exporter(exporter_class, client, debug, exporter_arguments):
+    instance = exporter_class(client, debug, *exporter_arguments)
+
+    gather(instance)
+
+    return instance
+
+'''
+    Run the entry point of an exporter instance, again for a long-lived one
+'''
+def gather(instance):
+    import inspect
+
+    # handle entrypoint as coroutine
+    if inspect.iscoroutinefunction(instance.gather_metrics):
+        import asyncio
+        asyncio.run(instance.gather_metrics())
+    else:
+        instance.gather_metrics()
+
+'''
+    Exporters whose gather_metrics is a coroutine, these can be run by
+    run_in_loop
+'''
+def is_async(exporter_class):
+    import inspect
+
+    return inspect.iscoroutinefunction(exporter_class.gather_metrics)
+
+'''
+    Runs an async exporter in the running event loop, against a registry of
+    its own, and returns a result like a ./metrics run's. Nothing separates
+    the exporter from the loop: it has to be trusted not to block it.
+
+    The deadline is cooperative, gather_metrics is cancelled at its next
+    await once timeout seconds have passed; the instance's deadline tells
+    the loop time it has until then. Only argument errors end up in stderr,
+    anything else the exporter prints goes to the output of the process.
+'''
+async def run_in_loop(exporter_class, arguments, timeout):
+    import io
+    import asyncio
+    import traceback
+    import contextlib
+    from lib import util
+
+    result = {
+        'returncode': 0,
+        'stdout': '',
+        'stderr': '',
+        'metrics': ''
+    }
+
+    # a SystemExit leaving a task is raised out of the event loop, stopping it
+    async def gather_guarded(instance):
+        try:
+            await instance.gather_metrics()
+        except SystemExit as e:
+            return e.code
+
+        return None
+
+    parsed_arguments, exporter_arguments = build_parser().parse_known_args(arguments)
+    client = util.ScopedClient()
+    token = client.activate()
+    stderr = io.StringIO()
+
+    try:
+        # parse_args() runs without awaiting, nothing else writes to stderr meanwhile
+        with contextlib.redirect_stderr(stderr):
+            instance = exporter_class(client, parsed_arguments.debug, *exporter_arguments)
+
+        instance.deadline = asyncio.get_running_loop().time() + timeout
+        code = await asyncio.wait_for(gather_guarded(instance), timeout=timeout)
+    except asyncio.TimeoutError:
+        return dict(result, returncode=-9, stderr='Killed: Timed out')
+    except SystemExit as e:
+        code = e.code
+    except Exception:
+        return dict(result, returncode=1, stderr=traceback.format_exc())
+    finally:
+        client.deactivate(token)
+
+    if isinstance(code, int) and code != 0:
+        return dict(result, returncode=code, stderr=stderr.getvalue())
+    elif code is not None and not isinstance(code, int):
+        return dict(result, returncode=1, stderr=f"{stderr.getvalue()}{code}\n")
+
+    result['metrics'] = client.generate_latest().decode('UTF-8')
+
+    return result
+
+'''
+    Runs the exporter once per target, at most fan_out at a time, each run
+    against its own registry so a failing target cannot affect the others.
+    Returns a collector of the merged results, see TargetsCollector.
+
+    When sharded (see lib/sharding) only the targets of this instance are run.
+'''
+def run_targets(exporter_class, debug, exporter_arguments, targets, fan_out):
+    import traceback
+    import concurrent.futures
+    from lib import util
+    from lib import sharding
+
+    if exporter_class.target_argument is None:
+        raise Exception(f"{exporter_class.__name__} does not take a target argument, it cannot be run for --targets")
+
+    targets = sharding.own_targets(targets)
+
+    def run_target(target):
+        client = util.ScopedClient()
+        token = client.activate()
+        started_at = time.perf_counter()
+
+        try:
+            run_exporter(exporter_class, client, debug, list(exporter_arguments) + [exporter_class.target_argument, target])
+            registry = client.REGISTRY
+        except (Exception, SystemExit):
+            print(f"Target {target} failed:\n{traceback.format_exc()}", file=sys.stderr)
+            registry = None
+        finally:
+            client.deactivate(token)
+
+        return target, registry, time.perf_counter() - started_at
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, fan_out)) as executor:
+        return TargetsCollector(list(executor.map(run_target, targets)))
+
+def split_targets(targets):
+    return [target.strip() for target in targets.split(',') if target.strip()]
+
+'''
+    Merged exposition of per target runs: families of the same name are
+    joined, every sample is labelled with its target (unless the exporter
+    already does that), and up/scrape_duration_seconds tell per target
+    whether and how fast it was collected
+'''
+class TargetsCollector:
+    def __init__(self, results):
+        # [(target, registry or None if it failed, seconds)]
+        self.results = results
+
+    def collect(self):
+        import prometheus_client
+
+        families = {}
+
+        for target, registry, _ in self.results:
+            if registry is None:
+                continue
+
+            for family in registry.collect():
+                merged = families.get(family.name)
+
+                if merged is None:
+                    merged = families[family.name] = prometheus_client.Metric(family.name, family.documentation, family.type, family.unit)
+
+                for sample in family.samples:
+                    if 'target' not in sample.labels:
+                        sample = sample._replace(labels={'target': target, **sample.labels})
+
+                    merged.samples.append(sample)
+
+        up = prometheus_client.core.GaugeMetricFamily('up', 'Whether the target was collected successfully', labels=['target'])
+        duration = prometheus_client.core.GaugeMetricFamily('scrape_duration_seconds', 'Time taken to collect the target', labels=['target'])
+
+        for target, registry, seconds in self.results:
+            up.add_metric([target], 0 if registry is None else 1)
+            duration.add_metric([target], seconds)
+
+        yield from families.values()
+        yield up
+        yield duration
@@ -0,0 +1,201 @@
+import os
+import json
+import time
+import random
+import asyncio
+import tempfile
+import traceback
+from lib import runner
+from lib.resultcache import cache_key
+
+'''
+    Scheduled background collection
+
+    Configured exporter and argument sets are collected on their own interval
+    by a single server worker, independently of scrapes. The latest successful
+    exposition of every job is kept as a snapshot in a directory (tmpfs when
+    available) that all server workers read from, so a scrape of a scheduled
+    job is answered from memory instead of waiting for the exporter.
+
+    A failed run leaves the previous snapshot in place, snapshots carry their
+    collection time so staleness shows up in the served metrics.
+
+    Schedule file format (JSON):
+
+        [
+            {"exporter": "cisco", "arguments": {"--target": "rack-sw01"}, "interval": 60},
+            {"exporter": "dummy", "interval": 15, "timeout": 10}
+        ]
+'''
+def default_directory():
+    base = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+    return os.path.join(base, 'metrics-server-snapshots')
+
+class Job:
+    def __init__(self, exporter, pairs, interval, timeout=None):
+        self.exporter = exporter
+        self.pairs = pairs
+        self.arguments = runner.arguments_from_pairs(pairs)
+        self.interval = interval
+        self.timeout = timeout
+
+        # same key a scrape with these query arguments maps to
+        self.key = cache_key(exporter, pairs)
+
+def load_jobs(path):
+    with open(path, 'r') as handle:
+        entries = json.load(handle)
+
+    jobs = []
+
+    for entry in entries:
+        pairs = [(str(name), str(value)) for name, value in entry.get('arguments', {}).items()]
+        timeout = entry.get('timeout')
+
+        jobs.append(Job(
+            entry['exporter'],
+            pairs,
+            float(entry['interval']),
+            None if timeout is None else float(timeout)
+        ))
+
+    return jobs
+
+'''
+    Latest exposition per job, written by the scheduling worker and read by
+    all of them. Readers keep the last snapshot they loaded and only read the
+    file again once its modification time changes.
+'''
+class SnapshotStore:
+    def __init__(self, directory=None):
+        self.directory = directory or default_directory()
+        self.loaded = {}
+
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.snapshot")
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+    def put(self, key, metrics, collected_at):
+        fd, temporary = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+
+        with os.fdopen(fd, 'w') as handle:
+            json.dump({'collected_at': collected_at, 'metrics': metrics}, handle)
+
+        os.replace(temporary, self.path(key))
+
+    '''
+        Returns {'collected_at', 'metrics'} or None if there is no snapshot yet
+    '''
+    def get(self, key):
+        try:
+            modified = os.stat(self.path(key)).st_mtime_ns
+        except OSError:
+            return None
+
+        loaded = self.loaded.get(key)
+        if loaded is not None and loaded[0] == modified:
+            return loaded[1]
+
+        try:
+            with open(self.path(key), 'r') as handle:
+                snapshot = json.load(handle)
+        except (OSError, ValueError):
+            return None
+
+        self.loaded[key] = (modified, snapshot)
+
+        return snapshot
+
+'''
+    Collection time and age series appended to a snapshot's exposition
+'''
+def staleness_series(snapshot, now=None):
+    if now is None:
+        now = time.time()
+
+    collected_at = snapshot['collected_at']
+
+    return "".join([
+        "# HELP snapshot_collection_timestamp_seconds Unix time the served metrics were collected at\n",
+        "# TYPE snapshot_collection_timestamp_seconds gauge\n",
+        f"snapshot_collection_timestamp_seconds {collected_at!r}\n",
+        "# HELP snapshot_age_seconds Seconds since the served metrics were collected\n",
+        "# TYPE snapshot_age_seconds gauge\n",
+        f"snapshot_age_seconds {max(0.0, now - collected_at)!r}\n"
+    ])
+
+'''
+    Runs every job on its interval, start to start, each interval stretched
+    or shortened by up to jitter (a fraction of it) so jobs drift apart
+    instead of firing together. At most concurrency jobs run at once.
+
+    run is a coroutine function (exporter, arguments, timeout) returning a
+    result like the web server's exporter runs, on_result is called with the
+    job, the result and the run time after every run.
+'''
+class Scheduler:
+    def __init__(self, jobs, store, run, concurrency, jitter, on_result=None):
+        self.jobs = jobs
+        self.store = store
+        self.run = run
+        self.slots = asyncio.Semaphore(concurrency)
+        self.jitter = jitter
+        self.on_result = on_result
+        self.tasks = []
+
+    def start(self):
+        self.tasks = [asyncio.ensure_future(self.job_loop(job)) for job in self.jobs]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def collect(self, job):
+        async with self.slots:
+            collected_at = time.time()
+            started_at = time.perf_counter()
+
+            try:
+                result = await self.run(job.exporter, job.arguments, job.timeout)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                result = {'returncode': 1, 'stdout': '', 'stderr': traceback.format_exc(), 'metrics': ''}
+
+            time_taken = time.perf_counter() - started_at
+
+        if result['returncode'] == 0:
+            self.store.put(job.key, result['metrics'], collected_at)
+
+        if self.on_result is not None:
+            self.on_result(job, result, time_taken)
+
+        return result
+
+    def delay(self, interval):
+        return interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+    async def job_loop(self, job):
+        loop = asyncio.get_running_loop()
+
+        # first runs are only spread by the jitter, snapshots should exist soon after start
+        await asyncio.sleep(random.uniform(0, job.interval * self.jitter))
+
+        while True:
+            started_at = loop.time()
+
+            await self.collect(job)
+
+            await asyncio.sleep(max(0, self.delay(job.interval) - (loop.time() - started_at)))
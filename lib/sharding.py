@@ -0,0 +1,101 @@
+import os
+import bisect
+import hashlib
+from lib import config
+
+'''
+    Sharding of targets over several metrics server instances
+
+    Every instance of a sharded deployment is configured with the same
+    members and its own place among them, either
+
+        SHARD_MEMBERS=http://metrics-0:8080,http://metrics-1:8080
+        SHARD_SELF=http://metrics-1:8080
+
+    or, when instances do not know each other's addresses,
+
+        SHARD_COUNT=2
+        SHARD_INDEX=1
+
+    Targets are assigned to members by consistent hashing: every member owns
+    many points on a ring, a target belongs to the member owning the first
+    point at or after the target's hash. Adding a member takes over about
+    1/N of the targets, every other target stays where it was.
+
+    Targets are hashed by name alone, a target is owned by the same instance
+    for every exporter. The same settings reach ./metrics runs through the
+    environment, so exporters collecting all of their targets at once and
+    --targets only collect the share of their instance.
+'''
+REPLICAS = 160
+
+def hash_point(value):
+    return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+class HashRing:
+    def __init__(self, members, replicas=REPLICAS):
+        points = sorted(
+            (hash_point(f"{member}#{replica}"), member)
+            for member in members
+            for replica in range(replicas)
+        )
+
+        self.points = [point for point, _ in points]
+        self.members = [member for _, member in points]
+
+    def owner(self, key):
+        position = bisect.bisect_left(self.points, hash_point(key))
+
+        return self.members[position % len(self.points)]
+
+'''
+    Place of this instance in a sharded deployment, own is its member
+'''
+class Shard:
+    def __init__(self, members, own):
+        if own not in members:
+            raise ValueError(f"Shard {own!r} is not one of the members {members}")
+
+        self.members = members
+        self.own = own
+        self.ring = HashRing(members)
+
+    def owner(self, target):
+        return self.ring.owner(target)
+
+    def owns(self, target):
+        return self.owner(target) == self.own
+
+    def select(self, targets):
+        return [target for target in targets if self.owns(target)]
+
+    '''
+        Members are addresses (SHARD_MEMBERS) that requests for targets of
+        other members can be redirected to, rather than numbers (SHARD_COUNT)
+    '''
+    def addressable(self):
+        return all(member.startswith(('http://', 'https://')) for member in self.members)
+
+'''
+    Shard configured in the environment, None when not sharded
+'''
+def from_environment():
+    members = config.env_list('SHARD_MEMBERS')
+
+    if members:
+        return Shard(members, os.getenv('SHARD_SELF', ''))
+
+    count = config.env_int('SHARD_COUNT', 0)
+
+    if count > 1:
+        return Shard([str(index) for index in range(count)], str(config.env_int('SHARD_INDEX', 0)))
+
+    return None
+
+'''
+    Targets of this instance, all of them when not sharded
+'''
+def own_targets(targets):
+    shard = from_environment()
+
+    return list(targets) if shard is None else shard.select(targets)
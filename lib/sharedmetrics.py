@@ -0,0 +1,323 @@
+import os
+import mmap
+import time
+import bisect
+import struct
+import tempfile
+from lib import exposition
+
+'''
+    Server metrics kept in a shared memory file (tmpfs when available)
+
+    Every server worker owns one slot of the file and is the only process ever
+    writing to it, so updates need neither locks nor IPC. A slot holds a table
+    of series keys (metric name and rendered label set) and a parallel array of
+    values. A new series is published by writing its key and value first and
+    bumping the slot's series count last, readers only look at series below
+    the count they read.
+
+    /metrics sums every series over all slots in a single pass.
+
+    Series that do not fit (slot full, key too long) are counted in a series
+    every slot reserves up front, DROPPED_SERIES.
+
+    A histogram is kept as a series per bucket (observations in that bucket
+    alone, made cumulative when rendered), a _sum and a _count series, so an
+    observation is three additions whatever the number of buckets.
+
+    Layout:
+        header:  magic, slot count, series per slot, started at
+        slot:    series count, keys, values
+'''
+MAGIC = 0x6d747273
+HEADER = struct.Struct('IIId')
+SLOT_HEADER = struct.Struct('I')
+DROPPED_SERIES = 'server_metrics_dropped_series_total'
+KEY_SIZE = 256
+KEY_LENGTH = struct.Struct('H')
+
+def default_path():
+    base = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+    return os.path.join(base, f"metrics-server-{os.getpid()}.metrics")
+
+'''
+    Slot of the current server worker, taken from the Sanic worker name
+    (ie. Sanic-Server-1-0), which is stable across worker restarts
+'''
+def worker_slot(slots):
+    name = os.getenv('SANIC_WORKER_NAME', '')
+    parts = name.split('-')
+
+    try:
+        return int(parts[2]) % slots
+    except (IndexError, ValueError):
+        return 0
+
+def join_labels(labels, label):
+    return f"{labels},{label}" if labels else label
+
+def format_value(value):
+    if value.is_integer():
+        return str(int(value))
+
+    return repr(value)
+
+class SharedMetrics:
+    def __init__(self, path, slots=None, capacity=None):
+        self.path = path
+        self.families = {}
+
+        # name -> (bucket bounds, rendered le values ending with +Inf)
+        self.histograms = {}
+
+        # (name, labels) -> 'name{labels} ', series keys never change
+        self.prefixes = {}
+
+        if slots is not None:
+            self.create(slots, capacity)
+
+        self.handle = open(path, 'r+b')
+        self.buffer = mmap.mmap(self.handle.fileno(), 0)
+
+        magic, self.slots, self.capacity, self.started_at = HEADER.unpack_from(self.buffer, 0)
+        if magic != MAGIC:
+            raise Exception(f"{path} is not a metrics store")
+
+        self.slot_size = SLOT_HEADER.size + self.capacity * KEY_SIZE + self.capacity * 8
+
+        # writer state for the slot this process owns
+        self.slot = None
+        self.index = {}
+
+        # (name, labels) -> positions of the buckets, _sum and _count
+        self.histogram_index = {}
+
+        # reader state, keys are immutable once published
+        self.known_keys = [[] for _ in range(self.slots)]
+
+    '''
+        Create the backing file, done once in the main process
+    '''
+    def create(self, slots, capacity):
+        slot_size = SLOT_HEADER.size + capacity * KEY_SIZE + capacity * 8
+
+        with open(self.path, 'wb') as handle:
+            handle.truncate(HEADER.size + slots * slot_size)
+            handle.write(HEADER.pack(MAGIC, slots, capacity, time.time()))
+
+    def close(self):
+        if self.slot is not None:
+            self.slot_values.release()
+
+        try:
+            self.buffer.close()
+        except BufferError:
+            pass
+
+        self.handle.close()
+
+    def unlink(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    '''
+        Families are declared by every process, so all of them know
+        their headers and the order to render in
+    '''
+    def declare(self, name, help_text, metric_type):
+        self.families[name] = exposition.render_header(name, help_text, metric_type)
+
+    def declare_histogram(self, name, help_text, buckets):
+        self.declare(name, help_text, 'histogram')
+
+        bounds = tuple(sorted(buckets))
+        self.histograms[name] = (bounds, [exposition.format_float(bound) for bound in bounds] + ['+Inf'])
+
+    def slot_offset(self, slot):
+        return HEADER.size + slot * self.slot_size
+
+    def keys_offset(self, slot):
+        return self.slot_offset(slot) + SLOT_HEADER.size
+
+    def values(self, slot):
+        start = self.keys_offset(slot) + self.capacity * KEY_SIZE
+
+        return memoryview(self.buffer)[start:start + self.capacity * 8].cast('d')
+
+    def read_key(self, slot, position):
+        offset = self.keys_offset(slot) + position * KEY_SIZE
+        (length,) = KEY_LENGTH.unpack_from(self.buffer, offset)
+
+        name, _, labels = self.buffer[offset + KEY_LENGTH.size:offset + KEY_LENGTH.size + length].decode().partition('\0')
+
+        return name, labels
+
+    '''
+        Take ownership of a slot, picking up series a previous process
+        in the same slot left behind
+    '''
+    def attach(self, slot):
+        self.slot = slot
+        self.slot_values = self.values(slot)
+        self.index = {}
+        self.histogram_index = {}
+
+        (count,) = SLOT_HEADER.unpack_from(self.buffer, self.slot_offset(slot))
+        for position in range(count):
+            self.index[self.read_key(slot, position)] = position
+
+        self.dropped_position = self.position(DROPPED_SERIES, '')
+
+    def add_series(self, key):
+        offset = self.slot_offset(self.slot)
+        (count,) = SLOT_HEADER.unpack_from(self.buffer, offset)
+        encoded = '\0'.join(key).encode()
+
+        if count >= self.capacity or len(encoded) > KEY_SIZE - KEY_LENGTH.size:
+            self.slot_values[self.dropped_position] += 1
+            return None
+
+        key_offset = self.keys_offset(self.slot) + count * KEY_SIZE
+        KEY_LENGTH.pack_into(self.buffer, key_offset, len(encoded))
+        self.buffer[key_offset + KEY_LENGTH.size:key_offset + KEY_LENGTH.size + len(encoded)] = encoded
+        self.slot_values[count] = 0.0
+
+        # publish
+        SLOT_HEADER.pack_into(self.buffer, offset, count + 1)
+        self.index[key] = count
+
+        return count
+
+    def position(self, name, labels):
+        key = (name, labels)
+        position = self.index.get(key)
+
+        if position is None:
+            position = self.add_series(key)
+
+        return position
+
+    def inc(self, name, labels='', value=1):
+        position = self.position(name, labels)
+
+        if position is not None:
+            self.slot_values[position] += value
+
+    def set(self, name, labels='', value=0):
+        position = self.position(name, labels)
+
+        if position is not None:
+            self.slot_values[position] = value
+
+    def histogram_positions(self, name, labels):
+        key = (name, labels)
+        positions = self.histogram_index.get(key)
+
+        if positions is None:
+            _, les = self.histograms[name]
+
+            positions = [self.position(f"{name}_bucket", join_labels(labels, f'le="{le}"')) for le in les]
+            positions.append(self.position(f"{name}_sum", labels))
+            positions.append(self.position(f"{name}_count", labels))
+
+            self.histogram_index[key] = positions
+
+        return positions
+
+    def observe(self, name, labels, value):
+        bounds, _ = self.histograms[name]
+        positions = self.histogram_positions(name, labels)
+        values = self.slot_values
+
+        bucket = positions[bisect.bisect_left(bounds, value)]
+        if bucket is not None:
+            values[bucket] += 1
+
+        if positions[-2] is not None:
+            values[positions[-2]] += value
+
+        if positions[-1] is not None:
+            values[positions[-1]] += 1
+
+    '''
+        Sum of every series over all slots
+    '''
+    def collect(self):
+        totals = {}
+
+        for slot in range(self.slots):
+            (count,) = SLOT_HEADER.unpack_from(self.buffer, self.slot_offset(slot))
+
+            known_keys = self.known_keys[slot]
+            for position in range(len(known_keys), count):
+                known_keys.append(self.read_key(slot, position))
+
+            values = self.values(slot)
+            for position in range(count):
+                key = known_keys[position]
+                totals[key] = totals.get(key, 0.0) + values[position]
+
+            values.release()
+
+        return totals
+
+    '''
+        Exposition of all declared families, computed maps family names to
+        [(labels, value)] for values that are not stored but worked out at
+        render time
+    '''
+    def render(self, computed={}):
+        totals = self.collect()
+
+        series = {name: [] for name in self.families}
+        for (name, labels), value in totals.items():
+            if name in series:
+                series[name].append((labels, value))
+            elif name.endswith('_count') and name[:-6] in self.histograms:
+                series[name[:-6]].append((labels, value))
+
+        series.update(computed)
+
+        blob = []
+
+        for name, header in self.families.items():
+            blob.append(header)
+
+            if name in self.histograms:
+                self.render_histogram(name, series[name], totals, blob)
+                continue
+
+            for labels, value in series[name]:
+                blob.append(f"{self.prefix(name, labels)}{format_value(value)}\n")
+
+        blob.append("\n")
+
+        return "".join(blob)
+
+    def render_histogram(self, name, counts, totals, blob):
+        _, les = self.histograms[name]
+        bucket_name = f"{name}_bucket"
+
+        for labels, count in counts:
+            cumulative = 0.0
+
+            for le in les:
+                bucket_labels = join_labels(labels, f'le="{le}"')
+                cumulative += totals.get((bucket_name, bucket_labels), 0.0)
+
+                blob.append(f"{self.prefix(bucket_name, bucket_labels)}{format_value(cumulative)}\n")
+
+            blob.append(f"{self.prefix(name + '_sum', labels)}{format_value(totals.get((name + '_sum', labels), 0.0))}\n")
+            blob.append(f"{self.prefix(name + '_count', labels)}{format_value(count)}\n")
+
+    def prefix(self, name, labels):
+        key = (name, labels)
+        prefix = self.prefixes.get(key)
+
+        if prefix is None:
+            prefix = self.prefixes[key] = f"{name}{{{labels}}} " if labels else f"{name} "
+
+        return prefix
@@ -0,0 +1,123 @@
+import re
+import json
+import codecs
+
+'''
+    Incremental parser of the rows of a NX-OS style table
+
+    Output like {"TABLE_name": {"ROW_name": [{...}, {...}]}} is fed in chunks
+    as it comes off a pipe, every row comes out as soon as its closing brace
+    has been fed. Only the row being received is held, not the output, so
+    memory stays bounded by the size of a row whatever the size of the table.
+
+    Anything outside of ROW_name is skipped without being parsed, a table with
+    a single row (an object instead of a list) is handled as in
+    mapping.table_rows.
+
+        rows = TableRows('interface')
+
+        for chunk in chunks:
+            for row in rows.feed(chunk):
+                ...
+
+        rows.close()
+'''
+whitespace = re.compile(r'[\s,]*')
+
+SEEK = 0      # looking for "ROW_name"
+VALUE = 1     # after the key, up to its list or object
+ROWS = 2      # inside the list of rows
+SINGLE = 3    # a single row object
+
+class TableRows():
+    def __init__(self, name):
+        self.name = name
+        self.key = f'"ROW_{name}"'
+        self.decoder = json.JSONDecoder()
+        self.text = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.state = SEEK
+        self.found = False
+        self.rows = 0
+
+    '''
+        Rows completed by chunk (bytes), as dicts
+    '''
+    def feed(self, chunk):
+        buffer = self.buffer + self.text.decode(chunk)
+        position = 0
+        rows = []
+
+        while True:
+            if self.state == SEEK:
+                found = buffer.find(self.key, position)
+
+                if found < 0:
+                    # the key could be cut in two by the chunk boundary
+                    position = max(position, len(buffer) - len(self.key) + 1)
+                    break
+
+                position = found + len(self.key)
+                self.state = VALUE
+                self.found = True
+                continue
+
+            position = whitespace.match(buffer, position).end() if self.state == ROWS \
+                else self.skip_colon(buffer, position)
+
+            if position >= len(buffer):
+                break
+
+            if self.state == VALUE:
+                if buffer[position] == '[':
+                    position += 1
+                    self.state = ROWS
+                else:
+                    self.state = SINGLE
+                continue
+
+            if self.state == ROWS and buffer[position] == ']':
+                position += 1
+                self.state = SEEK
+                continue
+
+            try:
+                row, position = self.decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # the row is not complete yet
+                break
+
+            rows.append(row)
+            self.rows += 1
+
+            if self.state == SINGLE:
+                self.state = SEEK
+
+        self.buffer = buffer[position:]
+
+        return rows
+
+    '''
+        Skips whitespace and the colon between the key and its value
+    '''
+    def skip_colon(self, buffer, position):
+        length = len(buffer)
+
+        while position < length and buffer[position] in ' \t\r\n:':
+            position += 1
+
+        return position
+
+    '''
+        Raises ValueError when the output ended inside of the table or had no
+        such table, like mapping.table_rows raises KeyError
+    '''
+    def close(self):
+        self.feed(b'')
+        self.text.decode(b'', final=True)
+
+        if not self.found:
+            raise ValueError(f"No ROW_{self.name} in output")
+
+        if self.state != SEEK:
+            raise ValueError(f"Output ended inside of ROW_{self.name}, after {self.rows} rows")
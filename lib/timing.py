@@ -1,38 +1,209 @@
-import time 
+import time
+import random
+import weakref
+import bisect
 import functools
 import contextlib
-import prometheus_client as metrics
+from prometheus_client.core import SummaryMetricFamily, HistogramMetricFamily
 from lib import util
+from lib import config
+from lib import exposition
+
+'''
+    Execution time of exporter functions, as the execution_seconds metric
+    labelled by Class.function
+
+    Instrumented functions can run thousands of times per scrape (ie. once per
+    interface row), so timing has to stay cheap: the series of a function is
+    resolved once per registry and reused after that, and observations are
+    plain additions to it, turned into a summary (or histogram) only when the
+    registry is collected, see ExecutionTimes.
+
+    Configured from the environment, so the web server's settings reach
+    ./metrics and the worker pool:
+
+        TIMING              0 turns timing off, observed functions only
+                            check the setting before calling through
+        TIMING_SAMPLE_RATE  share of calls that are timed, each of them counts
+                            for 1 / rate calls, so counts and sums stay right
+                            on average
+        TIMING_BUCKETS      histogram buckets in seconds (ie. 0.001,0.01,0.1,1)
+                            instead of a summary
+
+    or at runtime with configure().
+'''
+enabled = config.env_int('TIMING', 1) > 0
+sample_rate = config.env_float('TIMING_SAMPLE_RATE', 1.0)
+buckets = tuple(float(bucket) for bucket in config.env_list('TIMING_BUCKETS'))
+
+# registry -> {label: series}, entries go away with their registry
+series_cache = weakref.WeakKeyDictionary()
+
+# bumped by configure(), observed functions drop the series they kept from before
+generation = 0
+
+'''
+    Changes the settings taken from the environment. Also call it without
+    arguments after unregistering execution_seconds from a registry that
+    stays in use, so that no function keeps observing into the old series.
+'''
+def configure(enable=None, rate=None, histogram_buckets=None):
+    global enabled, sample_rate, buckets, generation
+
+    if enable is not None:
+        enabled = enable
+    if rate is not None:
+        sample_rate = rate
+    if histogram_buckets is not None:
+        buckets = tuple(histogram_buckets)
+
+    # series of the old buckets are of no use anymore
+    series_cache.clear()
+    generation += 1
+
+'''
+    Collector of execution_seconds
+
+    Every series is a list of [count, sum, observations per bucket...], added
+    to without locking. Threads timing the same function against the same
+    registry at the same moment can lose an observation, exporters collect
+    in a single thread or into a registry per thread (see --targets).
+'''
+class ExecutionTimes:
+    def __init__(self, buckets=()):
+        self.buckets = tuple(sorted(buckets))
+        self.series = {}
+
+    def series_for(self, label):
+        series = self.series.get(label)
+
+        if series is None:
+            # the last bucket is +Inf
+            series = self.series[label] = [0.0, 0.0] + [0.0] * (len(self.buckets) + 1 if self.buckets else 0)
+
+        return series
+
+    def family(self):
+        if self.buckets:
+            return HistogramMetricFamily('execution_seconds', "Histogram of time spent executing something", labels=['function'])
+
+        return SummaryMetricFamily('execution_seconds', "Summary of time spent executing something", labels=['function'])
+
+    def describe(self):
+        yield self.family()
+
+    def collect(self):
+        family = self.family()
+
+        for label, series in self.series.items():
+            if not self.buckets:
+                family.add_metric([label], series[0], series[1])
+                continue
+
+            cumulative = 0.0
+            histogram = []
+
+            for bound, observations in zip(self.buckets + (float('inf'),), series[2:]):
+                cumulative += observations
+                histogram.append((exposition.format_float(bound), cumulative))
+
+            family.add_metric([label], histogram, series[1])
+
+        yield family
 
 def _get_or_create_metric():
     metric = util.get_metric("execution_seconds")
     if metric is None:
-        metric = metrics.Summary("execution_seconds", "Summary of time spent executing something", ['function'])
+        metric = ExecutionTimes(buckets)
+        util.current_registry.get().register(metric)
 
     return metric
 
-def observed(method):
-    summary = _get_or_create_metric()
+'''
+    Series of a Class.function label in registry
+'''
+def series_for(registry, label):
+    registry_series = series_cache.get(registry)
+
+    if registry_series is None:
+        registry_series = series_cache[registry] = {}
+
+    series = registry_series.get(label)
+
+    if series is None:
+        collector = _get_or_create_metric()
+        series = registry_series[label] = (collector.buckets, collector.series_for(label))
+
+    return series
+
+'''
+    Observation of a call, standing for 1 / sample_rate calls when sampling
+'''
+def observe(series, amount):
+    bucket_bounds, values = series
+    weight = 1 / sample_rate if sample_rate < 1 else 1
+
+    values[0] += weight
+    values[1] += amount * weight
+
+    if bucket_bounds:
+        values[2 + bisect.bisect_left(bucket_bounds, amount)] += weight
+
+'''
+    Times calls of method, whether timing is on is looked up at call time,
+    so configure() also applies to methods decorated before
+
+    The function label is Class.method of the instance, class_name replaces
+    the class, ie. to keep the label of a method moved to another class:
+
+        @timing.observed(class_name='CiscoExporter')
+'''
+def observed(method=None, class_name=None):
+    if method is None:
+        return functools.partial(observed, class_name=class_name)
+
+    label = method.__name__
+
+    # (generation, registry, class, series) of the last call, a function is
+    # mostly called for the same class and registry many times in a row
+    last = [(None, None, None, None)]
 
     @functools.wraps(method)
     def wrapper(self, *args, **kwargs):
+        if not enabled or (sample_rate < 1 and random.random() >= sample_rate):
+            return method(self, *args, **kwargs)
+
         start = time.perf_counter()
         result = method(self, *args, **kwargs)
-        summary.labels(f"{self.__class__.__name__}.{method.__name__}").observe(round(time.perf_counter() - start, 3))
+        elapsed = time.perf_counter() - start
+
+        # the current registry can change between jobs
+        registry = util.current_registry.get()
+        cached_generation, cached_registry, cached_class, series = last[0]
+
+        if cached_registry is not registry or cached_class is not self.__class__ or cached_generation != generation:
+            series = series_for(registry, f"{class_name or self.__class__.__name__}.{label}")
+            last[0] = (generation, registry, self.__class__, series)
+
+        observe(series, elapsed)
 
         return result
     return wrapper
 
 class Observe():
     def __init__(self, class_ref, name):
-        self.name = f"{class_ref.__class__.__name__}.{name}"
-        self.summary = _get_or_create_metric()
-    
+        self.timed = enabled and (sample_rate >= 1 or random.random() < sample_rate)
+
+        if self.timed:
+            self.series = series_for(util.current_registry.get(), f"{class_ref.__class__.__name__}.{name}")
+
     def __enter__(self):
-        self.start = time.perf_counter()
+        if self.timed:
+            self.start = time.perf_counter()
 
     def __exit__(self, *args):
-        self.summary.labels(self.name).observe(round(time.perf_counter() - self.start, 3))
+        if self.timed:
+            observe(self.series, time.perf_counter() - self.start)
 
 '''
     Generic timer, no metrics
@@ -40,7 +211,7 @@ class Observe():
 class Timer():
     def __init__(self):
         pass
-    
+
     def __enter__(self):
         self.start = time.perf_counter()
 
@@ -51,4 +222,4 @@ class Timer():
         self.value = round(self.end - self.start, 3)
 
     def __repr__(self):
-        return self.value
\ No newline at end of file
+        return self.value
@@ -1,10 +1,67 @@
+import contextvars
 import prometheus_client as metrics
+from lib import exposition
+
+'''
+    Registry that metric helpers (get_metric, timing) work against.
+
+    Defaults to the global prometheus_client.REGISTRY, which is what a one-shot
+    ./metrics run uses. Long-lived processes that run many collections set this
+    to a fresh CollectorRegistry per job, see ScopedClient.
+'''
+current_registry = contextvars.ContextVar('current_registry', default=metrics.REGISTRY)
 
 '''
     Helper to get a reference to a metric by name
 '''
 def get_metric(metric_name):
-    if metric_name not in metrics.REGISTRY._names_to_collectors:
+    registry = current_registry.get()
+
+    if metric_name not in registry._names_to_collectors:
         return None
 
-    return metrics.REGISTRY._names_to_collectors[metric_name]
\ No newline at end of file
+    return registry._names_to_collectors[metric_name]
+
+'''
+    Stand-in for the prometheus_client module that is handed to exporters as
+    self.metrics, with every metric constructor bound to its own registry.
+
+    Anything that is not a metric constructor is looked up on prometheus_client
+    itself, so exporters can keep using self.metrics like the module.
+'''
+class ScopedClient:
+    metric_types = ('Counter', 'Gauge', 'Summary', 'Histogram', 'Info', 'Enum')
+
+    def __init__(self, registry=None):
+        if registry is None:
+            registry = metrics.CollectorRegistry(auto_describe=True)
+
+        self.REGISTRY = registry
+
+        for name in self.metric_types:
+            setattr(self, name, self._bind(getattr(metrics, name)))
+
+    def _bind(self, metric_class):
+        registry = self.REGISTRY
+
+        def constructor(*args, **kwargs):
+            kwargs.setdefault('registry', registry)
+            return metric_class(*args, **kwargs)
+
+        return constructor
+
+    def __getattr__(self, name):
+        return getattr(metrics, name)
+
+    def generate_latest(self, registry=None):
+        return exposition.generate_latest(registry or self.REGISTRY)
+
+    '''
+        Make this client's registry the current one for get_metric/timing,
+        returns a token for deactivate()
+    '''
+    def activate(self):
+        return current_registry.set(self.REGISTRY)
+
+    def deactivate(self, token):
+        current_registry.reset(token)
@@ -0,0 +1,330 @@
+import os
+
+# same environment the ./metrics wrapper sets up, must happen before prometheus_client is imported
+os.environ['PROMETHEUS_DISABLE_CREATED_SERIES'] = 'True'
+os.environ.pop('PROMETHEUS_MULTIPROC_DIR', None)
+
+import sys # noqa
+import asyncio # noqa
+import traceback # noqa
+import contextlib # noqa
+import subprocess # noqa
+import multiprocessing # noqa
+from multiprocessing.connection import Connection # noqa
+
+root_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+'''
+    Pool of long-lived exporter worker processes
+
+    Each worker is started once with its exporter module already imported and
+    then receives scrape jobs (exporter arguments) over a pipe. Every job runs
+    against a fresh CollectorRegistry, so jobs are as isolated from each other
+    as separate ./metrics runs are, without paying for a new interpreter.
+
+    Workers are recycled after max_jobs jobs or once their RSS grows past
+    max_rss_mb, and killed and replaced when a job runs past its timeout.
+'''
+
+def resident_memory_mb():
+    try:
+        with open('/proc/self/statm', 'r') as handle:
+            pages = int(handle.read().split()[1])
+
+        return pages * os.sysconf('SC_PAGE_SIZE') / 1048576
+    except: # noqa
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+'''
+    Runs a single job inside a worker, result mirrors what the web server
+    collects from a ./metrics sub process, stdout and stderr bounded as the
+    web server bounds them, output_limits being their limits in bytes
+'''
+def run_job(exporter_class, arguments, output_limits):
+    from lib import runner
+    from lib import util
+    from lib import exposition
+    from lib.boundedoutput import BoundedOutput, BoundedWriter
+
+    result = {
+        'returncode': 0,
+        'stdout': '',
+        'stderr': '',
+        'metrics': ''
+    }
+
+    stdout = BoundedOutput(output_limits[0])
+    stderr = BoundedOutput(output_limits[1], tail=True)
+
+    with contextlib.redirect_stdout(BoundedWriter(stdout)), contextlib.redirect_stderr(BoundedWriter(stderr)):
+        try:
+            parsed_arguments, exporter_arguments = runner.build_parser().parse_known_args(arguments)
+
+            if parsed_arguments.help:
+                exporter_arguments = list(exporter_arguments) + ["-h"]
+
+            if parsed_arguments.targets is not None:
+                collector = runner.run_targets(
+                    exporter_class, parsed_arguments.debug, exporter_arguments,
+                    runner.split_targets(parsed_arguments.targets), parsed_arguments.fan_out
+                )
+                result['metrics'] = exposition.generate_latest(collector).decode('UTF-8')
+            else:
+                client = util.ScopedClient()
+                token = client.activate()
+
+                try:
+                    runner.run_exporter(exporter_class, client, parsed_arguments.debug, exporter_arguments)
+                    result['metrics'] = client.generate_latest().decode('UTF-8')
+                finally:
+                    client.deactivate(token)
+        except SystemExit as e:
+            if isinstance(e.code, int):
+                result['returncode'] = e.code
+            elif e.code is not None:
+                print(e.code, file=sys.stderr)
+                result['returncode'] = 1
+        except: # noqa
+            traceback.print_exc()
+            result['returncode'] = 1
+
+    result['stdout'] = stdout.text()
+    result['stderr'] = stderr.text()
+    result['outputs'] = {
+        'stdout': (stdout.total, stdout.truncated),
+        'stderr': (stderr.total, stderr.truncated),
+        'metrics': (len(result['metrics']), False)
+    }
+
+    return result
+
+'''
+    Entry point of a worker process
+'''
+def worker_main(conn, exporter_name, max_jobs, max_rss_mb):
+    from lib import runner
+    from lib import exporterindex
+
+    exporter_class = None
+    load_error = None
+
+    try:
+        exporter_class = runner.load_exporter(exporter_name, exporterindex.inherited_index())
+    except runner.ExporterNotFound:
+        load_error = {'returncode': 255, 'stdout': "Exporter not found.\n", 'stderr': '', 'metrics': ''}
+    except: # noqa
+        load_error = {'returncode': 1, 'stdout': '', 'stderr': traceback.format_exc(), 'metrics': ''}
+
+    jobs = 0
+
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+
+        if job is None:
+            break
+
+        if load_error is not None:
+            result = dict(load_error)
+        else:
+            result = run_job(exporter_class, job['arguments'], job['output_limits'])
+
+        jobs += 1
+        result['recycle'] = jobs >= max_jobs or resident_memory_mb() > max_rss_mb
+
+        conn.send(result)
+
+        if result['recycle']:
+            break
+
+    conn.close()
+
+'''
+    Parent side handle of a single worker process
+
+    Workers are plain sub processes talking over an inherited pipe rather than
+    multiprocessing children, server workers are daemonic and may not have those
+'''
+class PoolWorker:
+    def __init__(self, exporter_name, max_jobs, max_rss_mb, output_limits):
+        self.output_limits = output_limits
+        self.conn, child_conn = multiprocessing.Pipe()
+
+        try:
+            self.process = subprocess.Popen(
+                [
+                    sys.executable, '-m', 'lib.workerpool',
+                    str(child_conn.fileno()), exporter_name, str(max_jobs), str(max_rss_mb)
+                ],
+                pass_fds=[child_conn.fileno()],
+                stdin=subprocess.DEVNULL,
+                cwd=root_directory
+            )
+        finally:
+            child_conn.close()
+
+    def alive(self):
+        return self.process.poll() is None
+
+    async def run(self, arguments):
+        loop = asyncio.get_running_loop()
+        readable = loop.create_future()
+        fileno = self.conn.fileno()
+
+        loop.add_reader(fileno, lambda: readable.done() or readable.set_result(True))
+
+        try:
+            self.conn.send({'arguments': arguments, 'output_limits': self.output_limits})
+            await readable
+        finally:
+            loop.remove_reader(fileno)
+
+        # the result is on its way once readable, but can be larger than the pipe
+        return await loop.run_in_executor(None, self.conn.recv)
+
+    '''
+        Kills the worker, it is reaped off the event loop when there is one
+    '''
+    def kill(self):
+        try:
+            self.process.kill()
+        except OSError:
+            pass
+
+        self.close()
+
+    '''
+        Asks the worker to exit, it is killed when it has not after a second
+    '''
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except: # noqa
+            pass
+
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+        try:
+            asyncio.get_running_loop().run_in_executor(None, self.reap)
+        except RuntimeError:
+            self.reap()
+
+    def reap(self):
+        try:
+            self.process.wait(1)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+'''
+    Workers of a single exporter
+'''
+class ExporterPool:
+    def __init__(self, exporter_name, size, max_jobs, max_rss_mb, output_limits):
+        self.exporter_name = exporter_name
+        self.size = size
+        self.max_jobs = max_jobs
+        self.max_rss_mb = max_rss_mb
+        self.output_limits = output_limits
+
+        self.slots = asyncio.Semaphore(size)
+        self.idle = []
+
+    async def acquire(self):
+        await self.slots.acquire()
+
+        while self.idle:
+            worker = self.idle.pop()
+
+            if worker.alive():
+                return worker
+
+            worker.kill()
+
+        try:
+            return PoolWorker(self.exporter_name, self.max_jobs, self.max_rss_mb, self.output_limits)
+        except: # noqa
+            self.slots.release()
+            raise
+
+    def release(self, worker):
+        self.idle.append(worker)
+        self.slots.release()
+
+    def discard(self, worker):
+        worker.kill()
+        self.slots.release()
+
+    async def run(self, arguments, timeout):
+        worker = await self.acquire()
+
+        try:
+            result = await asyncio.wait_for(worker.run(arguments), timeout=timeout)
+        except asyncio.TimeoutError:
+            # hung or just slow, either way the worker is replaced
+            self.discard(worker)
+
+            return {'returncode': -9, 'stdout': '', 'stderr': 'Killed: Timed out', 'metrics': ''}
+        except (EOFError, OSError):
+            self.discard(worker)
+
+            return {'returncode': 1, 'stdout': '', 'stderr': 'Exporter worker died', 'metrics': ''}
+        except BaseException:
+            # ie. cancelled when the client went away, the worker may still be busy with the job
+            self.discard(worker)
+            raise
+
+        if result.pop('recycle'):
+            self.discard(worker)
+        else:
+            self.release(worker)
+
+        return result
+
+    def close(self):
+        while self.idle:
+            self.idle.pop().stop()
+
+'''
+    Worker pools of all exporters, created lazily on first use
+
+    output_limits are the bytes of stdout and stderr of a job kept, the
+    start of stdout and the end of stderr
+'''
+class WorkerPool:
+    def __init__(self, default_size, sizes, max_jobs, max_rss_mb, output_limits=(65536, 65536)):
+        self.default_size = default_size
+        self.sizes = sizes
+        self.max_jobs = max_jobs
+        self.max_rss_mb = max_rss_mb
+        self.output_limits = output_limits
+
+        self.pools = {}
+
+    def enabled_for(self, exporter_name):
+        return self.sizes.get(exporter_name, self.default_size) > 0
+
+    async def run(self, exporter_name, arguments, timeout):
+        if exporter_name not in self.pools:
+            self.pools[exporter_name] = ExporterPool(
+                exporter_name,
+                self.sizes.get(exporter_name, self.default_size),
+                self.max_jobs,
+                self.max_rss_mb,
+                self.output_limits
+            )
+
+        return await self.pools[exporter_name].run(arguments, timeout)
+
+    def close(self):
+        for pool in self.pools.values():
+            pool.close()
+
+if __name__ == '__main__':
+    worker_main(Connection(int(sys.argv[1])), sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))
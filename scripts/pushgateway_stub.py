@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+'''
+    Local stand-in for a Pushgateway, for trying out and testing pushes
+
+    Accepts PUT, POST and DELETE on /metrics/job/NAME{/LABEL/VALUE}, keeps
+    the last body pushed per path and serves them all on GET /metrics. Keeps
+    connections alive like the real one does. GET /status returns counts of
+    connections and requests as JSON, to check that pushes share connections.
+
+    --fail-every N answers every Nth push with 503, to exercise retries.
+
+    usage: python3 scripts/pushgateway_stub.py [--port 9091] [--fail-every N] [--quiet]
+'''
+import json
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class State:
+    def __init__(self, fail_every):
+        self.lock = threading.Lock()
+        self.fail_every = fail_every
+        self.groups = {}
+        self.connections = 0
+        self.pushes = 0
+        self.failed = 0
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+
+        with self.server.state.lock:
+            self.server.state.connections += 1
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+    def answer(self, status, body=b'', content_type='text/plain; charset=utf-8'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        state = self.server.state
+
+        with state.lock:
+            if self.path == '/status':
+                body = json.dumps({
+                    'connections': state.connections,
+                    'pushes': state.pushes,
+                    'failed': state.failed,
+                    'groups': sorted(state.groups)
+                }).encode('utf-8')
+
+                return self.answer(200, body, 'application/json')
+
+            if self.path == '/metrics':
+                return self.answer(200, b''.join(state.groups.values()))
+
+        self.answer(404, b'not found\n')
+
+    def push(self):
+        state = self.server.state
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        if not self.path.startswith('/metrics/job/'):
+            return self.answer(400, b'push to /metrics/job/NAME\n')
+
+        with state.lock:
+            state.pushes += 1
+
+            if state.fail_every and state.pushes % state.fail_every == 0:
+                state.failed += 1
+                return self.answer(503, b'failing on purpose\n')
+
+            if self.command == 'DELETE':
+                state.groups.pop(self.path, None)
+            elif self.command == 'POST' and self.path in state.groups:
+                state.groups[self.path] += body
+            else:
+                state.groups[self.path] = body
+
+        self.answer(200 if self.command == 'DELETE' else 202)
+
+    do_PUT = push
+    do_POST = push
+    do_DELETE = push
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9091)
+    parser.add_argument('--fail-every', metavar='N', type=int, default=0, help='answer every Nth push with 503')
+    parser.add_argument('--quiet', action='store_true', help='do not log requests')
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    server.state = State(args.fail_every)
+    server.quiet = args.quiet
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
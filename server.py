@@ -1,47 +1,315 @@
-from sanic import Sanic, text, json
+from sanic import Sanic, text, json, raw, redirect
 import os
+import sys
 import time
 import asyncio
 import re
-from multiprocessing import Manager
-from aiopipe import aiopipe
+from lib import config
+from lib import runner
+from lib import exporterindex
+from lib import sharding
+from lib.workerpool import WorkerPool
+from lib.resultcache import ResultCache, cache_key
+from lib import sharedmetrics
+from lib.sharedmetrics import SharedMetrics, DROPPED_SERIES
+from lib import scheduler
+from lib.scheduler import Scheduler, SnapshotStore
+from lib.compression import Compressor
+from lib.admission import Admission, Rejected
+from lib.boundedoutput import BoundedOutput
 
 class Environment:
     WORKERS = int(os.getenv('WORKERS', 2))
     PORT = int(os.getenv('PORT', 80))
+    EXPORTER_TIMEOUT = config.env_float('EXPORTER_TIMEOUT', 59)
+    EXPORTER_TIMEOUTS = config.env_per_exporter('EXPORTER_TIMEOUTS', float)
+    EXPORTER_CONCURRENCY = config.env_int('EXPORTER_CONCURRENCY', 0)
+    EXPORTER_CONCURRENCIES = config.env_per_exporter('EXPORTER_CONCURRENCIES')
+    EXPORTER_QUEUE_DEPTH = config.env_int('EXPORTER_QUEUE_DEPTH', 16)
+    EXPORTER_QUEUE_DEPTHS = config.env_per_exporter('EXPORTER_QUEUE_DEPTHS')
+    RETRY_AFTER = config.env_int('RETRY_AFTER', 5)
+    POOL_SIZE = config.env_int('POOL_SIZE', 0)
+    POOL_SIZES = config.env_per_exporter('POOL_SIZES')
+    POOL_MAX_JOBS = config.env_int('POOL_MAX_JOBS', 100)
+    POOL_MAX_RSS_MB = config.env_int('POOL_MAX_RSS_MB', 512)
+    INPROCESS_EXPORTERS = config.env_list('INPROCESS_EXPORTERS')
+    CACHE_DIR = os.getenv('CACHE_DIR', None)
+    CACHE_TTL = config.env_float('CACHE_TTL', 0)
+    CACHE_TTLS = config.env_per_exporter('CACHE_TTLS', float)
+    METRICS_STORE_PATH = os.getenv('METRICS_STORE_PATH', None)
+    EXPORTER_INDEX = os.getenv('EXPORTER_INDEX', None)
+    METRICS_CAPACITY = config.env_int('METRICS_CAPACITY', 4096)
+    LATENCY_BUCKETS = tuple(float(bucket) for bucket in config.env_list('LATENCY_BUCKETS')) \
+        or (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    STREAMING = config.env_int('STREAMING', 0) > 0
+    STREAM_CHUNK_SIZE = config.env_int('STREAM_CHUNK_SIZE', 65536)
+    EXPORTER_STDOUT_KB = config.env_int('EXPORTER_STDOUT_KB', 64)
+    EXPORTER_STDERR_KB = config.env_int('EXPORTER_STDERR_KB', 64)
+    EXPORTER_OUTPUT_LIMIT_MB = config.env_int('EXPORTER_OUTPUT_LIMIT_MB', 64)
+    EXPORTER_METRICS_LIMIT_MB = config.env_int('EXPORTER_METRICS_LIMIT_MB', 512)
+    SCHEDULE_FILE = os.getenv('SCHEDULE_FILE', None)
+    SCHEDULE_CONCURRENCY = config.env_int('SCHEDULE_CONCURRENCY', 4)
+    SCHEDULE_JITTER = config.env_float('SCHEDULE_JITTER', 0.1)
+    SNAPSHOT_DIR = os.getenv('SNAPSHOT_DIR', None)
+    COMPRESSION = config.env_int('COMPRESSION', 0) > 0
+    COMPRESSION_LEVEL = config.env_int('COMPRESSION_LEVEL', 6)
+    COMPRESSION_ZSTD_LEVEL = config.env_int('COMPRESSION_ZSTD_LEVEL', 3)
+    COMPRESSION_MIN_BYTES = config.env_int('COMPRESSION_MIN_BYTES', 1024)
+    COMPRESSION_OFFLOAD_BYTES = config.env_int('COMPRESSION_OFFLOAD_BYTES', 65536)
+    COMPRESSION_CACHE_MB = config.env_int('COMPRESSION_CACHE_MB', 64)
 
 app = Sanic("metrics-exporter-webserver")
 app.config.FALLBACK_ERROR_FORMAT = "json"
 
-def increment_metric(ctx, metric, labels, value=1):
-    if labels not in ctx.metrics[metric]['metrics'].keys():
-        ctx.metrics[metric]['metrics'][labels] = value
-        return
-
-    ctx.metrics[metric]['metrics'][labels] += value
-
 '''
     Metrics bootstrap
+
+    Server metrics live in a shared memory store created by the main process,
+    each server worker writes to its own slot of it
 '''
-def fill_metric(mp_manager, ctx, metric_name, metric_help, metric_type, add_values=True):
-    ctx.metrics[metric_name] = mp_manager.dict()
-    ctx.metrics[metric_name]['help'] = metric_help
-    ctx.metrics[metric_name]['type'] = metric_type
-    if add_values:
-        ctx.metrics[metric_name]['metrics'] = mp_manager.dict()
+# histograms of the phases of exporter requests, server_exporter_PHASE_seconds
+PHASES = {
+    'queue_wait': "Time exporter runs waited for admission",
+    'spawn': "Time spent starting ./metrics processes",
+    'runtime': "Time from start of the exporter until its first metrics",
+    'read': "Time from the first metrics of the exporter until all output was read",
+    'encode': "Time spent encoding and compressing exporter responses",
+    'request': "Time spent handling exporter requests"
+}
+
+def declare_metrics(store):
+    store.declare('server_requests_total', "Total requests made to the server", "counter")
+    store.declare('server_exporter_requests_total', "Total requests made to exporters", "counter")
+    store.declare('server_exporter_seconds_total', "Total time spent handling exporters", "counter")
+    store.declare('server_exporter_cache_total', "Exporter result cache lookups, by result", "counter")
+    store.declare('server_exporter_admitted_total', "Exporter runs admitted", "counter")
+    store.declare('server_exporter_queue_seconds_total', "Total time exporter runs waited for admission", "counter")
+    store.declare('server_exporter_rejected_total', "Exporter runs rejected, by reason", "counter")
+    store.declare('server_exporter_in_flight', "Exporter runs in progress", "gauge")
+    store.declare('server_exporter_queued', "Exporter runs waiting for admission", "gauge")
+    store.declare('server_shard_requests_total', "Scrapes of targets owned by other shards, by result", "counter")
+    store.declare('server_scheduled_runs_total', "Scheduled exporter runs, by result", "counter")
+    store.declare('server_scheduled_seconds_total', "Total time spent in scheduled exporter runs", "counter")
+    store.declare('server_uptime_seconds_total', "Server uptime, in seconds", "counter")
+    store.declare('server_exporter_timeouts_total', "Exporter runs that timed out", "counter")
+    store.declare('server_exporter_kills_total', "Exporter processes killed, by reason", "counter")
+    store.declare('server_exporter_exit_codes_total', "Exporter runs, by exit code", "counter")
+    store.declare('server_exporter_response_bytes_total', "Total bytes of exporter responses", "counter")
+    store.declare('server_exporter_output_bytes_total', "Total bytes exporters wrote, by stream", "counter")
+    store.declare('server_exporter_output_truncated_total', "Exporter runs with output cut short, by stream", "counter")
+
+    for phase, help_text in PHASES.items():
+        store.declare_histogram(f'server_exporter_{phase}_seconds', help_text, Environment.LATENCY_BUCKETS)
+    store.declare(DROPPED_SERIES, "Server metric series that did not fit the metrics store", "counter")
 
 @app.main_process_start
 async def add_metrics(app, _):
-    mp_manager = Manager()
+    path = Environment.METRICS_STORE_PATH or sharedmetrics.default_path()
+
+    SharedMetrics(path, Environment.WORKERS, Environment.METRICS_CAPACITY).close()
+
+    # inherited by server workers
+    os.environ['METRICS_STORE_PATH'] = path
+
+    # entries from a previous run are of no use
+    ResultCache(Environment.CACHE_DIR).clear()
+
+    if Environment.SCHEDULE_FILE:
+        SnapshotStore(Environment.SNAPSHOT_DIR).clear()
+
+@app.main_process_stop
+async def remove_metrics(app, _):
+    SharedMetrics(os.environ['METRICS_STORE_PATH']).unlink()
+
+'''
+    Exporter index, built once by the main process and read by server
+    workers, worker pools and ./metrics runs through the environment
+'''
+@app.main_process_start
+async def build_exporter_index(app, _):
+    index, problems = exporterindex.discover()
+
+    for name, problem in problems.items():
+        print(f"Exporter {name} left out: {problem}", file=sys.stderr)
+
+    path = Environment.EXPORTER_INDEX or exporterindex.default_path()
+    exporterindex.write_index(path, index)
+
+    # inherited by server workers and everything they start
+    os.environ['EXPORTER_INDEX'] = path
+
+@app.main_process_stop
+async def remove_exporter_index(app, _):
+    try:
+        os.remove(os.environ['EXPORTER_INDEX'])
+    except OSError:
+        pass
+
+@app.before_server_start
+async def load_exporter_index(app, _):
+    app.ctx.exporters = exporterindex.read_index(os.environ['EXPORTER_INDEX'])
+
+    # exporter name -> class of those run in process, None for those that cannot be
+    app.ctx.inprocess = {}
+
+'''
+    Sharding, see lib/sharding, exporters run by the server read the same
+    settings from the environment
+'''
+@app.before_server_start
+async def load_shard(app, _):
+    app.ctx.shard = sharding.from_environment()
+
+'''
+    Member owning the target of a scrape with these query arguments, None if
+    it is this instance, the server is not sharded or there is no target
+'''
+def foreign_owner(app, exporter, pairs):
+    if app.ctx.shard is None or exporter not in app.ctx.exporters:
+        return None
+
+    argument = app.ctx.exporters[exporter].get('target_argument')
+
+    for name, value in pairs:
+        if argument is not None and name == argument and not app.ctx.shard.owns(value):
+            return app.ctx.shard.owner(value)
 
-    app.shared_ctx.metrics = mp_manager.dict()
-    fill_metric(mp_manager, app.shared_ctx, 'server_requests_total', "Total requests made to the server", "counter")
-    fill_metric(mp_manager, app.shared_ctx, 'server_exporter_requests_total', "Total requests made to exporters", "counter")
-    fill_metric(mp_manager, app.shared_ctx, 'server_exporter_seconds_total', "Total time spent handling exporters", "counter")
-    fill_metric(mp_manager, app.shared_ctx, 'server_uptime_seconds_total', "Server uptime, in seconds", "counter", False)
+    return None
 
-    app.shared_ctx.metrics['server_uptime_seconds_total']['started'] = time.time()
-    app.shared_ctx.metrics['server_uptime_seconds_total']['value'] = 0
+'''
+    Scrape of a target of another shard: redirected to it when members are
+    addresses, otherwise answered empty, so every instance can be scraped for
+    every target and only the owner returns its metrics
+'''
+def shard_response(request, exporter, owner):
+    if request.app.ctx.shard.addressable():
+        request.app.ctx.metrics.inc('server_shard_requests_total', f'exporter="{exporter}",result="redirected"')
+
+        location = owner.rstrip('/') + request.path
+        if request.query_string:
+            location += '?' + request.query_string
+
+        return redirect(location, status=307)
+
+    request.app.ctx.metrics.inc('server_shard_requests_total', f'exporter="{exporter}",result="skipped"')
+
+    return text('', headers={'X-Shard-Owner': owner})
+
+@app.before_server_start
+async def attach_metrics(app, _):
+    app.ctx.metrics = SharedMetrics(os.environ['METRICS_STORE_PATH'])
+    app.ctx.slot = sharedmetrics.worker_slot(app.ctx.metrics.slots)
+    app.ctx.metrics.attach(app.ctx.slot)
+
+    declare_metrics(app.ctx.metrics)
+
+'''
+    Exporter worker pool, one per server worker, and the scrape result cache
+'''
+@app.before_server_start
+async def start_worker_pool(app, _):
+    app.ctx.pool = WorkerPool(
+        Environment.POOL_SIZE,
+        Environment.POOL_SIZES,
+        Environment.POOL_MAX_JOBS,
+        Environment.POOL_MAX_RSS_MB,
+        (Environment.EXPORTER_STDOUT_KB * 1024, Environment.EXPORTER_STDERR_KB * 1024)
+    )
+
+    app.ctx.cache = ResultCache(
+        Environment.CACHE_DIR,
+        max([Environment.CACHE_TTL, *Environment.CACHE_TTLS.values()])
+    )
+
+@app.after_server_stop
+async def stop_worker_pool(app, _):
+    app.ctx.pool.close()
+
+'''
+    Admission control of exporter runs, per server worker
+'''
+@app.before_server_start
+async def start_admission(app, _):
+    def on_change(exporter, gate):
+        app.ctx.metrics.set('server_exporter_in_flight', f'exporter="{exporter}"', gate.in_flight)
+        app.ctx.metrics.set('server_exporter_queued', f'exporter="{exporter}"', gate.queued)
+
+    app.ctx.admission = Admission(
+        Environment.EXPORTER_CONCURRENCY,
+        Environment.EXPORTER_CONCURRENCIES,
+        Environment.EXPORTER_QUEUE_DEPTH,
+        Environment.EXPORTER_QUEUE_DEPTHS,
+        on_change
+    )
+
+@app.exception(Rejected)
+async def exporter_rejected(request, exception):
+    if exception.reason == 'queue_full':
+        message = "Too many exporter runs queued, try again later\n"
+    else:
+        message = "Timed out waiting for an exporter run slot, try again later\n"
+
+    return text(message, status=503, headers={'Retry-After': str(Environment.RETRY_AFTER)})
+
+'''
+    Response compression, compressed bodies of cached results and snapshots
+    are kept per server worker
+'''
+@app.before_server_start
+async def start_compression(app, _):
+    app.ctx.compressor = Compressor(
+        Environment.COMPRESSION_LEVEL,
+        Environment.COMPRESSION_ZSTD_LEVEL,
+        Environment.COMPRESSION_MIN_BYTES,
+        Environment.COMPRESSION_OFFLOAD_BYTES,
+        Environment.COMPRESSION_CACHE_MB * 1048576
+    )
+
+'''
+    Scheduled collection
+
+    Every server worker knows the schedule and serves its snapshots, only the
+    worker in the first metrics slot runs it
+'''
+@app.before_server_start
+async def load_schedule(app, _):
+    app.ctx.schedule = {}
+    app.ctx.scheduler = None
+
+    if not Environment.SCHEDULE_FILE:
+        return
+
+    jobs = scheduler.load_jobs(Environment.SCHEDULE_FILE)
+
+    # targets of other shards are collected by them, scrapes of these are redirected or skipped
+    app.ctx.schedule = {job.key: job for job in jobs if foreign_owner(app, job.exporter, job.pairs) is None}
+    app.ctx.snapshots = SnapshotStore(Environment.SNAPSHOT_DIR)
+
+@app.after_server_start
+async def start_scheduler(app, _):
+    if not app.ctx.schedule or app.ctx.slot != 0:
+        return
+
+    def on_result(job, result, time_taken):
+        status = 'success' if result['returncode'] == 0 else 'failure'
+
+        app.ctx.metrics.inc('server_scheduled_runs_total', f'exporter="{job.exporter}",result="{status}"')
+        app.ctx.metrics.inc('server_scheduled_seconds_total', f'exporter="{job.exporter}"', time_taken)
+
+    app.ctx.scheduler = Scheduler(
+        list(app.ctx.schedule.values()),
+        app.ctx.snapshots,
+        lambda exporter, arguments, timeout: run_exporter(app, exporter, arguments, timeout),
+        Environment.SCHEDULE_CONCURRENCY,
+        Environment.SCHEDULE_JITTER,
+        on_result
+    )
+    app.ctx.scheduler.start()
+
+@app.before_server_stop
+async def stop_scheduler(app, _):
+    if app.ctx.scheduler is not None:
+        await app.ctx.scheduler.stop()
 
 '''
     Middleware for server metrics
@@ -56,40 +324,36 @@ async def middleware_request(request):
 
 @app.middleware("response")
 async def middleware_response(request, response):
-    increment_metric(request.app.shared_ctx, 'server_requests_total', f'status="{response.status}"')
+    request.app.ctx.metrics.inc('server_requests_total', f'status="{response.status}"')
 
     if not request.path.startswith('/metrics/'):
         return
-        
+
+    # only exporters that exist get a label, anything else could be asked for
+    exporter = request.match_info.get('exporter')
+    known = exporter in request.app.ctx.exporters
+
+    # streamed responses have no body here, their bytes are counted as they are sent
+    if known and response.body:
+        request.app.ctx.metrics.inc('server_exporter_response_bytes_total', f'exporter="{exporter}"', len(response.body))
+
     if response.status == 200 or response.status > 499:
         time_taken = time.perf_counter() - request.ctx.request_started_at
 
-        increment_metric(request.app.shared_ctx, 'server_exporter_requests_total', f'path="{request.path}",status="{response.status}"')
-        increment_metric(request.app.shared_ctx, 'server_exporter_seconds_total', f'path="{request.path}"', time_taken)
+        request.app.ctx.metrics.inc('server_exporter_requests_total', f'path="{request.path}",status="{response.status}"')
+        request.app.ctx.metrics.inc('server_exporter_seconds_total', f'path="{request.path}"', time_taken)
+
+        if known:
+            request.app.ctx.metrics.observe('server_exporter_request_seconds', f'exporter="{exporter}"', time_taken)
 
 '''
     Route for web-server metrics
 '''
 @app.get("/metrics")
 async def route_metrics(request):
-    request.app.shared_ctx.metrics['server_uptime_seconds_total']['value'] = time.time() - app.shared_ctx.metrics['server_uptime_seconds_total']['started']
-
-    blob = []
-
-    for metric_name in request.app.shared_ctx.metrics.keys():
-        blob.append(f"# HELP {metric_name} {request.app.shared_ctx.metrics[metric_name]['help']}")
-        blob.append(f"# TYPE {metric_name} {request.app.shared_ctx.metrics[metric_name]['type']}")
-
-        if 'value' in request.app.shared_ctx.metrics[metric_name].keys():
-            blob.append(f"{metric_name} {request.app.shared_ctx.metrics[metric_name]['value']}")
-            continue
-
-        for labels, value in request.app.shared_ctx.metrics[metric_name]['metrics'].items():
-            blob.append(f"{metric_name}{{{labels}}} {value}")
-
-    blob.append("\n")
+    uptime = time.time() - request.app.ctx.metrics.started_at
 
-    return text("\n".join(blob))
+    return text(request.app.ctx.metrics.render({'server_uptime_seconds_total': [('', uptime)]}))
 
 '''
     Route for exporter metrics
@@ -103,68 +367,534 @@ def param_valid(what):
 
     return True
 
-@app.get("/metrics/<exporter:str>")
-async def route_metrics_exporter(request, exporter):
-    arguments = []
+'''
+    Exporter arguments taking regular expressions or interface names (see
+    the Cisco exporter), only their values may also contain /*+?|()[]^$
+'''
+PATTERN_ARGUMENTS = (
+    '--include-interfaces', '--exclude-interfaces',
+    '--include-descriptions', '--exclude-descriptions',
+    '--include-metrics', '--exclude-metrics',
+    '--interface-range'
+)
+
+def pattern_valid(what):
+    if re.match(r'^[a-zA-Z0-9\-_\.\,\:/*+?|()\[\]^$]+$', what) is None:
+        return False
 
-    for pair in request.query_args:
-        if not param_valid(pair[0]) or not param_valid(pair[1]):
-            continue
+    return True
 
-        if pair[0] == 'debug':
-            continue # intended for the web server
+'''
+    Stream reader over a pipe, so it can be read without blocking the event loop
+'''
+async def open_pipe(fd):
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
 
-        arguments.append(pair[0])
-        if pair[1] == "":
-            continue
+    transport, _ = await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(fd, 'rb', 0)
+    )
 
-        arguments.append(pair[1])
+    return reader, transport
 
-    metrics_filename = f"/tmp/.metrics_{request.id}"
+'''
+    Reads a stream to the end into output (a BoundedOutput), or until more
+    than limit bytes came and on_overflow was called. With timestamps, notes
+    when the first bytes arrived in timestamps['first_byte'].
+'''
+async def read_bounded(reader, output, limit, on_overflow, timestamps=None):
+    while True:
+        chunk = await reader.read(Environment.STREAM_CHUNK_SIZE)
 
-    proc = await asyncio.create_subprocess_shell(
-        f"./metrics --exporter {exporter} --output-filename {metrics_filename} {' '.join(arguments)}",
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE
-    )
+        if timestamps is not None and 'first_byte' not in timestamps:
+            timestamps['first_byte'] = time.perf_counter()
+
+        if not chunk:
+            return
+
+        output.add(chunk)
+
+        if output.total > limit:
+            on_overflow()
+            return
+
+async def read_pipe(fd, output, limit, on_overflow, timestamps):
+    reader, transport = await open_pipe(fd)
+
+    try:
+        await read_bounded(reader, output, limit, on_overflow, timestamps)
+    finally:
+        transport.close()
+
+'''
+    Bounded stdout and stderr of an exporter, and the limit on each
+'''
+def exporter_outputs():
+    stdout = BoundedOutput(Environment.EXPORTER_STDOUT_KB * 1024)
+    stderr = BoundedOutput(Environment.EXPORTER_STDERR_KB * 1024, tail=True)
+
+    return stdout, stderr, Environment.EXPORTER_OUTPUT_LIMIT_MB * 1048576
+
+'''
+    What the server records of an exporter run besides its result:
+    durations of its phases, bytes written and whether they were truncated
+    per stream, and why it was killed, if it was
+'''
+def new_report():
+    return {'phases': {}, 'outputs': {}, 'killed': None}
+
+'''
+    Starts ./metrics, returns the process and the read end of its metrics pipe
+
+    Metrics come back over a dedicated pipe the child inherits, separate from
+    stdout and stderr, which are free for the exporter to print to
+'''
+async def spawn_exporter_process(exporter, arguments):
+    metrics_read, metrics_write = os.pipe()
+
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            './metrics', '--exporter', exporter, '--output-fd', str(metrics_write), *arguments,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            pass_fds=[metrics_write]
+        )
+    except:
+        os.close(metrics_read)
+        raise
+    finally:
+        os.close(metrics_write)
+
+    return proc, metrics_read
+
+def kill_process(proc):
+    try:
+        proc.kill()
+    except:
+        pass
+
+'''
+    Runs the exporter as a ./metrics sub process
+
+    Output is read as it is written: only the start of stdout and the end of
+    stderr are kept (EXPORTER_STDOUT_KB, EXPORTER_STDERR_KB), and the
+    exporter is killed once it writes more than EXPORTER_OUTPUT_LIMIT_MB to
+    either, or more than EXPORTER_METRICS_LIMIT_MB of metrics.
+
+    Durations of the spawn, runtime and read phases, the last two only for
+    runs that finished, and what was written are put in report.
+'''
+async def run_exporter_process(exporter, arguments, timeout, report):
+    started_at = time.perf_counter()
+    proc, metrics_read = await spawn_exporter_process(exporter, arguments)
+    spawned_at = time.perf_counter()
+
+    report['phases']['spawn'] = spawned_at - started_at
+    timestamps = {}
 
-    http_status = 200
     process_output = {
         'returncode': 255,
         'stdout': '',
         'stderr': '',
-        'metrics_filename': metrics_filename,
         'metrics': ''
     }
 
+    stdout, stderr, output_limit = exporter_outputs()
+    metrics_limit = Environment.EXPORTER_METRICS_LIMIT_MB * 1048576
+    metrics = BoundedOutput(metrics_limit)
+
+    def overflow(reason):
+        def kill():
+            report['killed'] = report['killed'] or reason
+            kill_process(proc)
+
+        return kill
+
+    collecting = asyncio.gather(
+        read_bounded(proc.stdout, stdout, output_limit, overflow('output_limit')),
+        read_bounded(proc.stderr, stderr, output_limit, overflow('output_limit')),
+        read_pipe(metrics_read, metrics, metrics_limit, overflow('metrics_limit'), timestamps),
+        proc.wait()
+    )
+
     try:
-        stdout, stderr = await asyncio.wait_for(
-            proc.communicate(), timeout=59
-        )
+        await asyncio.wait_for(collecting, timeout=timeout)
+
+        finished_at = time.perf_counter()
+        report['phases']['runtime'] = timestamps['first_byte'] - spawned_at
+        report['phases']['read'] = finished_at - timestamps['first_byte']
 
         process_output['returncode'] = proc.returncode
-        process_output['stdout'] = stdout.decode()
-        process_output['stderr'] = stderr.decode()
+        process_output['stdout'] = stdout.text()
+        process_output['stderr'] = stderr.text()
+        process_output['metrics'] = metrics.text()
+
+        if report['killed'] is not None:
+            process_output['returncode'] = -9
+            process_output['stderr'] = f"Killed: over {report['killed'].replace('_', ' ')}\n{process_output['stderr']}"
+            process_output['metrics'] = ''
     except asyncio.exceptions.TimeoutError:
+        report['killed'] = 'timeout'
+        process_output['returncode'] = -9
         process_output['stderr'] = 'Killed: Timed out'
 
+        kill_process(proc)
+    except asyncio.exceptions.CancelledError:
+        # ie. a scheduled run while shutting down, do not leave the exporter behind
+        kill_process(proc)
+        collecting.add_done_callback(lambda future: future.cancelled() or future.exception())
+        raise
+    finally:
+        for stream, output in (('stdout', stdout), ('stderr', stderr), ('metrics', metrics)):
+            report['outputs'][stream] = (output.total, output.truncated)
+
+    return process_output
+
+'''
+    Runs the exporter as a ./metrics sub process and forwards its metrics to
+    the client as they are written, without holding the exposition in memory
+
+    The status is only known for sure once the exporter exits, so the response
+    is committed to 200 when the first chunk of metrics arrives. If nothing
+    arrives, the process output is handled like a regular run.
+
+    Returns the response and the exit code (-9 when killed), report is
+    filled in as by run_exporter_process, read includes sending to the client.
+    Metrics are not held, so they have no limit, stdout and stderr do.
+'''
+async def stream_exporter_process(request, exporter, arguments, timeout, report):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    phases = report['phases']
+
+    started_at = time.perf_counter()
+    proc, metrics_read = await spawn_exporter_process(exporter, arguments)
+    spawned_at = time.perf_counter()
+
+    phases['spawn'] = spawned_at - started_at
+    reader, transport = await open_pipe(metrics_read)
+
+    stdout, stderr, output_limit = exporter_outputs()
+
+    def overflow():
+        report['killed'] = report['killed'] or 'output_limit'
+        kill_process(proc)
+
+    # stdout and stderr are drained alongside, so the exporter never blocks on them
+    draining = asyncio.ensure_future(asyncio.gather(
+        read_bounded(proc.stdout, stdout, output_limit, overflow),
+        read_bounded(proc.stderr, stderr, output_limit, overflow),
+        proc.wait()
+    ))
+    # cancelled when the run is cut short, nobody waits on it then
+    draining.add_done_callback(lambda future: future.cancelled() or future.exception())
+    response = None
+    first_byte_at = None
+    streamed = 0
+
+    try:
+        while True:
+            chunk = await asyncio.wait_for(reader.read(Environment.STREAM_CHUNK_SIZE), timeout=deadline - loop.time())
+
+            if first_byte_at is None:
+                first_byte_at = time.perf_counter()
+
+            if not chunk:
+                break
+
+            if response is None:
+                response = await request.respond(content_type="text/plain; charset=utf-8")
+
+            await response.send(chunk)
+            streamed += len(chunk)
+
+        await asyncio.wait_for(draining, timeout=deadline - loop.time())
+
+        phases['runtime'] = first_byte_at - spawned_at
+        phases['read'] = time.perf_counter() - first_byte_at
+    except asyncio.exceptions.TimeoutError:
+        report['killed'] = 'timeout'
+        kill_process(proc)
+        draining.cancel()
+
+        if response is not None:
+            # already committed to 200, all that can be done is cutting it short
+            request.app.ctx.metrics.inc('server_exporter_response_bytes_total', f'exporter="{exporter}"', streamed)
+            await response.eof()
+            return None, -9
+
+        return text('Killed: Timed out', status=500), -9
+    except (asyncio.exceptions.CancelledError, ConnectionError):
+        # the client went away, sending to it raises the former as well, do not leave the exporter behind
+        kill_process(proc)
+        draining.cancel()
+        raise
+    finally:
+        transport.close()
+
+        for stream, output in (('stdout', stdout), ('stderr', stderr)):
+            report['outputs'][stream] = (output.total, output.truncated)
+
+        report['outputs']['metrics'] = (streamed, False)
+
+    returncode = -9 if report['killed'] is not None else proc.returncode
+
+    if response is not None:
+        request.app.ctx.metrics.inc('server_exporter_response_bytes_total', f'exporter="{exporter}"', streamed)
+        await response.eof()
+        return None, returncode
+
+    if report['killed'] is not None:
+        return text(f"Killed: over {report['killed'].replace('_', ' ')}\n{stderr.text()}", status=500), returncode
+    elif returncode == 255:
+        return text(stdout.text(), status=404), returncode
+    elif returncode != 0:
+        return text(stderr.text(), status=500), returncode
+
+    return text(''), returncode
+
+'''
+    Response with exporter metrics, compressed if the client accepts it
+
+    version identifies metrics that are served more than once (cached results
+    and snapshots), suffix is appended to metrics but never cached
+'''
+async def metrics_response(request, exporter, metrics, version=None, suffix=''):
+    started_at = time.perf_counter()
+
+    try:
+        if not Environment.COMPRESSION:
+            return text(metrics + suffix)
+
+        compressor = request.app.ctx.compressor
+        encoding = compressor.negotiate(request.headers.get('accept-encoding'))
+
+        body, encoding = await compressor.compress(metrics, encoding, version, suffix)
+
+        headers = {'Vary': 'Accept-Encoding'}
+        if encoding is not None:
+            headers['Content-Encoding'] = encoding
+
+        return raw(body, content_type="text/plain; charset=utf-8", headers=headers)
+    finally:
+        request.app.ctx.metrics.observe('server_exporter_encode_seconds', f'exporter="{exporter}"', time.perf_counter() - started_at)
+
+def exporter_timeout(exporter):
+    return Environment.EXPORTER_TIMEOUTS.get(exporter, Environment.EXPORTER_TIMEOUT)
+
+'''
+    Class of an exporter run in the event loop of this server worker, None
+    if it runs as usual: it is not in INPROCESS_EXPORTERS, is not async, fails
+    to import (its ./metrics runs tell why) or is asked for --targets or
+    --help, which only ./metrics handles
+'''
+def inprocess_class(app, exporter, arguments):
+    if exporter not in Environment.INPROCESS_EXPORTERS or exporter not in app.ctx.exporters:
+        return None
+
+    if exporter not in app.ctx.inprocess:
         try:
-            proc.kill()
-        except:
-            pass
+            exporter_class = runner.load_exporter(exporter, app.ctx.exporters)
+        except Exception:
+            exporter_class = None
+
+        if exporter_class is not None and not runner.is_async(exporter_class):
+            print(f"Exporter {exporter} has no async gather_metrics, it runs as a sub process", file=sys.stderr)
+            exporter_class = None
+
+        app.ctx.inprocess[exporter] = exporter_class
+
+    if '--targets' in arguments or '--help' in arguments:
+        return None
+
+    return app.ctx.inprocess[exporter]
+
+'''
+    Waits for the exporter's gate, returns the gate and the time waited,
+    raises Rejected when the run is turned away
+'''
+async def admit(app, exporter, timeout):
+    gate = app.ctx.admission.gate(exporter)
 
     try:
-        with open(metrics_filename, "r") as data:
-            process_output['metrics'] = data.read()
-        
-        os.remove(metrics_filename)
-    except:
-        pass
+        waited = await gate.acquire(timeout)
+    except Rejected as e:
+        app.ctx.metrics.inc('server_exporter_rejected_total', f'exporter="{exporter}",reason="{e.reason}"')
+        raise
+
+    app.ctx.metrics.inc('server_exporter_admitted_total', f'exporter="{exporter}"')
+    app.ctx.metrics.inc('server_exporter_queue_seconds_total', f'exporter="{exporter}"', waited)
+    app.ctx.metrics.observe('server_exporter_queue_wait_seconds', f'exporter="{exporter}"', waited)
+
+    return gate, waited
+
+'''
+    Records the report and the outcome of a finished exporter run, -9 being
+    the exit code of killed runs (on timeout, unless the report tells why)
+'''
+def record_run(app, exporter, returncode, report):
+    labels = f'exporter="{exporter}"'
+
+    for phase, seconds in report['phases'].items():
+        app.ctx.metrics.observe(f'server_exporter_{phase}_seconds', labels, seconds)
+
+    for stream, (written, truncated) in report['outputs'].items():
+        app.ctx.metrics.inc('server_exporter_output_bytes_total', f'{labels},stream="{stream}"', written)
+
+        if truncated:
+            app.ctx.metrics.inc('server_exporter_output_truncated_total', f'{labels},stream="{stream}"')
+
+    app.ctx.metrics.inc('server_exporter_exit_codes_total', f'{labels},code="{returncode}"')
+
+    killed = report['killed']
+    if killed is None and returncode == -9:
+        killed = 'timeout'
+
+    if killed == 'timeout':
+        app.ctx.metrics.inc('server_exporter_timeouts_total', labels)
 
-    if proc.returncode == 255:
+    if killed is not None:
+        app.ctx.metrics.inc('server_exporter_kills_total', f'{labels},reason="{killed}"')
+
+'''
+    Runs the exporter in the worker pool or as a sub process, once admitted.
+    Time spent waiting for admission counts against the timeout.
+'''
+async def run_exporter(app, exporter, arguments, timeout=None):
+    if timeout is None:
+        timeout = exporter_timeout(exporter)
+
+    if exporter not in app.ctx.exporters:
+        return {'returncode': 255, 'stdout': "Exporter not found.\n", 'stderr': '', 'metrics': ''}
+
+    gate, waited = await admit(app, exporter, timeout)
+    report = new_report()
+    exporter_class = inprocess_class(app, exporter, arguments)
+
+    try:
+        if exporter_class is not None:
+            started_at = time.perf_counter()
+            process_output = await runner.run_in_loop(exporter_class, arguments, timeout - waited)
+
+            if process_output['returncode'] == -9:
+                report['killed'] = 'timeout'
+            else:
+                report['phases']['runtime'] = time.perf_counter() - started_at
+                report['outputs']['metrics'] = (len(process_output['metrics']), False)
+        elif not app.ctx.pool.enabled_for(exporter):
+            process_output = await run_exporter_process(exporter, arguments, timeout - waited, report)
+        else:
+            started_at = time.perf_counter()
+            process_output = await app.ctx.pool.run(exporter, arguments, timeout - waited)
+            report['outputs'] = process_output.pop('outputs', {})
+
+            # pool workers are already running, the whole run is the exporter's
+            if process_output['returncode'] != -9:
+                report['phases']['runtime'] = time.perf_counter() - started_at
+    except asyncio.exceptions.CancelledError:
+        if exporter_class is None and not app.ctx.pool.enabled_for(exporter):
+            app.ctx.metrics.inc('server_exporter_kills_total', f'exporter="{exporter}",reason="cancelled"')
+        raise
+    finally:
+        gate.release()
+
+    record_run(app, exporter, process_output['returncode'], report)
+
+    return process_output
+
+async def stream_exporter(request, exporter, arguments):
+    timeout = exporter_timeout(exporter)
+    gate, waited = await admit(request.app, exporter, timeout)
+    report = new_report()
+
+    try:
+        response, returncode = await stream_exporter_process(request, exporter, arguments, timeout - waited, report)
+    except (asyncio.exceptions.CancelledError, ConnectionError):
+        request.app.ctx.metrics.inc('server_exporter_kills_total', f'exporter="{exporter}",reason="cancelled"')
+        raise
+    finally:
+        gate.release()
+
+    record_run(request.app, exporter, returncode, report)
+
+    return response
+
+@app.get("/metrics/<exporter:str>")
+async def route_metrics_exporter(request, exporter):
+    # before anything keyed on the name, ie. cache files or metric labels, exists for it
+    if exporter not in request.app.ctx.exporters:
+        return text("Exporter not found.\n", status=404)
+
+    pairs = []
+
+    for pair in request.query_args:
+        if not param_valid(pair[0]):
+            continue
+
+        if not param_valid(pair[1]) and not (pair[0] in PATTERN_ARGUMENTS and pattern_valid(pair[1])):
+            continue
+
+        if pair[0] == 'debug':
+            continue # intended for the web server
+
+        # ie. --output-filename or --interval would write files or keep running,
+        # values become arguments as well
+        for argument in pair:
+            if argument in runner.CLI_ONLY_ARGUMENTS:
+                return text(f"Argument {argument} cannot be used in scrapes.\n", status=400)
+
+        pairs.append(pair)
+
+    owner = foreign_owner(request.app, exporter, pairs)
+    if owner is not None:
+        return shard_response(request, exporter, owner)
+
+    arguments = runner.arguments_from_pairs(pairs)
+    key = cache_key(exporter, pairs)
+
+    # scheduled jobs are answered from their latest snapshot, once there is one
+    if key in request.app.ctx.schedule and not request.ctx.debug_request:
+        snapshot = request.app.ctx.snapshots.get(key)
+
+        if snapshot is not None:
+            request.app.ctx.metrics.inc('server_exporter_cache_total', f'exporter="{exporter}",result="snapshot"')
+
+            return await metrics_response(
+                request,
+                exporter,
+                snapshot['metrics'],
+                (key, snapshot['collected_at']),
+                scheduler.staleness_series(snapshot)
+            )
+
+    cache_ttl = Environment.CACHE_TTLS.get(exporter, Environment.CACHE_TTL)
+
+    # streaming only applies to uncached ./metrics runs, anything else needs the whole result
+    streaming = Environment.STREAMING and cache_ttl <= 0 and not request.ctx.debug_request \
+        and not request.app.ctx.pool.enabled_for(exporter) \
+        and inprocess_class(request.app, exporter, arguments) is None
+
+    if streaming:
+        return await stream_exporter(request, exporter, arguments)
+
+    # debug requests want to see this run's stdout and stderr, never cached
+    if cache_ttl > 0 and not request.ctx.debug_request:
+        process_output, cache_status = await request.app.ctx.cache.fetch(
+            key,
+            cache_ttl,
+            lambda: run_exporter(request.app, exporter, arguments)
+        )
+
+        request.app.ctx.metrics.inc('server_exporter_cache_total', f'exporter="{exporter}",result="{cache_status}"')
+    else:
+        process_output = await run_exporter(request.app, exporter, arguments)
+
+    http_status = 200
+
+    if process_output['returncode'] == 255:
         http_status = 404
         response = process_output['stdout']
-    elif proc.returncode > 0:
+    elif process_output['returncode'] != 0:
         http_status = 500
         response = process_output['stderr']
     else:
@@ -173,7 +903,15 @@ async def route_metrics_exporter(request, exporter):
     if request.ctx.debug_request:
         return json(process_output, status=http_status)
 
-    return text(response, status=http_status)
+    if http_status != 200:
+        return text(response, status=http_status)
+
+    # results from the cache are the same until stored again
+    version = None
+    if 'stored_at' in process_output:
+        version = (key, process_output['stored_at'])
+
+    return await metrics_response(request, exporter, response, version)
 
 if __name__ == "__main__":
     app.run(workers=Environment.WORKERS, host="0.0.0.0", port=Environment.PORT)
@@ -0,0 +1,84 @@
+import asyncio
+import pytest
+from lib.admission import Admission, Gate, Rejected
+
+def test_no_limit_admits_everything():
+    async def run():
+        gate = Gate(0, 0)
+        waited = [await gate.acquire() for _ in range(10)]
+        return gate, waited
+
+    gate, waited = asyncio.run(run())
+
+    assert waited == [0.0] * 10
+    assert gate.in_flight == 10
+
+def test_limit_and_queue():
+    async def run():
+        gate = Gate(1, 1)
+        await gate.acquire()
+
+        queued = asyncio.ensure_future(gate.acquire())
+        await asyncio.sleep(0)
+
+        assert (gate.in_flight, gate.queued) == (1, 1)
+
+        with pytest.raises(Rejected) as rejected:
+            await gate.acquire()
+
+        assert rejected.value.reason == 'queue_full'
+
+        gate.release()
+        waited = await queued
+
+        assert (gate.in_flight, gate.queued) == (1, 0)
+        assert waited >= 0
+
+    asyncio.run(run())
+
+def test_queue_timeout():
+    async def run():
+        gate = Gate(1, 5)
+        await gate.acquire()
+
+        with pytest.raises(Rejected) as rejected:
+            await gate.acquire(timeout=0.01)
+
+        assert rejected.value.reason == 'queue_timeout'
+        assert (gate.in_flight, gate.queued) == (1, 0)
+
+        # the slot of the timed out wait is not lost
+        gate.release()
+        await asyncio.wait_for(gate.acquire(), timeout=1)
+
+    asyncio.run(run())
+
+def test_cancelled_wait_leaves_the_queue():
+    async def run():
+        gate = Gate(1, 1)
+        await gate.acquire()
+
+        queued = asyncio.ensure_future(gate.acquire())
+        await asyncio.sleep(0)
+        queued.cancel()
+        await asyncio.sleep(0)
+
+        assert gate.queued == 0
+
+    asyncio.run(run())
+
+def test_admission_gates_per_exporter():
+    changes = []
+    admission = Admission(2, {'cisco': 1}, 3, {}, lambda name, gate: changes.append((name, gate.in_flight, gate.queued)))
+
+    async def run():
+        await admission.gate('cisco').acquire()
+        admission.gate('cisco').release()
+
+    asyncio.run(run())
+
+    assert admission.gate('cisco').limit == 1
+    assert admission.gate('dummy').limit == 2
+    assert admission.gate('dummy').queue_depth == 3
+    assert admission.gate('cisco') is admission.gate('cisco')
+    assert changes == [('cisco', 0, 1), ('cisco', 0, 0), ('cisco', 1, 0), ('cisco', 0, 0)]
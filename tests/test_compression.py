@@ -0,0 +1,92 @@
+import gzip
+import asyncio
+import pytest
+from lib import compression
+
+@pytest.fixture
+def compressor():
+    compressor = compression.Compressor(min_size=10, offload_size=1000)
+
+    # zstd depends on an optional package, negotiation is tested without it
+    compressor.encodings = ['gzip']
+
+    return compressor
+
+def test_accepted_encodings():
+    assert compression.accepted_encodings('gzip, deflate;q=0.5, br;q=bad, , *;q=0') == \
+        {'gzip': 1.0, 'deflate': 0.5, 'br': 0.0, '*': 0.0}
+
+@pytest.mark.parametrize('header, expected', [
+    (None, None),
+    ('', None),
+    ('gzip', 'gzip'),
+    ('GZIP;q=0.3', 'gzip'),
+    ('gzip;q=0', None),
+    ('identity', None),
+    ('*', 'gzip'),
+    ('*;q=0.5, gzip;q=0', None),
+    ('br, deflate', None)
+])
+def test_negotiate(compressor, header, expected):
+    assert compressor.negotiate(header) == expected
+
+def test_negotiate_prefers_zstd_unless_weighted_lower(compressor):
+    compressor.encodings = ['zstd', 'gzip']
+
+    assert compressor.negotiate('gzip, zstd') == 'zstd'
+    assert compressor.negotiate('gzip, zstd;q=0.5') == 'gzip'
+
+def test_small_bodies_are_left_as_is(compressor):
+    assert asyncio.run(compressor.compress('short', 'gzip')) == (b'short', None)
+
+@pytest.mark.parametrize('size', [100, 5000])
+def test_gzip_with_suffix(compressor, size):
+    body = 'metric 1\n' * size
+
+    compressed, encoding = asyncio.run(compressor.compress(body, 'gzip', suffix='age 2\n'))
+
+    assert encoding == 'gzip'
+    assert gzip.decompress(compressed) == (body + 'age 2\n').encode()
+
+def test_versioned_bodies_are_compressed_once(compressor):
+    body = 'metric 1\n' * 100
+    starts = []
+    start = compressor.start
+
+    def counting_start(*args):
+        starts.append(1)
+        return start(*args)
+
+    compressor.start = counting_start
+
+    async def responses():
+        return [await compressor.compress(body, 'gzip', ('key', 1), suffix=f'age {age}\n') for age in range(3)]
+
+    for age, (compressed, _) in enumerate(asyncio.run(responses())):
+        assert gzip.decompress(compressed) == f'{body}age {age}\n'.encode()
+
+    assert len(starts) == 1
+
+def test_cache_is_bounded(compressor):
+    compressor.cache_bytes = compression.GZIP_STATE_BYTES * 2 + 1000
+
+    async def responses():
+        for version in range(5):
+            await compressor.compress('metric 1\n' * 100, 'gzip', ('key', version))
+
+    asyncio.run(responses())
+
+    assert len(compressor.cache) == 2
+    assert compressor.cached_bytes <= compressor.cache_bytes
+    assert list(compressor.cache) == [(('key', 3), 'gzip'), (('key', 4), 'gzip')]
+
+@pytest.mark.skipif(compression.zstandard is None, reason="zstandard is not installed")
+def test_zstd_with_suffix():
+    compressor = compression.Compressor(min_size=10)
+    body = 'metric 1\n' * 100
+
+    compressed, encoding = asyncio.run(compressor.compress(body, 'zstd', ('key', 1), suffix='age 2\n'))
+
+    reader = compression.zstandard.ZstdDecompressor().stream_reader(compressed, read_across_frames=True)
+    assert encoding == 'zstd'
+    assert reader.read() == (body + 'age 2\n').encode()
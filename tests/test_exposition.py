@@ -0,0 +1,96 @@
+import io
+import prometheus_client
+from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily, GaugeHistogramMetricFamily
+from lib import exposition
+
+class Families:
+    def __init__(self, families):
+        self.families = families
+
+    def collect(self):
+        return iter(self.families)
+
+def registry():
+    registry = prometheus_client.CollectorRegistry()
+
+    gauge = prometheus_client.Gauge('bytes', 'Bytes per "interface"\nsecond line \\ backslash', ['instance', 'interface', 'description'], registry=registry)
+    counter = prometheus_client.Counter('packets', 'Packets', ['interface'], registry=registry)
+    histogram = prometheus_client.Histogram('latency_seconds', 'Latency', ['path'], registry=registry)
+    summary = prometheus_client.Summary('runtime_seconds', 'Runtime', registry=registry)
+    special = prometheus_client.Gauge('special', 'Special values', ['value'], registry=registry)
+
+    for i in range(20):
+        gauge.labels('sw1', f'Ethernet1/{i}', f'uplink "{i}"\n\\').set(i * 1234567.891)
+        counter.labels(f'Ethernet1/{i}').inc(i)
+        histogram.labels(f'/path/{i % 3}').observe(i / 10)
+        summary.observe(i / 7)
+
+    for value in (float('inf'), float('-inf'), float('nan'), 0, -0.0, -1.5, 1e-9, 123456789.0, 1234567.0, 2 ** 70, -2 ** 70):
+        special.labels(str(value)).set(value)
+
+    prometheus_client.Info('build', 'Build', registry=registry).info({'version': '1.0'})
+    prometheus_client.Enum('state', 'State', states=['up', 'down'], registry=registry).state('down')
+
+    return registry
+
+def openmetrics_families():
+    timestamped = GaugeMetricFamily('timestamped', 'With timestamps', labels=['a'])
+    timestamped.add_metric(['x'], 1.5, timestamp=1700000000.123)
+
+    histogram = GaugeHistogramMetricFamily('queue', 'Gauge histogram', buckets=[('1.0', 2), ('+Inf', 3)], gsum_value=4)
+
+    unlabelled = CounterMetricFamily('requests', 'Requests')
+    unlabelled.add_metric([], 7, created=1700000000)
+
+    return Families([timestamped, histogram, unlabelled])
+
+def test_same_bytes_as_generate_latest():
+    for source in (registry(), openmetrics_families()):
+        expected = prometheus_client.generate_latest(source)
+
+        assert exposition.Encoder().generate_latest(source) == expected
+        assert exposition.Encoder(cache_series=False).generate_latest(source) == expected
+
+def test_warm_encoder_follows_changes():
+    metrics = registry()
+    encoder = exposition.Encoder()
+    gauge = metrics._names_to_collectors['bytes']
+
+    for value in (1.0, 1.0, 0.0, -0.0, 2.5):
+        gauge.labels('sw1', 'Ethernet1/0', 'x').set(value)
+
+        assert encoder.generate_latest(metrics) == prometheus_client.generate_latest(metrics)
+
+def test_families_join_to_the_whole_exposition():
+    metrics = registry()
+    encoder = exposition.Encoder()
+    handle = io.BytesIO()
+
+    written = encoder.write_families(handle, metrics)
+
+    assert handle.getvalue() == prometheus_client.generate_latest(metrics)
+    assert written == len(handle.getvalue())
+    assert b''.join(encoder.generate_families(metrics)) == handle.getvalue()
+
+def test_series_with_the_same_values_under_other_label_names():
+    encoder = exposition.Encoder()
+
+    for label in ('a', 'b'):
+        family = GaugeMetricFamily('m', 'Help', labels=[label])
+        family.add_metric(['x'], 1)
+        source = Families([family])
+
+        assert encoder.generate_latest(source) == prometheus_client.generate_latest(source)
+
+def test_cache_limit():
+    encoder = exposition.Encoder(max_cached=5)
+    metrics = registry()
+
+    assert encoder.generate_latest(metrics) == prometheus_client.generate_latest(metrics)
+    assert len(encoder.series) <= 5 and len(encoder.headers) <= 5
+
+def test_format_float_matches_prometheus_client():
+    from prometheus_client.utils import floatToGoString
+
+    for value in (0, -0.0, 1, 0.1, 1e-9, 1234567.0, 12345678.9, 1e21, 2 ** 70, -2 ** 70, float('inf'), float('-inf'), float('nan')):
+        assert exposition.format_float(value) == floatToGoString(value)
@@ -0,0 +1,116 @@
+import prometheus_client
+from lib import mapping
+from lib import util
+
+converters = {
+    'float': float,
+    'state': lambda value: {'up': 1, 'down': 0}[value]
+}
+
+metrics_wanted = {
+    'eth': {
+        'state':    ('Gauge', 'state', 'eth_state'),
+        'rxload':   ('Gauge', 'float'),
+        'bytes':    ('Counter', 'float')
+    },
+    'system': {
+        'load':     ('Gauge', 'float')
+    }
+}
+
+metric_config = {
+    'eth': {
+        'labels': ['instance', 'interface'],
+        'helptext': 'Interface metrics',
+        'prefix_with_category_name': False,
+        'gate': ('state', ['state'])
+    },
+    'system': {
+        'labels': ['instance'],
+        'helptext': 'System metrics',
+        'prefix_with_category_name': True
+    }
+}
+
+def plans(wanted=None):
+    return mapping.compile_plans(metrics_wanted, metric_config, converters, 'device', wanted)
+
+def test_table_rows_of_a_single_row():
+    assert mapping.table_rows({'TABLE_x': {'ROW_x': {'a': 1}}}, 'x') == [{'a': 1}]
+    assert mapping.table_rows({'TABLE_x': {'ROW_x': [{'a': 1}, {'a': 2}]}}, 'x') == [{'a': 1}, {'a': 2}]
+
+def test_metric_names_and_row_keys():
+    compiled = plans()
+
+    assert [field[1] for field in compiled['eth'].fields] == ['device_state', 'device_rxload', 'device_bytes']
+    assert [field[3] for field in compiled['eth'].fields] == ['eth_state', 'rxload', 'bytes']
+    assert [field[1] for field in compiled['system'].fields] == ['device_system_load']
+
+def test_extract_converts_and_skips_bad_values():
+    plan = plans()['eth']
+
+    assert plan.extract({'eth_state': 'up', 'rxload': '3', 'bytes': 'n/a'}) == [(0, 1), (1, 3.0)]
+
+def test_gate_keeps_only_listed_fields_when_down():
+    plan = plans()['eth']
+
+    assert plan.extract({'eth_state': 'down', 'rxload': '3', 'bytes': '10'}) == [(0, 0)]
+    assert plan.extract({'rxload': '3'}) == []
+
+def test_wanted_leaves_out_metrics():
+    plan = plans(lambda name: name != 'device_rxload')['eth']
+
+    assert plan.sources() == ['state', 'bytes']
+    assert plan.extract({'eth_state': 'up', 'rxload': '3', 'bytes': '10'}) == [(0, 1), (1, 10.0)]
+
+def test_gate_applies_when_its_field_is_left_out():
+    plan = plans(lambda name: name != 'device_state')['eth']
+
+    assert plan.extract({'eth_state': 'down', 'rxload': '3', 'bytes': '10'}) == []
+    assert plan.extract({'eth_state': 'up', 'rxload': '3', 'bytes': '10'}) == [(0, 3.0), (1, 10.0)]
+
+def test_bound_plan_matches_prometheus_client():
+    plan = plans()['eth']
+    rows = [
+        (('sw1', 'Ethernet1/1'), {'eth_state': 'up', 'rxload': '3', 'bytes': '10'}),
+        (('sw1', 'Ethernet1/1'), {'eth_state': 'up', 'rxload': '4', 'bytes': '5'}),
+        (('sw1', 'Ethernet1/2'), {'eth_state': 'down', 'rxload': '1', 'bytes': '7'})
+    ]
+
+    bound = plan.bind(util.ScopedClient())
+    for labels, row in rows:
+        bound.apply(labels, plan.extract(row))
+
+    expected = prometheus_client.CollectorRegistry()
+    state = prometheus_client.Gauge('device_state', 'Interface metrics', ['instance', 'interface'], registry=expected)
+    rxload = prometheus_client.Gauge('device_rxload', 'Interface metrics', ['instance', 'interface'], registry=expected)
+    total = prometheus_client.Counter('device_bytes', 'Interface metrics', ['instance', 'interface'], registry=expected)
+
+    state.labels('sw1', 'Ethernet1/1').set(1)
+    state.labels('sw1', 'Ethernet1/2').set(0)
+    rxload.labels('sw1', 'Ethernet1/1').set(4)
+    total.labels('sw1', 'Ethernet1/1').inc(15)
+
+    registry = prometheus_client.CollectorRegistry()
+    registry.register(bound)
+
+    def samples(registry):
+        return sorted(
+            (sample.name, tuple(sorted(sample.labels.items())), sample.value)
+            for family in registry.collect()
+            for sample in family.samples
+            if not sample.name.endswith('_created')
+        )
+
+    assert samples(registry) == samples(expected)
+
+def test_max_series_drops_new_label_sets():
+    plan = plans()['system']
+    bound = plan.bind(util.ScopedClient(), max_series=1)
+
+    bound.apply(('sw1',), [(0, 1.0)])
+    bound.apply(('sw2',), [(0, 2.0)])
+    bound.apply(('sw1',), [(0, 3.0)])
+
+    assert bound.series == {('sw1',): [3.0]}
+    assert bound.dropped == 1
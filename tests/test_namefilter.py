@@ -0,0 +1,25 @@
+from lib.namefilter import NameFilter
+
+names = ['Ethernet1/1', 'Ethernet1/10', 'Ethernet1/41', 'Vlan10', 'mgmt0']
+
+def allowed(name_filter):
+    return [name for name in names if name_filter.allows(name)]
+
+def test_no_patterns_allow_everything():
+    name_filter = NameFilter()
+
+    assert allowed(name_filter) == names
+    assert not name_filter.active()
+
+def test_patterns_match_whole_names():
+    assert allowed(NameFilter(include=['Ethernet1/1'])) == ['Ethernet1/1']
+    assert allowed(NameFilter(exclude=['Vlan'])) == names
+
+def test_include_then_exclude():
+    name_filter = NameFilter(include=['Ethernet1/.*', 'mgmt0'], exclude=['Ethernet1/4[0-9]'])
+
+    assert allowed(name_filter) == ['Ethernet1/1', 'Ethernet1/10', 'mgmt0']
+    assert name_filter.active()
+
+def test_exclude_only():
+    assert allowed(NameFilter(exclude=['Vlan.*', 'mgmt.*'])) == ['Ethernet1/1', 'Ethernet1/10', 'Ethernet1/41']
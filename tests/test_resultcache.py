@@ -0,0 +1,150 @@
+import os
+import time
+import asyncio
+import multiprocessing
+import pytest
+from lib.resultcache import ResultCache, cache_key
+
+def result(metrics='up 1\n', returncode=0):
+    return {'returncode': returncode, 'stdout': '', 'stderr': '', 'metrics': metrics}
+
+def test_cache_key_ignores_argument_order():
+    assert cache_key('dummy', [('a', '1'), ('b', '2')]) == cache_key('dummy', [('b', '2'), ('a', '1')])
+    assert cache_key('dummy', [('a', '1')]) != cache_key('other', [('a', '1')])
+
+def test_hit_after_miss(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    calls = []
+
+    async def collect():
+        calls.append(1)
+        return result()
+
+    async def scrape():
+        return [await cache.fetch('key', 10, collect) for _ in range(2)]
+
+    (first, first_status), (second, second_status) = asyncio.run(scrape())
+
+    assert (first_status, second_status) == ('miss', 'hit')
+    assert second['metrics'] == first['metrics']
+    assert len(calls) == 1
+
+def test_failed_results_are_not_stored(tmp_path):
+    cache = ResultCache(str(tmp_path))
+
+    async def collect():
+        return result(returncode=1)
+
+    async def scrape():
+        return [(await cache.fetch('key', 10, collect))[1] for _ in range(2)]
+
+    assert asyncio.run(scrape()) == ['miss', 'miss']
+
+def test_concurrent_fetches_are_coalesced(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    calls = []
+
+    async def collect():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return result()
+
+    async def scrape():
+        return await asyncio.gather(*[cache.fetch('key', 10, collect) for _ in range(5)])
+
+    statuses = sorted(status for _, status in asyncio.run(scrape()))
+
+    assert statuses == ['coalesced'] * 4 + ['miss']
+    assert len(calls) == 1
+    assert cache.in_flight == {}
+
+def test_cancelled_caller_does_not_fail_the_others(tmp_path):
+    cache = ResultCache(str(tmp_path))
+
+    async def collect():
+        await asyncio.sleep(0.05)
+        return result()
+
+    async def scrape():
+        first = asyncio.ensure_future(cache.fetch('key', 10, collect))
+
+        # the first caller is collecting, the cache is read in the executor before
+        while 'key' not in cache.in_flight:
+            await asyncio.sleep(0.001)
+
+        second = asyncio.ensure_future(cache.fetch('key', 10, collect))
+        await asyncio.sleep(0.01)
+
+        first.cancel()
+
+        return first, await second
+
+    first, (second, status) = asyncio.run(scrape())
+
+    assert first.cancelled()
+    assert status == 'coalesced'
+    assert second['metrics'] == 'up 1\n'
+
+def test_exception_reaches_every_caller(tmp_path):
+    cache = ResultCache(str(tmp_path))
+
+    async def collect():
+        await asyncio.sleep(0.01)
+        raise RuntimeError('broken')
+
+    async def scrape():
+        return await asyncio.gather(*[cache.fetch('key', 10, collect) for _ in range(2)], return_exceptions=True)
+
+    assert [str(error) for error in asyncio.run(scrape())] == ['broken', 'broken']
+    assert cache.in_flight == {}
+
+def test_lock_files_are_removed(tmp_path):
+    cache = ResultCache(str(tmp_path))
+
+    async def collect():
+        return result()
+
+    asyncio.run(cache.fetch('key', 10, collect))
+
+    assert os.listdir(tmp_path) == ['key.entry']
+
+def test_sweep_removes_expired_entries(tmp_path):
+    cache = ResultCache(str(tmp_path), max_ttl=10)
+    cache.put('old', result())
+    cache.put('new', result())
+
+    expired = time.time() - 60
+    os.utime(cache.path('old', 'entry'), (expired, expired))
+
+    cache.sweep()
+
+    assert os.listdir(tmp_path) == ['new.entry']
+
+def collect_in_process(directory, key, queue):
+    async def collect():
+        queue.put(os.getpid())
+        await asyncio.sleep(0.2)
+        return result()
+
+    async def scrape():
+        return (await ResultCache(directory).fetch(key, 10, collect))[1]
+
+    queue.put(asyncio.run(scrape()))
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason="needs fork")
+def test_processes_collect_once(tmp_path):
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    processes = [context.Process(target=collect_in_process, args=(str(tmp_path), 'key', queue)) for _ in range(4)]
+
+    for process in processes:
+        process.start()
+
+    for process in processes:
+        process.join(10)
+
+    reported = [queue.get(timeout=1) for _ in range(5)]
+
+    assert sum(isinstance(item, int) for item in reported) == 1
+    assert sorted(item for item in reported if isinstance(item, str)) == ['coalesced'] * 3 + ['miss']
+    assert os.listdir(tmp_path) == ['key.entry']
@@ -0,0 +1,57 @@
+import pytest
+from lib import sharding
+
+targets = [f"switch-{i}" for i in range(2000)]
+
+def test_every_target_has_one_owner():
+    members = ['a', 'b', 'c']
+    shards = [sharding.Shard(members, own) for own in members]
+
+    selected = [shard.select(targets) for shard in shards]
+
+    assert sorted(sum(selected, [])) == sorted(targets)
+    assert all(len(share) > len(targets) / 3 * 0.7 for share in selected)
+
+def test_owner_is_stable():
+    first = sharding.HashRing(['a', 'b', 'c'])
+    second = sharding.HashRing(['c', 'a', 'b'])
+
+    assert [first.owner(target) for target in targets] == [second.owner(target) for target in targets]
+
+def test_adding_a_member_moves_only_its_share():
+    before = sharding.HashRing(['a', 'b', 'c'])
+    after = sharding.HashRing(['a', 'b', 'c', 'd'])
+
+    moved = [target for target in targets if before.owner(target) != after.owner(target)]
+
+    assert all(after.owner(target) == 'd' for target in moved)
+    assert len(moved) < len(targets) / 4 * 1.3
+
+def test_own_must_be_a_member():
+    with pytest.raises(ValueError):
+        sharding.Shard(['a', 'b'], 'c')
+
+def test_addressable():
+    assert sharding.Shard(['http://a:8080', 'https://b'], 'https://b').addressable()
+    assert not sharding.Shard(['0', '1'], '0').addressable()
+
+def test_from_environment(monkeypatch):
+    for name in ('SHARD_MEMBERS', 'SHARD_SELF', 'SHARD_COUNT', 'SHARD_INDEX'):
+        monkeypatch.delenv(name, raising=False)
+
+    assert sharding.from_environment() is None
+    assert sharding.own_targets(['x', 'y']) == ['x', 'y']
+
+    monkeypatch.setenv('SHARD_COUNT', '2')
+    monkeypatch.setenv('SHARD_INDEX', '1')
+
+    assert sharding.from_environment().members == ['0', '1']
+    assert sharding.from_environment().own == '1'
+
+    monkeypatch.setenv('SHARD_MEMBERS', 'http://a:8080,http://b:8080')
+    monkeypatch.setenv('SHARD_SELF', 'http://b:8080')
+
+    shard = sharding.from_environment()
+
+    assert shard.own == 'http://b:8080'
+    assert sharding.own_targets(targets) == shard.select(targets)
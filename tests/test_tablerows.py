@@ -0,0 +1,75 @@
+import json
+import pytest
+from lib import mapping
+from lib.tablerows import TableRows
+
+def output(rows):
+    return json.dumps({
+        'TABLE_other': {'ROW_other': [{'interface': 'skipped'}]},
+        'TABLE_interface': {'ROW_interface': rows},
+        'trailer': {'ROW_interface_like': 'text with "ROW_ in it'}
+    }, indent=1).encode()
+
+def parse(data, chunk_size):
+    table = TableRows('interface')
+    rows = []
+
+    for start in range(0, len(data), chunk_size):
+        rows.extend(table.feed(data[start:start + chunk_size]))
+
+    table.close()
+
+    return rows
+
+rows = [
+    {'interface': 'Ethernet1/1', 'desc': 'uplink {core} "a"\\b', 'state': 'up'},
+    {'interface': 'Ethernet1/2', 'desc': 'naïve ünïcode', 'nested': {'a': [1, 2]}},
+    {'interface': 'Vlan10', 'state': 'down'}
+]
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, 64, 1 << 20])
+def test_rows_in_any_chunking(chunk_size):
+    data = output(rows)
+
+    assert parse(data, chunk_size) == mapping.table_rows(json.loads(data), 'interface')
+
+@pytest.mark.parametrize('chunk_size', [1, 5, 1 << 20])
+def test_single_row(chunk_size):
+    data = output(rows[0])
+
+    assert parse(data, chunk_size) == mapping.table_rows(json.loads(data), 'interface')
+
+def test_rows_come_out_as_soon_as_they_are_complete():
+    table = TableRows('interface')
+    data = b'{"TABLE_interface": {"ROW_interface": [{"interface": "a"}, {"interface": "b"}]}}'
+    second = data.index(b'{"interface": "b"}')
+
+    assert table.feed(data[:second - 1]) == [{'interface': 'a'}]
+    assert table.feed(data[second - 1:-3]) == [{'interface': 'b'}]
+    assert table.feed(data[-3:]) == []
+
+    table.close()
+
+def test_only_the_current_row_is_held():
+    table = TableRows('interface')
+    table.feed(b'{"TABLE_interface": {"ROW_interface": [')
+
+    for _ in range(1000):
+        table.feed(b'{"interface": "Ethernet1/1", "state": "up"},')
+
+        assert len(table.buffer) < 100
+
+def test_missing_table():
+    table = TableRows('interface')
+    table.feed(output(rows).replace(b'ROW_interface"', b'ROW_port"'))
+
+    with pytest.raises(ValueError, match='No ROW_interface'):
+        table.close()
+
+def test_truncated_output():
+    table = TableRows('interface')
+    data = output(rows)
+    table.feed(data[:data.index(b'Vlan10')])
+
+    with pytest.raises(ValueError, match='after 2 rows'):
+        table.close()
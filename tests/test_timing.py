@@ -0,0 +1,78 @@
+import pytest
+import prometheus_client
+from lib import timing
+from lib import util
+
+class Exporter:
+    @timing.observed
+    def work(self):
+        return 'done'
+
+    @timing.observed(class_name='Renamed')
+    def moved(self):
+        return 'done'
+
+@pytest.fixture
+def registry():
+    settings = (timing.enabled, timing.sample_rate, timing.buckets)
+    registry = prometheus_client.CollectorRegistry()
+    token = util.current_registry.set(registry)
+
+    yield registry
+
+    util.current_registry.reset(token)
+    timing.configure(*settings)
+
+def counts(registry):
+    return {
+        sample.labels['function']: sample.value
+        for family in registry.collect()
+        for sample in family.samples
+        if sample.name == 'execution_seconds_count'
+    }
+
+def test_calls_are_counted(registry):
+    timing.configure(enable=True, rate=1.0, histogram_buckets=())
+
+    assert Exporter().work() == 'done'
+    Exporter().work()
+    Exporter().moved()
+
+    assert counts(registry) == {'Exporter.work': 2, 'Renamed.moved': 1}
+
+def test_enabled_after_decoration(registry):
+    timing.configure(enable=False)
+    Exporter().work()
+
+    assert counts(registry) == {}
+
+    timing.configure(enable=True, rate=1.0, histogram_buckets=())
+    Exporter().work()
+
+    assert counts(registry) == {'Exporter.work': 1}
+
+def test_reconfigured_buckets_reach_decorated_functions(registry):
+    timing.configure(enable=True, rate=1.0, histogram_buckets=())
+    Exporter().work()
+
+    registry.unregister(util.get_metric('execution_seconds'))
+    timing.configure(histogram_buckets=[0.1, 1])
+    Exporter().work()
+
+    buckets = [
+        sample.labels['le']
+        for family in registry.collect()
+        for sample in family.samples
+        if sample.name == 'execution_seconds_bucket'
+    ]
+
+    assert buckets == ['0.1', '1.0', '+Inf']
+    assert counts(registry) == {'Exporter.work': 1}
+
+def test_observe_block(registry):
+    timing.configure(enable=True, rate=1.0, histogram_buckets=())
+
+    with timing.Observe(Exporter(), 'block'):
+        pass
+
+    assert counts(registry) == {'Exporter.block': 1}